@@ -0,0 +1,552 @@
+# Asyncio sync engine (SYNC_ENGINE = 'asyncio').
+#
+# Runs the same cycle as erpnext_sync.main() on one event loop instead of a
+# thread per device and per push:
+#   - the devices are read concurrently over asyncio streams by AsyncZK,
+#     which implements the part of the ZK protocol (over TCP) that
+#     get_all_attendance_from_device uses: connect/auth, disable/enable,
+#     free sizes, users, buffered reads of the attendance log, clear and
+#     exit. The terminal is not pinged before connecting, and terminals
+#     that only speak UDP need the default engine.
+#   - punches are pushed through one pooled aiohttp client when aiohttp is
+#     installed, else send_to_erpnext runs in a thread pool of
+#     HTTP_POOL_SIZE threads
+#   - decoding, dump files, the push limiter and scheduler, watermarks,
+#     attendance logs and status.json are those of the default engine, so a
+#     cycle interrupted under one engine is resumed by the other.
+#
+# Usage, in local_config.py:
+#   SYNC_ENGINE = 'asyncio'
+
+import asyncio
+import contextlib
+import datetime
+import json
+import struct
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from erpnext_sync import config, error_logger, info_logger, push_limiter, status
+
+USHRT_MAX = 65535
+MACHINE_PREPARE_DATA = (0x5050, 0x7D82)
+# command and reply codes, as in zk.const
+CMD_USERTEMP_RRQ = 9
+CMD_CLEAR_ATTLOG = 15
+CMD_GET_FREE_SIZES = 50
+CMD_CONNECT = 1000
+CMD_EXIT = 1001
+CMD_ENABLEDEVICE = 1002
+CMD_DISABLEDEVICE = 1003
+CMD_AUTH = 1102
+CMD_PREPARE_DATA = 1500
+CMD_DATA = 1501
+CMD_FREE_DATA = 1502
+CMD_PREPARE_BUFFER = 1503
+CMD_READ_BUFFER = 1504
+CMD_ACK_OK = 2000
+CMD_ACK_UNAUTH = 2005
+FCT_USER = 5
+MAX_CHUNK = 0xFFC0  # bytes per buffered read over TCP
+
+
+class ZKError(Exception):
+    pass
+
+
+def checksum(packet):
+    """Checksum of a ZK packet (zkemsdk.c, as pyzk computes it)."""
+    total = 0
+    for i in range(0, len(packet) - 1, 2):
+        total += packet[i] | packet[i + 1] << 8
+        if total > USHRT_MAX:
+            total -= USHRT_MAX
+    if len(packet) % 2:
+        total += packet[-1]
+    while total > USHRT_MAX:
+        total -= USHRT_MAX
+    total = ~total
+    while total < 0:
+        total += USHRT_MAX
+    return total
+
+
+class DownloadedAttendance:
+    """What erpnext_sync.iter_attendance_records reads from a connection,
+    downloaded beforehand so that it can be decoded off the event loop.
+    """
+
+    def __init__(self, records, users, attendance_data):
+        self.records = records
+        self._users = users
+        self._attendance_data = attendance_data
+
+    def read_sizes(self):
+        pass
+
+    def get_users(self):
+        return self._users
+
+    def read_with_buffer(self, command, fct=0, ext=0):
+        return self._attendance_data, len(self._attendance_data)
+
+
+class AsyncZK:
+    def __init__(self, ip, port=4370, timeout=30, password=0, encoding="UTF-8"):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+        self.password = password
+        self.encoding = encoding
+        self.users = 0
+        self.records = 0
+        self._reader = self._writer = None
+        self._session_id = 0
+        self._reply_id = USHRT_MAX - 1
+
+    async def connect(self):
+        from zk.base import make_commkey
+
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port), self.timeout
+        )
+        self._session_id = 0
+        self._reply_id = USHRT_MAX - 1
+        header, _ = await self._command(CMD_CONNECT)
+        self._session_id = header[2]
+        if header[0] == CMD_ACK_UNAUTH:
+            header, _ = await self._command(
+                CMD_AUTH, make_commkey(self.password, self._session_id)
+            )
+        if header[0] != CMD_ACK_OK:
+            self._writer.close()
+            if header[0] == CMD_ACK_UNAUTH:
+                raise ZKError("Unauthenticated")
+            raise ZKError("Invalid response: Can't connect")
+        return self
+
+    async def disconnect(self):
+        try:
+            await self._simple_command(CMD_EXIT, "can't disconnect")
+        finally:
+            self._writer.close()
+        return True
+
+    async def disable_device(self):
+        return await self._simple_command(CMD_DISABLEDEVICE, "Can't disable device")
+
+    async def enable_device(self):
+        return await self._simple_command(CMD_ENABLEDEVICE, "Can't enable device")
+
+    async def clear_attendance(self):
+        return await self._simple_command(CMD_CLEAR_ATTLOG, "Can't clear response")
+
+    async def free_data(self):
+        return await self._simple_command(CMD_FREE_DATA, "can't free data")
+
+    async def read_sizes(self):
+        header, data = await self._command(CMD_GET_FREE_SIZES)
+        if header[0] != CMD_ACK_OK:
+            raise ZKError("can't read sizes")
+        if len(data) >= 80:
+            fields = struct.unpack("<20i", data[:80])
+            self.users = fields[4]
+            self.records = fields[8]
+        return True
+
+    async def get_users(self):
+        """The users of the device, as pyzk User objects."""
+        from zk.user import User
+
+        await self.read_sizes()
+        if self.users == 0:
+            return []
+        user_data, size = await self.read_with_buffer(CMD_USERTEMP_RRQ, FCT_USER)
+        if size <= 4:
+            return []
+        user_packet_size = struct.unpack("<I", user_data[:4])[0] / self.users
+        user_data = memoryview(user_data)[4:]
+
+        def text(value):
+            return value.split(b"\x00")[0].decode(self.encoding, errors="ignore")
+
+        if user_packet_size == 28:
+            user_format = struct.Struct("<HB5s8sIxBhI")
+        else:
+            user_format = struct.Struct("<HB8s24sIx7sx24s")
+        user_data = user_data[: len(user_data) // user_format.size * user_format.size]
+        users = []
+        for record in user_format.iter_unpack(user_data):
+            if user_format.size == 28:
+                uid, privilege, password, name, card, group_id, _, user_id = record
+                group_id, user_id = str(group_id), str(user_id)
+            else:
+                uid, privilege, password, name, card, group_id, user_id = record
+                group_id, user_id = text(group_id).strip(), text(user_id)
+            name = text(name).strip() or "NN-%s" % user_id
+            users.append(
+                User(uid, name, privilege, text(password), group_id, user_id, card)
+            )
+        return users
+
+    async def read_with_buffer(self, command, fct=0, ext=0):
+        """(data, size) of a buffered read (CMD_PREPARE_BUFFER), read in
+        chunks of MAX_CHUNK bytes.
+        """
+        header, data = await self._command(
+            CMD_PREPARE_BUFFER, struct.pack("<bhii", 1, command, fct, ext)
+        )
+        if header[0] == CMD_DATA:
+            return data, len(data)
+        if header[0] not in (CMD_ACK_OK, CMD_PREPARE_DATA):
+            raise ZKError("RWB Not supported")
+        size = struct.unpack("<I", data[1:5])[0]
+        chunks = []
+        start = 0
+        while start < size:
+            chunk_size = min(MAX_CHUNK, size - start)
+            chunks.append(await self._read_chunk(start, chunk_size))
+            start += chunk_size
+        await self.free_data()
+        return b"".join(chunks), start
+
+    async def download_attendance(self):
+        """DownloadedAttendance of the device, for iter_attendance_records."""
+        await self.read_sizes()
+        if self.records == 0:
+            return DownloadedAttendance(0, [], b"")
+        records = self.records
+        users = await self.get_users()
+        attendance_data, _ = await self.read_with_buffer(13)  # CMD_ATTLOG_RRQ
+        return DownloadedAttendance(records, users, attendance_data)
+
+    async def _read_chunk(self, start, size):
+        for _ in range(3):
+            header, data = await self._command(
+                CMD_READ_BUFFER, struct.pack("<ii", start, size)
+            )
+            if header[0] == CMD_DATA:
+                return data
+            if header[0] == CMD_PREPARE_DATA:
+                chunk = []
+                while True:
+                    header, data = await self._read_packet()
+                    if header[0] == CMD_DATA:
+                        chunk.append(data)
+                    elif header[0] == CMD_ACK_OK:
+                        return b"".join(chunk)
+                    else:
+                        break
+        raise ZKError("can't read chunk %i:[%i]" % (start, size))
+
+    async def _simple_command(self, command, error):
+        header, _ = await self._command(command)
+        if header[0] != CMD_ACK_OK:
+            raise ZKError(error)
+        return True
+
+    async def _command(self, command, command_string=b""):
+        """Sends a command; returns the header (command, checksum,
+        session_id, reply_id) and the data of the reply.
+        """
+        packet = (
+            struct.pack("<4H", command, 0, self._session_id, self._reply_id)
+            + command_string
+        )
+        self._reply_id += 1
+        if self._reply_id >= USHRT_MAX:
+            self._reply_id -= USHRT_MAX
+        packet = (
+            struct.pack(
+                "<4H", command, checksum(packet), self._session_id, self._reply_id
+            )
+            + command_string
+        )
+        self._writer.write(
+            struct.pack("<HHI", *MACHINE_PREPARE_DATA, len(packet)) + packet
+        )
+        await self._writer.drain()
+        header, data = await self._read_packet()
+        self._reply_id = header[3]
+        return header, data
+
+    async def _read_packet(self):
+        top = await asyncio.wait_for(self._reader.readexactly(8), self.timeout)
+        magic_1, magic_2, length = struct.unpack("<HHI", top)
+        if (magic_1, magic_2) != MACHINE_PREPARE_DATA or length < 8:
+            raise ZKError("TCP packet invalid")
+        packet = await asyncio.wait_for(self._reader.readexactly(length), self.timeout)
+        return struct.unpack("<4H", packet[:8]), packet[8:]
+
+
+async def get_all_attendance_from_device(
+    ip, port=4370, timeout=30, device_id=None, clear_from_device_on_fetch=False
+):
+    """erpnext_sync.get_all_attendance_from_device over AsyncZK."""
+    from erpnext_sync import (
+        finish_fetch,
+        iter_attendance_records,
+        save_attendance_records,
+    )
+
+    conn = None
+    attendances = []
+    try:
+        conn = await AsyncZK(ip, port=port, timeout=timeout).connect()
+        started = time.monotonic()
+        x = await conn.disable_device()
+        # device is disabled when fetching data
+        info_logger.info("\t".join((ip, "Device Disable Attempted. Result:", str(x))))
+        downloaded = await conn.download_attendance()
+        attendances = await asyncio.get_running_loop().run_in_executor(
+            None,
+            save_attendance_records,
+            iter_attendance_records(downloaded),
+            device_id,
+            ip,
+        )
+        if len(attendances) and clear_from_device_on_fetch:
+            x = await conn.clear_attendance()
+            info_logger.info(
+                "\t".join((ip, "Attendance Clear Attempted. Result:", str(x)))
+            )
+        x = await conn.enable_device()
+        seconds = time.monotonic() - started
+        info_logger.info("\t".join((ip, "Device Enable Attempted. Result:", str(x))))
+        await asyncio.get_running_loop().run_in_executor(
+            None, finish_fetch, device_id, attendances, seconds
+        )
+    except:
+        error_logger.exception(str(ip) + " exception when fetching from device...")
+        raise Exception("Device fetch failed.")
+    finally:
+        if conn:
+            try:
+                await conn.disconnect()
+            except Exception:
+                # the stream may already be broken; keep the original error
+                error_logger.exception(str(ip) + " exception when disconnecting...")
+    return attendances
+
+
+async def fetch_attendance_logs(device, dump_file=None):
+    """erpnext_sync.fetch_attendance_logs over AsyncZK."""
+    from erpnext_sync import load_dump_file
+
+    device_attendance_logs = None
+    if dump_file:
+        device_attendance_logs = await asyncio.get_running_loop().run_in_executor(
+            None, load_dump_file, dump_file
+        )
+    if not device_attendance_logs:
+        device_attendance_logs = await get_all_attendance_from_device(
+            device["ip"],
+            device_id=device["device_id"],
+            clear_from_device_on_fetch=device["clear_from_device_on_fetch"],
+        )
+    return device_attendance_logs or []
+
+
+# limiter -> (event loop, asyncio.Event set by the next release())
+_releases = weakref.WeakKeyDictionary()
+
+
+def _release_event(limiter):
+    loop = asyncio.get_running_loop()
+    entry = _releases.get(limiter)
+    if entry is None or entry[0] is not loop:
+        entry = _releases[limiter] = (loop, asyncio.Event())
+    return entry[1]
+
+
+async def acquire(limiter):
+    """limiter.acquire() without blocking the event loop: waits for the time
+    try_acquire() returns, or until release() frees a request slot.
+    """
+    while True:
+        started_at, wait_for = limiter.try_acquire()
+        if started_at is not None:
+            return started_at
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_release_event(limiter).wait(), wait_for)
+
+
+def release(limiter, started_at, status_code, retry_after=None):
+    """limiter.release() for a request started with acquire()."""
+    limiter.release(started_at, status_code, retry_after)
+    entry = _releases.pop(limiter, None)
+    if entry is not None:
+        entry[1].set()
+
+
+def _response(status_code, headers, content):
+    # checkin_result and _safe_get_error_str read requests responses
+    from erpnext_sync import requests
+
+    response = requests.models.Response()
+    response.status_code = status_code
+    response.headers.update(headers)
+    response._content = content
+    return response
+
+
+@contextlib.asynccontextmanager
+async def erpnext_sender():
+    """A coroutine function with the signature and result of
+    send_to_erpnext, sharing one pool of connections.
+    """
+    from erpnext_sync import checkin_request, checkin_result, send_to_erpnext
+
+    pool_size = getattr(config, "HTTP_POOL_SIZE", 32)
+    try:
+        import aiohttp
+    except ImportError:
+        aiohttp = None
+    if aiohttp is None:
+        with ThreadPoolExecutor(max_workers=pool_size) as executor:
+
+            async def send(*args):
+                return await asyncio.get_running_loop().run_in_executor(
+                    executor, send_to_erpnext, *args
+                )
+
+            yield send
+        return
+
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size)
+    ) as session:
+
+        async def send(
+            employee_field_value, timestamp, device_id=None, log_type=None, site=None
+        ):
+            url, headers, data, limiter, _ = checkin_request(
+                employee_field_value, timestamp, device_id, log_type, site
+            )
+            limiter = limiter or push_limiter
+            # like requests, form fields that are None are left out
+            data = {key: value for key, value in data.items() if value is not None}
+            retries = getattr(config, "PUSH_MAX_RETRIES", 3)
+            while True:
+                started_at = await acquire(limiter)
+                response = None
+                try:
+                    async with session.post(url, headers=headers, data=data) as r:
+                        response = _response(r.status, r.headers, await r.read())
+                finally:
+                    release(
+                        limiter,
+                        started_at,
+                        response.status_code if response is not None else None,
+                        (
+                            response.headers.get("Retry-After")
+                            if response is not None
+                            else None
+                        ),
+                    )
+                if response.status_code not in (429, 503) or retries <= 0:
+                    break
+                retries -= 1
+            return checkin_result(
+                response, employee_field_value, timestamp, device_id, log_type
+            )
+
+        yield send
+
+
+async def push_to_sites(pending, send, suppressed=None, deadline=None):
+    """erpnext_sync.push_to_sites on the event loop."""
+    from erpnext_sync import (
+        fair_push_rounds,
+        push_round_size,
+        site_push_outcome,
+        site_push_schedulers,
+    )
+
+    by_site = {}
+    for device, site, device_attendance_logs in pending:
+        by_site.setdefault(site, []).append((device, device_attendance_logs))
+
+    async def push_site(site):
+        schedulers, failed_device_ids = site_push_schedulers(
+            by_site[site], suppressed, site, send
+        )
+        slots = asyncio.Semaphore(push_round_size())
+
+        async def turn(scheduler, limit):
+            async with slots:
+                await scheduler.arun(limit, deadline)
+
+        for turns in fair_push_rounds(schedulers, deadline):
+            await asyncio.gather(*(turn(*x) for x in turns))
+        return site_push_outcome(schedulers, site, failed_device_ids)
+
+    outcomes = await asyncio.gather(*map(push_site, by_site))
+    return (
+        set().union(*(failed for failed, _ in outcomes)),
+        set().union(*(unfinished for _, unfinished in outcomes)),
+    )
+
+
+async def main_async(force=False):
+    """erpnext_sync.main() on one event loop."""
+    from erpnext_sync import (
+        collapse_punches,
+        cycle_devices,
+        finish_cycle,
+        get_dump_file_name_and_directory,
+        next_cycle_time,
+        push_deadline,
+        route_attendance_logs,
+    )
+
+    if not (force or next_cycle_time() <= datetime.datetime.now()):
+        return
+    status.set("lift_off_timestamp", str(datetime.datetime.now()))
+    info_logger.info("Cleared for lift off!")
+    devices = cycle_devices()
+    deadline = push_deadline()
+
+    async def fetch(device):
+        info_logger.info("Processing Device: " + device["device_id"])
+        dump_file = get_dump_file_name_and_directory(device["device_id"], device["ip"])
+        try:
+            device_attendance_logs = await fetch_attendance_logs(device, dump_file)
+        except:
+            error_logger.exception(
+                "exception when fetching attendance for device"
+                + json.dumps(device, default=str)
+            )
+            return None
+        return dump_file, device_attendance_logs
+
+    fetched = []
+    fetch_failed = []
+    pending = []
+    # every device is fetched before anything is pushed, as in main()
+    for device, result in zip(devices, await asyncio.gather(*map(fetch, devices))):
+        if result is None:
+            fetch_failed.append(device["device_id"])
+            continue
+        dump_file, device_attendance_logs = result
+        try:
+            pending.extend(route_attendance_logs(device, device_attendance_logs))
+            fetched.append((device, dump_file))
+        except:
+            fetch_failed.append(device["device_id"])
+            error_logger.exception(
+                "exception when fetching attendance for device"
+                + json.dumps(device, default=str)
+            )
+    suppressed = collapse_punches(
+        [(device, logs) for device, _, logs in pending],
+        getattr(config, "PUNCH_DEBOUNCE_SECONDS", None),
+    )
+    async with erpnext_sender() as send:
+        outcome = await push_to_sites(pending, send, suppressed, deadline)
+    finish_cycle(fetched, *outcome, fetch_failed)
+
+
+def main(force=False):
+    asyncio.run(main_async(force))
@@ -0,0 +1,610 @@
+# High-throughput historical backfill of punches from exported files.
+#
+# Reads USB-exported attendance files (ZKTeco "attlog.dat" TSV) and old
+# "<device_id>_<ip>_last_fetch_dump.json" files as a stream, sorts and
+# de-duplicates them with a bounded-memory external merge sort, then pushes
+# them to ERPNext concurrently while checkpointing progress in status.json.
+#
+# Usage:
+#   python3 erpnext_sync.py backfill --device-id HO1 1_attlog.dat old_dump.json
+#   python3 erpnext_sync.py backfill --device-id HO1 --from-archive --since 20240101
+#
+# With ERPNEXT_SITES the punches are routed with PUNCH_ROUTES, as the live
+# cycle does, and pushed to every site in turn (or only the --site ones),
+# each with its own checkpoint and logs.
+#
+# A second run over the same files resumes after the last record that was
+# acknowledged together with everything before it.
+#
+# Outcomes go to attendance_backfill_log_<device_id>.log, not the success
+# log: the last line of the success log is where pull_process_and_push_data
+# resumes from, and a historical punch there would move it back in time.
+
+import datetime
+import hashlib
+import heapq
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import erpnext_sync
+import punch_archive
+from erpnext_sync import config, error_logger, info_logger, status
+
+DUMP_FILE_SUFFIX = "_last_fetch_dump.json"
+DEFAULT_CHUNK_SIZE = 100000
+DEFAULT_CONCURRENCY = 8
+CHECKPOINT_INTERVAL = 5  # seconds
+PROGRESS_INTERVAL = 10  # seconds
+BACKFILL_LOG_PREFIX = "attendance_backfill_log_"
+DUPLICATE_MARKER = "DUPLICATE"
+
+# sortable record tuple: (epoch timestamp, user_id, uid, punch, status)
+_TIMESTAMP, _USER_ID, _UID, _PUNCH, _STATUS = range(5)
+
+
+class BackfillHalted(Exception):
+    """ERPNext returned an error that is not in the allowlisted errors."""
+
+
+def iter_dump_file(path, read_size=1 << 16):
+    """Yields record tuples from a '_last_fetch_dump.json' file without
+    loading the whole JSON array into memory.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    with open(path, "r") as f:
+        eof = False
+        while True:
+            position = 0
+            while True:
+                while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                    position += 1
+                if position >= len(buffer):
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    if eof:
+                        raise
+                    break  # partial object, read more
+                position = end
+                yield _record_from_dump(obj)
+            buffer = buffer[position:]
+            if eof:
+                return
+            chunk = f.read(read_size)
+            if not chunk:
+                eof = True
+            buffer += chunk
+
+
+def _record_from_dump(obj):
+    return (
+        float(obj["timestamp"]),
+        str(obj["user_id"]),
+        obj.get("uid"),
+        obj.get("punch"),
+        obj.get("status"),
+    )
+
+
+def iter_attlog_file(path):
+    """Yields record tuples from a USB-exported attendance file.
+
+    Lines look like: '      22\\t2019-02-26 20:31:29\\t1\\t0\\t0\\t0'
+    (user_id, timestamp, status/verify type, punch, work code, reserved).
+    """
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        for line_number, line in enumerate(f, 1):
+            columns = line.strip().split("\t")
+            if len(columns) < 2 or not columns[0].strip():
+                continue
+            try:
+                timestamp = datetime.datetime.strptime(
+                    columns[1].strip(), "%Y-%m-%d %H:%M:%S"
+                ).timestamp()
+            except ValueError:
+                error_logger.error(
+                    "\t".join(
+                        ["Backfill: skipping malformed line", path, str(line_number)]
+                    )
+                )
+                continue
+            yield (
+                timestamp,
+                columns[0].strip(),
+                None,
+                _int_or_none(columns, 3),
+                _int_or_none(columns, 2),
+            )
+
+
+def _int_or_none(columns, index):
+    try:
+        return int(columns[index])
+    except (IndexError, ValueError):
+        return None
+
+
+def iter_input_file(path):
+    if path.endswith(".json"):
+        return iter_dump_file(path)
+    return iter_attlog_file(path)
+
+
+def device_id_from_dump_file(path):
+    # dump files are named '<device_id>_<ip with _>_last_fetch_dump.json' and
+    # device_id is strictly alphanumeric
+    name = os.path.basename(path)
+    if name.endswith(DUMP_FILE_SUFFIX):
+        return name.split("_", 1)[0]
+    return None
+
+
+def sorted_unique_records(records, chunk_size=DEFAULT_CHUNK_SIZE, temp_dir=None):
+    """Sorts record tuples by (timestamp, user_id) and drops duplicates, holding
+    at most chunk_size records in memory. Chunks are spilled to sorted run
+    files that are merged lazily.
+
+    Returns (iterator, number of unique records).
+    """
+    runs = []
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_size:
+            runs.append(_spill_run(chunk, temp_dir))
+            chunk = []
+    chunk.sort(key=_sort_key)
+    if runs and chunk:
+        runs.append(_spill_run(chunk, temp_dir))
+        chunk = []
+
+    if not runs:
+        unique = list(_unique(iter(chunk)))
+        return iter(unique), len(unique)
+
+    # count in a first merge pass so that progress can show an ETA
+    total = sum(1 for _ in _unique(_merge_runs(runs, cleanup=False)))
+    return _unique(_merge_runs(runs, cleanup=True)), total
+
+
+def _sort_key(record):
+    return (record[_TIMESTAMP], record[_USER_ID])
+
+
+def _spill_run(chunk, temp_dir):
+    chunk.sort(key=_sort_key)
+    fd, path = tempfile.mkstemp(prefix="backfill_run_", suffix=".jsonl", dir=temp_dir)
+    with os.fdopen(fd, "w") as f:
+        for record in chunk:
+            f.write(json.dumps(record))
+            f.write("\n")
+    return path
+
+
+def _iter_run(path):
+    with open(path, "r") as f:
+        for line in f:
+            yield tuple(json.loads(line))
+
+
+def _merge_runs(runs, cleanup):
+    try:
+        yield from heapq.merge(*[_iter_run(path) for path in runs], key=_sort_key)
+    finally:
+        if cleanup:
+            for path in runs:
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+def _unique(records):
+    last_key = None
+    for record in records:
+        key = _sort_key(record)
+        if key != last_key:
+            last_key = key
+            yield record
+
+
+def input_fingerprint(paths):
+    digest = hashlib.sha1()
+    for path in sorted(os.path.abspath(p) for p in paths):
+        stat = os.stat(path)
+        digest.update(
+            "\t".join([path, str(stat.st_size), str(int(stat.st_mtime))]).encode()
+        )
+    return digest.hexdigest()
+
+
+def _checkpoint_key(device_id):
+    return f"{device_id}_backfill_checkpoint"
+
+
+def _to_device_attendance_log(record):
+    return {
+        "user_id": record[_USER_ID],
+        "timestamp": datetime.datetime.fromtimestamp(record[_TIMESTAMP]),
+        "status": record[_STATUS],
+        "punch": record[_PUNCH],
+        "uid": record[_UID],
+    }
+
+
+def find_device(device_id, punch_direction=None):
+    for device in getattr(config, "devices", []):
+        if device["device_id"] == device_id:
+            if punch_direction:
+                device = dict(device, punch_direction=punch_direction)
+            return device
+    return {"device_id": device_id, "punch_direction": punch_direction or "AUTO"}
+
+
+class _Progress:
+    def __init__(self, total, already_done, label):
+        self.label = label
+        self.total = total
+        self.done = already_done
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self._started_with = already_done
+        self._last_report = 0
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_report < PROGRESS_INTERVAL:
+            return
+        self._last_report = now
+        elapsed = now - self.started_at
+        rate = (self.done - self._started_with) / elapsed if elapsed else 0
+        remaining = self.total - self.done
+        eta = str(datetime.timedelta(seconds=int(remaining / rate))) if rate else "?"
+        message = (
+            "{} progress: {}/{} ({:.1f}%), {} failed, {:.1f} records/s, ETA {}".format(
+                self.label,
+                self.done,
+                self.total,
+                100.0 * self.done / self.total if self.total else 100.0,
+                self.failed,
+                rate,
+                eta,
+            )
+        )
+        print(message)
+        info_logger.info(message)
+        erpnext_sync.record_push_limiter_metrics()
+
+
+def outcome_log_writer(device_id, prefix=BACKFILL_LOG_PREFIX, site=None):
+    """log_result for push_records that writes <prefix><device_id>.log in the
+    logs directory of site. Successes and duplicates (the check-in is already
+    in ERPNext) are written as INFO, other failures as ERROR.
+    """
+    log_file = prefix + device_id
+    outcome_logger = erpnext_sync.setup_logger(
+        log_file if site is None else "/".join([site, log_file]),
+        "/".join([erpnext_sync._logs_directory(site), log_file]) + ".log",
+    )
+
+    def log_result(status_code, message, device_attendance_log):
+        if status_code == 200:
+            outcome_logger.info(
+                erpnext_sync.format_attendance_log_line(message, device_attendance_log)
+            )
+        elif erpnext_sync.DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE in message:
+            outcome_logger.info(
+                erpnext_sync.format_attendance_log_line(
+                    DUPLICATE_MARKER, device_attendance_log
+                )
+            )
+        else:
+            outcome_logger.error(
+                erpnext_sync.format_attendance_log_line(
+                    status_code, device_attendance_log
+                )
+            )
+
+    return log_result
+
+
+def push_records(
+    device,
+    records,
+    total,
+    checkpoint=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    on_checkpoint=None,
+    log_result=None,
+    label="Backfill",
+    site=None,
+):
+    """Pushes sorted, unique record tuples concurrently.
+
+    checkpoint: (timestamp, user_id) of the last record known to be pushed
+        together with everything before it; records up to it are skipped.
+    on_checkpoint: called with the new checkpoint as acknowledgements move it.
+    log_result: called with (status_code, message, device_attendance_log)
+        for every response; defaults to the device's backfill log.
+    label: prefix of the progress lines.
+    site: name of the ERPNext site to push to (see erpnext_sites), None for
+        ERPNEXT_URL.
+
+    Errors are classified like pull_process_and_push_data: allowlisted errors
+    are logged and skipped, anything else stops the backfill after in-flight
+    requests finish, with the checkpoint left before the failed record.
+    """
+    if log_result is None:
+        log_result = outcome_log_writer(device["device_id"], site=site)
+    skipped = 0
+    pending = {}  # future -> sequence number
+    acknowledged = {}  # sequence number -> sort key, waiting for a gap to fill
+    next_to_checkpoint = 0
+    sequence = 0
+    halted = None
+    last_checkpoint_at = time.monotonic()
+    progress = None
+
+    def push(record):
+        device_attendance_log = _to_device_attendance_log(record)
+        status_code, message = erpnext_sync.send_to_erpnext(
+            device_attendance_log["user_id"],
+            device_attendance_log["timestamp"],
+            device["device_id"],
+            erpnext_sync.get_punch_direction(device, device_attendance_log),
+            site,
+        )
+        log_result(status_code, message, device_attendance_log)
+        return status_code, message
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        records = iter(records)
+        exhausted = False
+        while True:
+            while not exhausted and halted is None and len(pending) < concurrency * 2:
+                record = next(records, None)
+                if record is None:
+                    exhausted = True
+                    break
+                if checkpoint is not None and _sort_key(record) <= tuple(checkpoint):
+                    skipped += 1
+                    continue
+                if progress is None:
+                    progress = _Progress(total, skipped, label)
+                pending[executor.submit(push, record)] = (sequence, _sort_key(record))
+                sequence += 1
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                seq, key = pending.pop(future)
+                try:
+                    status_code, message = future.result()
+                except Exception as e:
+                    status_code, message = None, str(e)
+                    error_logger.exception("Backfill: exception when pushing record")
+                progress.done += 1
+                if status_code != 200:
+                    progress.failed += 1
+                    if status_code is None or not erpnext_sync.is_allowlisted_error(
+                        message
+                    ):
+                        halted = halted or message
+                        continue
+                acknowledged[seq] = key
+            while next_to_checkpoint in acknowledged:
+                checkpoint = acknowledged.pop(next_to_checkpoint)
+                next_to_checkpoint += 1
+            if (
+                on_checkpoint
+                and time.monotonic() - last_checkpoint_at > CHECKPOINT_INTERVAL
+            ):
+                on_checkpoint(checkpoint)
+                last_checkpoint_at = time.monotonic()
+            progress.report()
+
+    if on_checkpoint:
+        on_checkpoint(checkpoint)
+    if progress:
+        progress.report(force=True)
+    if halted is not None:
+        raise BackfillHalted(halted)
+    return progress.done - skipped if progress else 0, skipped
+
+
+def backfill(
+    paths,
+    device_id=None,
+    punch_direction=None,
+    concurrency=DEFAULT_CONCURRENCY,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    since=None,
+    until=None,
+    restart=False,
+    from_archive=False,
+    sites=None,
+):
+    """Backfills punches of a single device from exported files, and/or
+    from the punch archive with from_archive.
+
+    With ERPNEXT_SITES the punches are routed like the live cycle does: each
+    site in sites (every site by default) gets its own pass over the input,
+    with its own checkpoint and logs, and punches that no route matches are
+    not pushed. Returns (pushed, skipped) summed over the sites.
+    """
+    import erpnext_sites
+
+    if not device_id:
+        inferred = {device_id_from_dump_file(path) for path in paths}
+        if len(inferred) != 1 or None in inferred:
+            raise ValueError(
+                "device_id could not be inferred from the file names, pass --device-id"
+            )
+        device_id = inferred.pop()
+    device = find_device(device_id, punch_direction)
+
+    fingerprint = input_fingerprint(paths)
+    if from_archive:
+        # the archive only grows, so a checkpoint over it stays valid
+        fingerprint = hashlib.sha1(
+            "\t".join([fingerprint, "archive", str(since), str(until)]).encode()
+        ).hexdigest()
+
+    def records():
+        for path in paths:
+            for record in iter_input_file(path):
+                if since and record[_TIMESTAMP] < since.timestamp():
+                    continue
+                if until and record[_TIMESTAMP] >= until.timestamp():
+                    continue
+                yield record
+        if from_archive:
+            yield from punch_archive.iter_records(
+                erpnext_sync.punch_archive_directory(), device_id, since, until
+            )
+
+    if sites is None:
+        sites = erpnext_sites.site_names() or [None]
+
+    def site_records(site):
+        nonlocal unrouted
+        for record in records():
+            record_site = erpnext_sites.site_for(record[_USER_ID])
+            if record_site is None and site is not None:
+                unrouted += 1
+            elif record_site == site:
+                yield record
+
+    pushed = skipped = 0
+    for site in sites:
+        unrouted = 0  # counted again by every pass
+        site_pushed, site_skipped = _backfill_site(
+            device,
+            site_records(site),
+            site,
+            fingerprint,
+            concurrency,
+            chunk_size,
+            restart,
+        )
+        pushed += site_pushed
+        skipped += site_skipped
+    if unrouted:
+        info_logger.info(
+            "\t".join(
+                ["Punches matching no site in PUNCH_ROUTES:", device_id, str(unrouted)]
+            )
+        )
+    return pushed, skipped
+
+
+def _backfill_site(
+    device, records, site, fingerprint, concurrency, chunk_size, restart
+):
+    import erpnext_sites
+
+    key = erpnext_sites.push_key(device["device_id"], site)
+    saved = status.get(_checkpoint_key(key))
+    checkpoint = None
+    if saved and saved.get("fingerprint") == fingerprint and not restart:
+        checkpoint = saved.get("checkpoint")
+        info_logger.info(
+            "\t".join(["Backfill: resuming", key, "after", json.dumps(checkpoint)])
+        )
+
+    info_logger.info("\t".join(["Backfill: sorting input for", key]))
+    unique_records, total = sorted_unique_records(
+        records, chunk_size=chunk_size, temp_dir=_logs_directory(site)
+    )
+    info_logger.info("\t".join(["Backfill:", str(total), "unique records for", key]))
+
+    def save_checkpoint(new_checkpoint):
+        status.set(
+            _checkpoint_key(key),
+            {
+                "fingerprint": fingerprint,
+                "checkpoint": list(new_checkpoint) if new_checkpoint else None,
+                "updated": str(datetime.datetime.now()),
+            },
+        )
+
+    return push_records(
+        device,
+        unique_records,
+        total,
+        checkpoint=checkpoint,
+        concurrency=concurrency,
+        on_checkpoint=save_checkpoint,
+        label="Backfill" if site is None else "Backfill " + site,
+        site=site,
+    )
+
+
+def _logs_directory(site=None):
+    return erpnext_sync._logs_directory(site)
+
+
+def parse_date(value):
+    return datetime.datetime.strptime(value, "%Y%m%d")
+
+
+def add_arguments(parser):
+    parser.add_argument("files", nargs="*", help="attlog.dat or *_last_fetch_dump.json")
+    parser.add_argument(
+        "--from-archive",
+        action="store_true",
+        help="also read the device's punches from the local punch archive",
+    )
+    parser.add_argument("--device-id", help="defaults to the dump file's device_id")
+    parser.add_argument(
+        "--punch-direction",
+        choices=["IN", "OUT", "AUTO"],
+        help="overrides the device's punch_direction from local_config",
+    )
+    parser.add_argument(
+        "--site",
+        action="append",
+        help="push only the punches routed to this ERPNEXT_SITES site (repeatable)",
+    )
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help="records sorted in memory at a time",
+    )
+    parser.add_argument("--since", type=parse_date, help="YYYYMMDD, inclusive")
+    parser.add_argument("--until", type=parse_date, help="YYYYMMDD, exclusive")
+    parser.add_argument(
+        "--restart", action="store_true", help="ignore the saved checkpoint"
+    )
+
+
+def run(args):
+    if not args.files and not args.from_archive:
+        print("Backfill needs input files or --from-archive")
+        return 2
+    try:
+        pushed, skipped = backfill(
+            args.files,
+            device_id=args.device_id,
+            punch_direction=args.punch_direction,
+            concurrency=args.concurrency,
+            chunk_size=args.chunk_size,
+            since=args.since,
+            until=args.until,
+            restart=args.restart,
+            from_archive=args.from_archive,
+            sites=args.site,
+        )
+    except BackfillHalted as e:
+        error_logger.error("\t".join(["Backfill halted by ERPNext error.", str(e)]))
+        print("Backfill halted, fix the error and run again to resume:", e)
+        return 1
+    print(
+        "Backfill finished: {} pushed, {} skipped by checkpoint".format(pushed, skipped)
+    )
+    return 0
@@ -0,0 +1,111 @@
+# Throughput of the Thai date formatters on attendance-like timestamps.
+#
+# Usage:
+#   python3 benchmarks/thai_strftime_bench.py [number of timestamps]
+#
+# First prints the per-call cost of common formats, then compares
+# thai_strftime() in a loop with compile_thai_format() and
+# thai_strftime_many() over a day's worth of punches spread over a few dates,
+# like a daily Thai attendance digest.
+
+import os
+import random
+import sys
+import time
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from thai_strftime import (  # noqa: E402
+    compile_thai_format,
+    thai_strftime,
+    thai_strftime_many,
+)
+
+FORMATS = [
+    "%a %-d %b %y",
+    "%A %-d %B %Y %H:%M:%S",
+    "%c",
+]
+
+
+def punch_timestamps(count, days=3, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2024, 6, 3, 6, 0, 0)
+    return [
+        start + timedelta(days=rng.randrange(days), seconds=rng.randrange(14 * 3600))
+        for _ in range(count)
+    ]
+
+
+def measure(fn):
+    started = time.perf_counter()
+    fn()
+    return time.perf_counter() - started
+
+
+PER_CALL_FORMATS = [
+    "%a %-d %b %y",
+    "%c",
+    "%-d %b %y",
+    "%A %d %B %Y",
+    "%H:%M",
+    "%-H นาฬิกา %-M นาที",
+]
+
+
+def per_call(number=100000):
+    """Micro-benchmark: microseconds per call of a single timestamp."""
+    dt_obj = datetime(2019, 6, 9, 5, 59, 0)
+    print("per call, best of 5 x {}".format(number))
+    print("{:<24} {:>14} {:>14}".format("format", "thai_strftime", "compiled"))
+    for fmt in PER_CALL_FORMATS:
+        compiled_fmt = compile_thai_format(fmt)
+        direct = min(
+            timeit.repeat(lambda: thai_strftime(dt_obj, fmt), number=number, repeat=5)
+        )
+        compiled = min(
+            timeit.repeat(lambda: compiled_fmt(dt_obj), number=number, repeat=5)
+        )
+        print(
+            "{:<24} {:>11.2f} us {:>11.2f} us".format(
+                fmt, direct / number * 1e6, compiled / number * 1e6
+            )
+        )
+    print()
+
+
+def main(count=200000):
+    per_call()
+    timestamps = punch_timestamps(count)
+    print("{} timestamps over 3 dates".format(count))
+    print(
+        "{:<24} {:<10} {:>14} {:>14} {:>14} {:>8}".format(
+            "format", "digits", "loop/s", "compiled/s", "many/s", "gain"
+        )
+    )
+    for fmt in FORMATS:
+        for thai_digit in (False, True):
+            loop = measure(
+                lambda: [thai_strftime(dt, fmt, thai_digit) for dt in timestamps]
+            )
+            compiled_fmt = compile_thai_format(fmt, thai_digit)
+            compiled = measure(lambda: [compiled_fmt(dt) for dt in timestamps])
+            many = measure(
+                lambda: list(thai_strftime_many(timestamps, fmt, thai_digit))
+            )
+            print(
+                "{:<24} {:<10} {:>14,.0f} {:>14,.0f} {:>14,.0f} {:>7.1f}x".format(
+                    fmt,
+                    "thai" if thai_digit else "arabic",
+                    count / loop,
+                    count / compiled,
+                    count / many,
+                    loop / many,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
@@ -0,0 +1,215 @@
+# Cooperative device ownership between hosts (DEVICE_LEASE_DIRECTORY).
+#
+# When the sync runs on several hosts for redundancy, each device must be
+# pulled and pushed by one host only. The hosts share a SQLite file in
+# DEVICE_LEASE_DIRECTORY (a shared volume) holding one lease per device:
+# (holder, expiry). At the start of every cycle a host, in one transaction:
+#   - renews its heartbeat; hosts whose heartbeat has expired are gone
+#   - computes its fair share, ceil(devices / live hosts)
+#   - releases the leases it holds above its share, so that a host that
+#     just joined gets them at its next cycle
+#   - renews its other leases and claims free or expired ones up to its
+#     share
+# and then syncs only the devices it holds. A lease lasts
+# DEVICE_LEASE_SECONDS (twice PULL_FREQUENCY by default), so the devices of
+# a host that stops are taken over within one lease period.
+#
+# The push watermarks of a device are saved with its lease at the end of
+# each cycle and restored by the host that takes the device over, so it
+# resumes where the previous holder stopped instead of pushing again. For
+# that, a host must be done pushing before its leases can be taken: leases
+# are only renewed when a cycle starts, so the pushes of a cycle stop being
+# dispatched LEASE_MARGIN of a lease before the leases claimed for it
+# expire (see push_deadline), and what is left is carried over to the next
+# cycle. The margin leaves time for the pushes in flight and the saving of
+# the watermarks.
+#
+# The hosts' clocks must be synchronized (NTP). SQLite locking needs a
+# shared file system with working POSIX locks (e.g. NFSv4, SMB); lock
+# files are not used.
+
+import contextlib
+import json
+import math
+import os
+import socket
+import sqlite3
+import time
+
+from erpnext_sync import config, info_logger, status
+
+LEASE_FILE = "device_leases.sqlite3"
+LEASE_MARGIN = 0.1  # part of a lease at its end in which no push is dispatched
+_store = None
+
+
+class LeaseStore:
+    def __init__(self, path, holder, lease_seconds):
+        self.path = path
+        self.holder = holder
+        self.lease_seconds = lease_seconds
+        self.expires = None  # of the leases held since the last claim
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (device_id TEXT PRIMARY KEY,"
+                " holder TEXT, expires REAL, state TEXT)"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS hosts (holder TEXT PRIMARY KEY,"
+                " expires REAL)"
+            )
+
+    def _connect(self):
+        # autocommit: transactions are opened explicitly with BEGIN IMMEDIATE,
+        # and rolled back if the connection is closed before COMMIT
+        return contextlib.closing(
+            sqlite3.connect(self.path, timeout=60, isolation_level=None)
+        )
+
+    def claim(self, device_ids, now=None):
+        """Renews and claims leases as described above. Returns (held,
+        acquired): the device_ids held now and those among them that were
+        not held before.
+        """
+        now = time.time() if now is None else now
+        expires = now + self.lease_seconds
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "INSERT OR REPLACE INTO hosts VALUES (?, ?)", (self.holder, expires)
+            )
+            live_hosts = conn.execute(
+                "SELECT COUNT(*) FROM hosts WHERE expires > ?", (now,)
+            ).fetchone()[0]
+            share = math.ceil(len(device_ids) / live_hosts)
+            leases = {
+                device_id: (holder, lease_expires)
+                for device_id, holder, lease_expires in conn.execute(
+                    "SELECT device_id, holder, expires FROM leases"
+                )
+            }
+            held = [
+                device_id
+                for device_id in device_ids
+                if leases.get(device_id, (None, 0))[0] == self.holder
+                and leases[device_id][1] > now
+            ]
+            released = held[share:]
+            held = held[:share]
+            acquired = []
+            for device_id in device_ids:
+                if len(held) + len(acquired) >= share:
+                    break
+                holder, lease_expires = leases.get(device_id, (None, 0))
+                if device_id not in held and (holder is None or lease_expires <= now):
+                    acquired.append(device_id)
+            for device_id in released:
+                conn.execute(
+                    "UPDATE leases SET holder = NULL, expires = 0"
+                    " WHERE device_id = ?",
+                    (device_id,),
+                )
+            for device_id in held + acquired:
+                conn.execute(
+                    "INSERT INTO leases (device_id, holder, expires) VALUES (?, ?, ?)"
+                    " ON CONFLICT (device_id) DO UPDATE SET holder = excluded.holder,"
+                    " expires = excluded.expires",
+                    (device_id, self.holder, expires),
+                )
+            conn.execute("COMMIT")
+        self.expires = expires
+        return held + acquired, acquired
+
+    def push_deadline(self, now=None):
+        """Seconds from now after which no push should be dispatched, so
+        that the leases of the last claim do not expire mid-push; None
+        before the first claim.
+        """
+        if self.expires is None:
+            return None
+        now = time.time() if now is None else now
+        return self.expires - LEASE_MARGIN * self.lease_seconds - now
+
+    def save_state(self, device_id, state):
+        """Saves the state of a device held by this host."""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE leases SET state = ? WHERE device_id = ? AND holder = ?",
+                (json.dumps(state), device_id, self.holder),
+            )
+
+    def load_state(self, device_id):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT state FROM leases WHERE device_id = ?", (device_id,)
+            ).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+
+def get_store():
+    global _store
+    if _store is None:
+        directory = config.DEVICE_LEASE_DIRECTORY
+        os.makedirs(directory, exist_ok=True)
+        _store = LeaseStore(
+            os.path.join(directory, LEASE_FILE),
+            getattr(config, "DEVICE_LEASE_HOLDER", None) or socket.gethostname(),
+            getattr(config, "DEVICE_LEASE_SECONDS", None)
+            or 2 * config.PULL_FREQUENCY * 60,
+        )
+    return _store
+
+
+def _watermark_keys(device_id):
+    import erpnext_sites
+
+    return [
+        erpnext_sites.push_key(device_id, site) + "_push_watermark"
+        for site in erpnext_sites.site_names() or [None]
+    ]
+
+
+def claim_devices(devices):
+    """The devices this host holds a lease on for this cycle. The watermarks
+    of the devices taken over from another host are restored.
+    """
+    store = get_store()
+    held, acquired = store.claim([device["device_id"] for device in devices])
+    for device_id in acquired:
+        state = store.load_state(device_id)
+        for key in _watermark_keys(device_id):
+            watermark = state.get(key)
+            local = status.get(key)
+            if watermark and (
+                not local
+                or (watermark["timestamp"] or 0) > (local.get("timestamp") or 0)
+            ):
+                status.set(key, watermark)
+    info_logger.info(
+        "\t".join(
+            ["Device leases:", store.holder, "held", ",".join(held) or "-"]
+            + (["acquired", ",".join(acquired)] if acquired else [])
+        )
+    )
+    return [device for device in devices if device["device_id"] in held]
+
+
+def push_deadline():
+    """time.monotonic() after which the pushes of this cycle must stop being
+    dispatched, before the leases claimed for it expire; None if no lease
+    was claimed yet.
+    """
+    remaining = get_store().push_deadline()
+    return None if remaining is None else time.monotonic() + remaining
+
+
+def save_watermarks(device_ids):
+    """Saves the watermarks of the devices with their leases, for the host
+    that takes them over next.
+    """
+    store = get_store()
+    for device_id in device_ids:
+        store.save_state(
+            device_id,
+            {key: status.get(key) for key in _watermark_keys(device_id)},
+        )
@@ -0,0 +1,169 @@
+# Managed trimming of the attendance tables of the devices
+# (DEVICE_TRIM_THRESHOLD).
+#
+# With clear_from_device_on_fetch off, a device keeps every punch, and each
+# fetch reads the whole table with the device disabled: fetches get slower
+# every month. Clearing right after a fetch risks losing punches that are
+# not pushed yet, so instead, at the end of a cycle, a device is cleared
+# only when:
+#   - its last fetch read more than DEVICE_TRIM_THRESHOLD records (or the
+#     device's 'trim_threshold')
+#   - the cycle runs in the low-traffic DEVICE_TRIM_WINDOW (local time)
+#   - every fetched record is in ERPNext: the device's pushes all finished
+#     (pushed, or rejected with an allowlisted error) on every site. A copy
+#     in the punch archive is not enough, as the device would then no longer
+#     hold punches that ERPNext is still missing.
+#   - the device, once disabled, still holds exactly the records fetched:
+#     punches that arrived since the fetch would otherwise be lost
+#
+# Every fetch records its size and duration as '<device_id>_fetch_stats' in
+# status.json. A trim records the size before and after and the duration of
+# the last fetch as '<device_id>_trim'; the duration of the first fetch after
+# it is added there, so the gain is visible.
+
+import datetime
+
+import erpnext_sync
+from erpnext_sync import config, error_logger, info_logger, status
+
+DEFAULT_WINDOW = ("01:00", "05:00")
+
+
+def record_fetch(device_id, records, seconds, archived):
+    """Saves the statistics of a fetch of records from a device, read in
+    seconds; archived is True when they were all saved to the punch archive.
+    """
+    status.set(
+        f"{device_id}_fetch_stats",
+        {
+            "timestamp": str(datetime.datetime.now()),
+            "records": records,
+            "seconds": round(seconds, 3),
+            "archived": archived,
+        },
+    )
+    trim = status.get(f"{device_id}_trim")
+    if trim and trim.get("fetch_seconds_after") is None:
+        trim["fetch_seconds_after"] = round(seconds, 3)
+        trim["records_after_first_fetch"] = records
+        status.set(f"{device_id}_trim", trim)
+        info_logger.info(
+            "\t".join(
+                [
+                    "Fetch after trim:",
+                    device_id,
+                    "seconds",
+                    str(trim["fetch_seconds_before"]),
+                    "->",
+                    str(trim["fetch_seconds_after"]),
+                    "records",
+                    str(trim["records_before"]),
+                    "->",
+                    str(records),
+                ]
+            )
+        )
+
+
+def in_window(now, window=None):
+    """True when now (a datetime) is within window, ("HH:MM", "HH:MM") in
+    local time; the window may span midnight.
+    """
+    start, end = (
+        datetime.datetime.strptime(x, "%H:%M").time()
+        for x in window or getattr(config, "DEVICE_TRIM_WINDOW", DEFAULT_WINDOW)
+    )
+    if start <= end:
+        return start <= now.time() < end
+    return now.time() >= start or now.time() < end
+
+
+def threshold(device):
+    return device.get("trim_threshold", getattr(config, "DEVICE_TRIM_THRESHOLD", None))
+
+
+def trim_devices(fetched, failed_device_ids=(), unfinished_device_ids=(), now=None):
+    """Trims the fetched devices ([(device, dump file)]) that qualify, as
+    described above. Returns the ids of the devices trimmed.
+    """
+    trimmed = set()
+    if not in_window(now or datetime.datetime.now()):
+        return trimmed
+    for device, _ in fetched:
+        device_id = device["device_id"]
+        if not threshold(device) or device["clear_from_device_on_fetch"]:
+            continue
+        stats = status.get(f"{device_id}_fetch_stats")
+        if not stats or stats["records"] <= threshold(device):
+            continue
+        pushed = (
+            device_id not in failed_device_ids
+            and device_id not in unfinished_device_ids
+        )
+        if not pushed:
+            info_logger.info(
+                "\t".join(["Trim postponed:", device_id, "punches not pushed yet"])
+            )
+            continue
+        try:
+            if trim_device(device, stats):
+                trimmed.add(device_id)
+        except Exception:
+            error_logger.exception("exception when trimming device " + device_id)
+    return trimmed
+
+
+def trim_device(device, stats):
+    """Clears the attendance of a device if it still holds the
+    stats["records"] records fetched. Returns True if it was cleared.
+    """
+    device_id = device["device_id"]
+    with erpnext_sync.device_connection(device["ip"]) as conn:
+        conn.disable_device()
+        try:
+            conn.read_sizes()
+            records_before = conn.records
+            if records_before != stats["records"]:
+                info_logger.info(
+                    "\t".join(
+                        [
+                            "Trim postponed:",
+                            device_id,
+                            str(records_before),
+                            "records on the device,",
+                            str(stats["records"]),
+                            "fetched",
+                        ]
+                    )
+                )
+                return False
+            conn.clear_attendance()
+            conn.read_sizes()
+            records_after = conn.records
+        finally:
+            conn.enable_device()
+    status.set(
+        f"{device_id}_trim",
+        {
+            "timestamp": str(datetime.datetime.now()),
+            "records_before": records_before,
+            "records_after": records_after,
+            "fetch_seconds_before": stats["seconds"],
+            "fetch_seconds_after": None,
+        },
+    )
+    info_logger.info(
+        "\t".join(
+            [
+                "Device trimmed:",
+                device_id,
+                "records",
+                str(records_before),
+                "->",
+                str(records_after),
+                "last fetch seconds",
+                str(stats["seconds"]),
+            ]
+        )
+    )
+    return True
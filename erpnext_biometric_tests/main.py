@@ -1,9 +1,19 @@
 import requests
+import argparse
+import http.client
 import json
-from datetime import datetime
+import socket
+import ssl
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import importlib.util
 import os
 import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote, urlencode, urlsplit
 from loguru import logger
 
 # Configure loguru logger
@@ -20,6 +30,11 @@ logger.add(
     format="{time:YYYY-MM-DD HH:mm:ss} | {level: <8} | {message}",
 )
 
+EMPLOYEE_FIELDS = ["name", "employee_name", "attendance_device_id", "status"]
+EMPLOYEE_PAGE_LENGTH = 500
+EMPLOYEE_PAGE_WORKERS = 4
+
+
 def load_config(config_file='local_config.py'):
     """
     Load configuration from external file
@@ -51,8 +66,30 @@ class ERPNextTester:
             "Accept": "application/json",
             "Content-Type": "application/json"
         }
+        self._session = None
+        self._employees = None
+        self._session_lock = threading.Lock()
         logger.debug("ERPNextTester initialized with config")
 
+    @property
+    def session(self):
+        """Keep-alive session shared by the bulk and load-test requests"""
+        with self._session_lock:
+            if self._session is None:
+                pool_size = getattr(self.config, "HTTP_POOL_SIZE", 32)
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=pool_size, pool_maxsize=pool_size
+                )
+                self._session = requests.Session()
+                self._session.headers.update(self.headers)
+                self._session.mount("http://", adapter)
+                self._session.mount("https://", adapter)
+            return self._session
+
+    def checkin_url(self):
+        endpoint_app = "hrms" if getattr(self.config, "ERPNEXT_VERSION", 15) > 13 else "erpnext"
+        return f"{self.config.ERPNEXT_URL}/api/method/{endpoint_app}.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field"
+
     def test_permissions(self):
         """
         Test API user permissions
@@ -82,25 +119,105 @@ class ERPNextTester:
         
         return all_permissions_ok
 
-    def get_all_employees(self):
+    def get_employee_count(self):
         """
-        Get list of all employees with their attendance device IDs
+        Number of Employee records, or None if it cannot be read
         """
+        url = f"{self.config.ERPNEXT_URL}/api/method/frappe.client.get_count"
+        try:
+            response = self.session.get(url, params={"doctype": "Employee"})
+            if response.status_code == 200:
+                return int(response.json().get('message'))
+        except Exception as e:
+            logger.warning(f"Could not count employees: {str(e)}")
+        return None
+
+    def get_employee_page(self, start, page_length=EMPLOYEE_PAGE_LENGTH):
         url = f"{self.config.ERPNEXT_URL}/api/resource/Employee"
+        params = {
+            "fields": json.dumps(EMPLOYEE_FIELDS),
+            "limit_start": start,
+            "limit_page_length": page_length,
+            "order_by": "name asc",
+        }
+        response = self.session.get(url, params=params)
+        response.raise_for_status()
+        return response.json().get('data', [])
+
+    def get_all_employees(self, refresh=False):
+        """
+        Get list of all employees with their attendance device IDs
+
+        Pages of EMPLOYEE_PAGE_LENGTH rows are fetched concurrently, sized by
+        frappe.client.get_count. The list is cached for the session.
+        """
+        if self._employees is not None and not refresh:
+            return self._employees
         try:
             logger.info("Fetching employee list...")
-            response = requests.get(url, headers=self.headers)
-            if response.status_code == 200:
-                employees = response.json().get('data', [])
-                if employees:
-                    logger.success(f"Found {len(employees)} employees")
-                    return employees
-            logger.warning("No employees found")
-            return []
+            count = self.get_employee_count()
+            employees = []
+            if count is None:
+                # page until a short page
+                start = 0
+                while True:
+                    page = self.get_employee_page(start)
+                    employees.extend(page)
+                    if len(page) < EMPLOYEE_PAGE_LENGTH:
+                        break
+                    start += EMPLOYEE_PAGE_LENGTH
+            else:
+                starts = range(0, count, EMPLOYEE_PAGE_LENGTH)
+                with ThreadPoolExecutor(max_workers=EMPLOYEE_PAGE_WORKERS) as executor:
+                    for page in executor.map(self.get_employee_page, starts):
+                        employees.extend(page)
+            self._employees = employees
+            if employees:
+                logger.success(f"Found {len(employees)} employees")
+            else:
+                logger.warning("No employees found")
+            return employees
         except Exception as e:
             logger.error(f"Error fetching employees: {str(e)}")
             return []
 
+    def audit_employee_mapping(self, device_user_ids):
+        """
+        Compare device user IDs with Employee.attendance_device_id
+
+        Returns a dict with the device user IDs that have no employee, the
+        ones mapped to an employee that is not Active, and attendance device
+        IDs used by more than one employee.
+        """
+        by_device_id = {}
+        for emp in self.get_all_employees():
+            device_id = (emp.get('attendance_device_id') or '').strip()
+            if device_id:
+                by_device_id.setdefault(device_id, []).append(emp)
+
+        unmatched, inactive = [], []
+        for user_id in sorted(set(device_user_ids)):
+            employees = by_device_id.get(user_id)
+            if not employees:
+                unmatched.append(user_id)
+            elif not any(emp.get('status') == 'Active' for emp in employees):
+                inactive.append(user_id)
+        duplicated = {
+            device_id: [emp['name'] for emp in employees]
+            for device_id, employees in sorted(by_device_id.items())
+            if len(employees) > 1
+        }
+
+        for user_id in unmatched:
+            logger.warning(f"No employee for device user ID {user_id}")
+        for user_id in inactive:
+            logger.warning(f"Employee for device user ID {user_id} is not active")
+        for device_id, names in duplicated.items():
+            logger.warning(f"Device user ID {device_id} is used by {', '.join(names)}")
+        if not (unmatched or inactive or duplicated):
+            logger.success("Every device user ID maps to one active employee")
+        return {"unmatched": unmatched, "inactive": inactive, "duplicated": duplicated}
+
     def get_employee_details(self, employee_id):
         """
         Get details for a specific employee
@@ -133,9 +250,7 @@ class ERPNextTester:
                 if employees:
                     print("\n👥 Available Employees:")
                     for emp in employees:
-                        emp_details = self.get_employee_details(emp['name'])
-                        if emp_details:
-                            print(f"ID: {emp_details.get('attendance_device_id', 'N/A')} - Name: {emp_details.get('employee_name')} ({emp['name']})")
+                        print(f"ID: {emp.get('attendance_device_id') or 'N/A'} - Name: {emp.get('employee_name')} ({emp['name']})")
                 
             employee_id = input("\n🔑 Enter Employee ID to test: ").strip()
             if not employee_id:
@@ -144,7 +259,7 @@ class ERPNextTester:
 
         logger.info(f"Testing Employee Checkin API for Employee ID: {employee_id}")
         
-        checkin_url = f"{self.config.ERPNEXT_URL}/api/method/hrms.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field"
+        checkin_url = self.checkin_url()
         
         test_data = {
             "employee_field_value": employee_id,
@@ -189,7 +304,7 @@ class ERPNextTester:
         logger.info("Testing Shift Type API...")
         
         for shift_mapping in self.config.shift_type_device_mapping:
-            for shift_name in shift_mapping['shift_type_name']:
+            for shift_name in shift_type_names(shift_mapping):
                 url = f"{self.config.ERPNEXT_URL}/api/resource/Shift Type/{shift_name}"
                 
                 try:
@@ -202,25 +317,428 @@ class ERPNextTester:
                 except Exception as e:
                     logger.error(f"Error checking Shift Type {shift_name}: {str(e)}")
 
-def main():
+    def load_test(self, employee_ids, count=100, concurrency=10, rate=None, cleanup=True):
+        """
+        Send synthetic check-ins to add_log_based_on_employee_field and
+        report throughput, latency percentiles and errors.
+
+        Check-ins are spread one second apart from 30 days ago, cycling
+        through employee_ids, and use a unique device_id so they can be told
+        apart from real punches. With cleanup they are deleted afterwards.
+        """
+        run_id = f"LOADTEST-{uuid.uuid4().hex[:8]}"
+        base_time = datetime.now().replace(microsecond=0) - timedelta(days=30)
+        checkin_url = self.checkin_url()
+        logger.info(
+            f"Load test {run_id}: {count} check-ins, concurrency {concurrency}, "
+            f"rate {rate or 'unlimited'}/s, employees {', '.join(employee_ids)}"
+        )
+
+        latencies = []
+        errors = Counter()
+        created = []
+        results_lock = threading.Lock()
+
+        def send(i):
+            data = {
+                "employee_field_value": employee_ids[i % len(employee_ids)],
+                "timestamp": (base_time + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"),
+                "device_id": run_id,
+                "log_type": "IN" if i % 2 == 0 else "OUT",
+            }
+            started = time.perf_counter()
+            try:
+                response = self.session.post(checkin_url, json=data)
+                error = None
+                if response.status_code == 200:
+                    name = response.json().get("message", {}).get("name")
+                else:
+                    name = None
+                    try:
+                        exc_type = response.json().get("exc_type", "")
+                    except ValueError:
+                        exc_type = ""
+                    error = f"HTTP {response.status_code} {exc_type}".strip()
+            except Exception as e:
+                name = None
+                error = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with results_lock:
+                latencies.append(elapsed)
+                if error:
+                    errors[error] += 1
+                elif name:
+                    created.append(name)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for i in range(count):
+                if rate:
+                    # pace submissions to the target rate
+                    delay = started + i / rate - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                executor.submit(send, i)
+        duration = time.perf_counter() - started
+
+        report = {
+            "run_id": run_id,
+            "requests": count,
+            "succeeded": count - sum(errors.values()),
+            "duration_s": round(duration, 3),
+            "throughput_rps": round(count / duration, 2) if duration else None,
+            "latency_ms": latency_percentiles(latencies),
+            "errors": dict(errors),
+        }
+        logger.info(f"Throughput: {report['throughput_rps']} check-ins/s over {report['duration_s']} s")
+        logger.info(
+            "Latency ms: "
+            + ", ".join(f"{k} {v}" for k, v in report["latency_ms"].items())
+        )
+        if errors:
+            for error, error_count in errors.most_common():
+                logger.error(f"{error_count} x {error}")
+        else:
+            logger.success("No errors")
+
+        if cleanup:
+            report["submitted_for_deletion"] = self.delete_checkins(created)
+            # deletion of large batches is queued: count what is still there
+            report["remaining"] = self.count_checkins(run_id)
+            if report["remaining"]:
+                logger.warning(
+                    f"{report['remaining']} test check-ins of {run_id} are still "
+                    "in ERPNext, their deletion may still be queued"
+                )
+        return report
+
+    def probe_targets(self):
+        """
+        (name, method, path, body) of each endpoint the sync depends on
+        """
+        targets = [
+            ("employee_checkin_list", "GET", "/api/resource/" + quote("Employee Checkin") + "?" + urlencode({"limit_page_length": 1}), None),
+            ("employee_list", "GET", "/api/resource/Employee?" + urlencode({"fields": '["name"]', "limit_page_length": 1}), None),
+        ]
+        shift_names = [
+            name
+            for mapping in getattr(self.config, "shift_type_device_mapping", [])
+            for name in shift_type_names(mapping)
+        ]
+        if shift_names:
+            shift_path = "/api/resource/" + quote("Shift Type") + "/" + quote(shift_names[0])
+            targets.append(("shift_type_get", "GET", shift_path, None))
+            try:
+                response = self.session.get(self.config.ERPNEXT_URL + shift_path)
+                response.raise_for_status()
+                # write back the current value, so the PUT changes nothing
+                current = response.json()['data'].get('last_sync_of_checkin')
+                body = json.dumps({"last_sync_of_checkin": current})
+                targets.append(("shift_type_put", "PUT", shift_path, body))
+            except Exception as e:
+                logger.warning(f"Not probing Shift Type PUT, cannot read {shift_names[0]}: {str(e)}")
+        # an employee that does not exist, so that no check-in is created
+        checkin_body = json.dumps({
+            "employee_field_value": "PROBE-NONEXISTENT",
+            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "device_id": "PROBE",
+            "log_type": "IN",
+        })
+        checkin_path = urlsplit(self.checkin_url()).path
+        targets.append(("checkin_method", "POST", checkin_path, checkin_body))
+        return targets
+
+    def probe(self, repeat=10, cold_repeat=3):
+        """
+        Time each endpoint repeat times over one keep-alive connection (warm)
+        and cold_repeat times over a new connection each (cold)
+        """
+        report = {
+            "url": self.config.ERPNEXT_URL,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "repeat": repeat,
+            "cold_repeat": cold_repeat,
+            "endpoints": {},
+        }
+        warm = ProbeConnection(self.config.ERPNEXT_URL)
+        cold = ProbeConnection(self.config.ERPNEXT_URL)
+        for name, method, path, body in self.probe_targets():
+            logger.info(f"Probing {method} {path.split('?')[0]}")
+            statuses = Counter()
+            timings = {key: [] for key in ("connect", "tls", "cold_ttfb", "cold_total", "warm_ttfb", "warm_total")}
+            for _ in range(cold_repeat):
+                try:
+                    connect, tls = cold.open()
+                    status, ttfb, total = cold.request(method, path, self.headers, body)
+                except (OSError, http.client.HTTPException) as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                finally:
+                    cold.close()
+                statuses[str(status)] += 1
+                timings["connect"].append(connect)
+                if tls is not None:
+                    timings["tls"].append(tls)
+                timings["cold_ttfb"].append(ttfb)
+                # the whole cost of a request on a new connection
+                timings["cold_total"].append(connect + (tls or 0) + total)
+            for _ in range(repeat):
+                try:
+                    if warm.conn is None:
+                        warm.open()
+                    status, ttfb, total = warm.request(method, path, self.headers, body)
+                except (OSError, http.client.HTTPException) as e:
+                    warm.close()
+                    statuses[type(e).__name__] += 1
+                    continue
+                statuses[str(status)] += 1
+                timings["warm_ttfb"].append(ttfb)
+                timings["warm_total"].append(total)
+            result = {
+                "method": method,
+                "path": path,
+                "status": dict(statuses),
+                "cold": {
+                    "connect_ms": latency_percentiles(timings["connect"]),
+                    "tls_ms": latency_percentiles(timings["tls"]),
+                    "ttfb_ms": latency_percentiles(timings["cold_ttfb"]),
+                    "total_ms": latency_percentiles(timings["cold_total"]),
+                },
+                "warm": {
+                    "ttfb_ms": latency_percentiles(timings["warm_ttfb"]),
+                    "total_ms": latency_percentiles(timings["warm_total"]),
+                },
+            }
+            report["endpoints"][name] = result
+            logger.info(
+                f"{name}: cold p50 {result['cold']['total_ms'].get('p50')} ms, "
+                f"warm p50 {result['warm']['total_ms'].get('p50')} ms, status {dict(statuses)}"
+            )
+        warm.close()
+        return report
+
+    def delete_checkins(self, names, batch_size=500):
+        """
+        Submit Employee Checkin rows for deletion in bulk through
+        frappe.desk.reportview.delete_items, which deletes large batches in a
+        background job: a 200 response means submitted, not deleted
+        """
+        url = f"{self.config.ERPNEXT_URL}/api/method/frappe.desk.reportview.delete_items"
+        submitted = 0
+        for i in range(0, len(names), batch_size):
+            batch = names[i : i + batch_size]
+            try:
+                response = self.session.post(
+                    url, json={"items": json.dumps(batch), "doctype": "Employee Checkin"}
+                )
+                if response.status_code == 200:
+                    submitted += len(batch)
+                else:
+                    logger.error(f"Could not delete test check-ins: {response.text}")
+            except Exception as e:
+                logger.error(f"Error deleting test check-ins: {str(e)}")
+        logger.info(f"Submitted {submitted} of {len(names)} test check-ins for deletion")
+        return submitted
+
+    def count_checkins(self, device_id):
+        """
+        Number of Employee Checkin rows of a device_id, None if it cannot be read
+        """
+        url = f"{self.config.ERPNEXT_URL}/api/method/frappe.client.get_count"
+        params = {
+            "doctype": "Employee Checkin",
+            "filters": json.dumps({"device_id": device_id}),
+        }
+        try:
+            response = self.session.get(url, params=params)
+            if response.status_code == 200:
+                return response.json().get("message")
+            logger.error(f"Could not count check-ins: {response.text}")
+        except Exception as e:
+            logger.error(f"Error counting check-ins: {str(e)}")
+        return None
+
+
+class ProbeConnection:
+    """
+    HTTP connection opened step by step so that TCP connect, TLS handshake
+    and time to first byte can be timed separately
+    """
+
+    def __init__(self, base_url, timeout=30):
+        parts = urlsplit(base_url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.conn = None
+
+    def open(self):
+        """Opens a new connection, returns (connect, tls) durations in seconds"""
+        self.close()
+        started = time.perf_counter()
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        connected = time.perf_counter()
+        # as urllib3 does, otherwise small requests wait on delayed ACKs
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        tls = None
+        if self.https:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self.host)
+            tls = time.perf_counter() - connected
+            self.conn = http.client.HTTPSConnection(self.host, self.port, timeout=self.timeout)
+        else:
+            self.conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.conn.sock = sock
+        return connected - started, tls
+
+    def request(self, method, path, headers, body=None):
+        """Sends one request on the open connection, returns (status, ttfb, total)"""
+        started = time.perf_counter()
+        self.conn.request(method, self.base_path + path, body=body, headers=headers)
+        response = self.conn.getresponse()
+        ttfb = time.perf_counter() - started
+        response.read()
+        total = time.perf_counter() - started
+        if response.will_close:
+            self.close()
+        return response.status, ttfb, total
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def shift_type_names(mapping):
+    """Shift Types of a shift_type_device_mapping entry, whose
+    'shift_type_name' may be a single name or a list"""
+    names = mapping['shift_type_name']
+    return [names] if isinstance(names, str) else names
+
+
+def latency_percentiles(latencies):
+    """p50/p95/p99/max of latencies in seconds, as milliseconds"""
+    if not latencies:
+        return {}
+    ordered = sorted(latencies)
+
+    def percentile(p):
+        # nearest rank
+        index = max(0, min(len(ordered) - 1, int(round(p / 100.0 * len(ordered))) - 1))
+        return round(ordered[index] * 1000, 1)
+
+    return {
+        "p50": percentile(50),
+        "p95": percentile(95),
+        "p99": percentile(99),
+        "max": round(ordered[-1] * 1000, 1),
+    }
+
+
+def run_interactive_tests(tester):
+    # Run all tests
+    permissions_ok = tester.test_permissions()
+    if permissions_ok:
+        tester.test_checkin_api()
+        tester.test_shift_type_api()
+    else:
+        logger.warning("Skipping further tests due to permission issues")
+        logger.info("Please fix permissions first")
+
+
+def get_device_user_ids(config):
+    """
+    User IDs enrolled on every device in local_config.devices
+    """
+    from zk import ZK
+
+    user_ids = set()
+    for device in config.devices:
+        conn = None
+        try:
+            logger.info(f"Reading users from device {device['device_id']}")
+            conn = ZK(device['ip'], port=device.get('port', 4370), timeout=30).connect()
+            user_ids.update(user.user_id for user in conn.get_users())
+        except Exception as e:
+            logger.error(f"Error reading users from device {device['device_id']}: {str(e)}")
+        finally:
+            if conn:
+                conn.disconnect()
+    return user_ids
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="ERPNext Biometric API Testing Suite")
+    parser.add_argument("--config", default="local_config.py", help="path to local_config.py")
+    subparsers = parser.add_subparsers(dest="command")
+
+    loadtest_parser = subparsers.add_parser(
+        "loadtest", help="send synthetic check-ins concurrently and report throughput"
+    )
+    loadtest_parser.add_argument(
+        "--employee", action="append", required=True,
+        help="attendance_device_id to check in (repeatable)",
+    )
+    loadtest_parser.add_argument("--count", type=int, default=100)
+    loadtest_parser.add_argument("--concurrency", type=int, default=10)
+    loadtest_parser.add_argument("--rate", type=float, help="target check-ins per second")
+    loadtest_parser.add_argument(
+        "--no-cleanup", action="store_true", help="keep the test Employee Checkin rows"
+    )
+
+    audit_parser = subparsers.add_parser(
+        "audit", help="report device user IDs with no matching active employee"
+    )
+    audit_parser.add_argument(
+        "--user-id", action="append",
+        help="device user ID to check (repeatable); defaults to the users on every device",
+    )
+
+    probe_parser = subparsers.add_parser(
+        "probe", help="time the endpoints the sync depends on and print a JSON report"
+    )
+    probe_parser.add_argument("--repeat", type=int, default=10, help="requests per endpoint on a kept-alive connection")
+    probe_parser.add_argument("--cold-repeat", type=int, default=3, help="requests per endpoint on a new connection")
+    probe_parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+    return parser
+
+
+def main(argv=None):
+    args = build_arg_parser().parse_args(argv)
+
     # Ensure logs directory exists
     os.makedirs("logs", exist_ok=True)
     
     # Load configuration
     logger.info("Starting ERPNext Test Suite")
-    config = load_config()
+    config = load_config(args.config)
     
     # Create tester instance
     tester = ERPNextTester(config)
-    
-    # Run all tests
-    permissions_ok = tester.test_permissions()
-    if permissions_ok:
-        tester.test_checkin_api()
-        tester.test_shift_type_api()
+
+    if args.command == "loadtest":
+        report = tester.load_test(
+            args.employee,
+            count=args.count,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            cleanup=not args.no_cleanup,
+        )
+        print(json.dumps(report, indent=2))
+    elif args.command == "probe":
+        report = tester.probe(repeat=args.repeat, cold_repeat=args.cold_repeat)
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+            logger.info(f"Probe report written to {args.output}")
+        else:
+            print(json.dumps(report, indent=2))
+    elif args.command == "audit":
+        report = tester.audit_employee_mapping(args.user_id or get_device_user_ids(config))
+        print(json.dumps(report, indent=2))
     else:
-        logger.warning("Skipping further tests due to permission issues")
-        logger.info("Please fix permissions first")
+        run_interactive_tests(tester)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,165 @@
+# Routing of punches to several ERPNext sites (ERPNEXT_SITES).
+#
+# Shared terminals collect punches for companies that run on separate
+# ERPNext sites. Each device is still read once per cycle; its punches are
+# split by site with PUNCH_ROUTES and the sites are pushed in parallel, each
+# with its own HTTP session, push limiter, push watermark
+# ("<site>:<device_id>_push_watermark" in status.json) and attendance logs
+# (<LOGS_DIRECTORY>/<site>/), so that a site that is down or slow holds
+# back only its own punches.
+#
+# A route sends a user_id to a site by:
+#   - user_ids: explicit list, looked up in a dict
+#   - ranges: [low, high] of numeric user_ids (inclusive), looked up by
+#     bisection over the sorted, non-overlapping ranges
+#   - prefixes: longest matching prefix
+# in that order; other user_ids go to DEFAULT_SITE, or are not pushed when
+# it is None. Results are cached per user_id.
+#
+# Without ERPNEXT_SITES every punch goes to ERPNEXT_URL as before (site
+# None).
+
+import bisect
+import threading
+
+from erpnext_sync import config
+
+_lock = threading.Lock()
+_sites = None
+_router = None
+
+
+class Site:
+    def __init__(self, name, settings):
+        from erpnext_sync import _new_http_session
+        from push_limiter import AdaptiveLimiter
+
+        self.name = name
+        self.url = settings["url"].rstrip("/")
+        self.api_key = settings["api_key"]
+        self.api_secret = settings["api_secret"]
+        self.version = settings.get("version", 15)
+        self.session = _new_http_session()
+        self.limiter = AdaptiveLimiter(
+            latency_target=settings.get(
+                "latency_target_ms", getattr(config, "PUSH_LATENCY_TARGET_MS", 500)
+            )
+            / 1000.0,
+            max_limit=settings.get(
+                "max_concurrency", getattr(config, "PUSH_MAX_CONCURRENCY", 16)
+            ),
+            max_rps=settings.get("max_rps", getattr(config, "PUSH_MAX_RPS", None)),
+        )
+
+
+class PunchRouter:
+    def __init__(self, routes, default_site=None):
+        self.default_site = default_site
+        self._user_ids = {}
+        self._prefixes = {}
+        ranges = []
+        for route in routes:
+            site = route["site"]
+            for user_id in route.get("user_ids", []):
+                self._user_ids[str(user_id)] = site
+            for prefix in route.get("prefixes", []):
+                self._prefixes[str(prefix)] = site
+            for low, high in route.get("ranges", []):
+                ranges.append((int(low), int(high), site))
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] <= previous[1]:
+                raise ValueError(
+                    "PUNCH_ROUTES ranges overlap: {} and {}".format(
+                        previous[:2], current[:2]
+                    )
+                )
+        self._range_lows = [low for low, _, _ in ranges]
+        self._ranges = ranges
+        self._prefix_lengths = sorted({len(p) for p in self._prefixes}, reverse=True)
+        self._cache = {}
+
+    def site_for(self, user_id):
+        """Name of the site of a user_id, or None when it is not routed."""
+        user_id = str(user_id)
+        try:
+            return self._cache[user_id]
+        except KeyError:
+            pass
+        site = self._user_ids.get(user_id)
+        if site is None and user_id.isdigit():
+            number = int(user_id)
+            i = bisect.bisect_right(self._range_lows, number) - 1
+            if i >= 0 and number <= self._ranges[i][1]:
+                site = self._ranges[i][2]
+        if site is None:
+            for length in self._prefix_lengths:
+                site = self._prefixes.get(user_id[:length])
+                if site is not None:
+                    break
+        if site is None:
+            site = self.default_site
+        self._cache[user_id] = site
+        return site
+
+
+def _load():
+    global _sites, _router
+    with _lock:
+        if _sites is None:
+            settings = getattr(config, "ERPNEXT_SITES", None) or {}
+            sites = {name: Site(name, s) for name, s in settings.items()}
+            router = PunchRouter(
+                getattr(config, "PUNCH_ROUTES", []),
+                getattr(config, "DEFAULT_SITE", None),
+            )
+            for site in [router.default_site] + [
+                route["site"] for route in getattr(config, "PUNCH_ROUTES", [])
+            ]:
+                if site is not None and site not in sites:
+                    raise ValueError("PUNCH_ROUTES: unknown site " + site)
+            _router = router
+            _sites = sites
+
+
+def site_names():
+    """Names of the configured sites; empty without ERPNEXT_SITES."""
+    _load()
+    return list(_sites)
+
+
+def get(name):
+    _load()
+    return _sites[name]
+
+
+def site_for(user_id):
+    """Name of the site of a user_id; None when it is not routed or without
+    ERPNEXT_SITES.
+    """
+    _load()
+    return _router.site_for(user_id) if _sites else None
+
+
+def split(device_attendance_logs):
+    """{site name: attendance logs} with an entry for every site, and the
+    number of logs that no route matched. Without ERPNEXT_SITES:
+    ({None: device_attendance_logs}, 0).
+    """
+    _load()
+    if not _sites:
+        return {None: device_attendance_logs}, 0
+    by_site = {name: [] for name in _sites}
+    unrouted = 0
+    for device_attendance_log in device_attendance_logs:
+        site = _router.site_for(device_attendance_log["user_id"])
+        if site is None:
+            unrouted += 1
+        else:
+            by_site[site].append(device_attendance_log)
+    return by_site, unrouted
+
+
+def push_key(device_id, site=None):
+    """Status key prefix of the pushes of a device to a site."""
+    return device_id if site is None else "{}:{}".format(site, device_id)
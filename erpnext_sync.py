@@ -1,20 +1,59 @@
-import local_config as config
-import requests
+import argparse
+import contextlib
 import datetime
+import importlib
+import inspect
 import json
 import os
+import struct
 import sys
+import threading
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from logging.handlers import RotatingFileHandler
-import pickledb
-from zk import ZK, const
+
+_STARTED_AT = time.perf_counter()
+
+
+class _Lazy:
+    """Stands in for an object that is expensive to create until first use.
+
+    Importing this module must stay cheap (cron one-shots, health checks,
+    replays), so ``local_config``, ``requests``, ``pickledb``, ``zk``, the
+    loggers and ``status.json`` are only loaded once an attribute is read.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def _resolve(self):
+        if self._value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self._resolve(), attr)
+
+
+def _lazy_import(name):
+    return _Lazy(lambda: importlib.import_module(name))
+
+
+config = _lazy_import("local_config")
+requests = _lazy_import("requests")
+pickledb = _lazy_import("pickledb")
+pyzk = _lazy_import("zk")
 
 # Manot's modified import
 # /api/method/erpnext.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field
 # import pywhatkit
 
-import thai_strftime
+# import thai_strftime (where it is called, to keep imports cheap)
 # import apprise
 # from dotenv import load_dotenv
 # from multiprocessing import Process
@@ -34,7 +73,9 @@ EMPLOYEE_INACTIVE_ERROR_MESSAGE = (
 DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE = (
     "This employee already has a log with the same timestamp"
 )
-allowlisted_errors = [
+# numbered 1-3 by allowed_exceptions in the config file, see
+# get_allowlisted_errors()
+ALLOWLISTABLE_ERRORS = [
     EMPLOYEE_NOT_FOUND_ERROR_MESSAGE,
     EMPLOYEE_INACTIVE_ERROR_MESSAGE,
     DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE,
@@ -60,6 +101,7 @@ datetime_obj = datetime.datetime.now()
 # thaiformat = thai_strftime(thai_now, "%a %-d %b %y")
 # print('Thai Format',thaiformat)
 
+# import thai_strftime
 # thai_date = thai_strftime.thai_strftime(datetime_obj, "%A %-d %b %y")
 
 # apobj.add(telegram_url)
@@ -67,15 +109,27 @@ datetime_obj = datetime.datetime.now()
 # apobj.notify(body="สวัสดี " + thai_date + "\n" + "จาก ZKTeco ", title="แค่เข้ามาทักทาย")
 
 
-if hasattr(config, "allowed_exceptions"):
-    allowlisted_errors_temp = []
-    for error_number in config.allowed_exceptions:
-        allowlisted_errors_temp.append(allowlisted_errors[error_number - 1])
-    allowlisted_errors = allowlisted_errors_temp
+_configured_allowlisted_errors = None
 
-device_punch_values_IN = getattr(config, "device_punch_values_IN", [0, 4])
-device_punch_values_OUT = getattr(config, "device_punch_values_OUT", [1, 5])
-ERPNEXT_VERSION = getattr(config, "ERPNEXT_VERSION", 15)
+
+def get_allowlisted_errors():
+    """Returns the ERPNext errors that should not halt the import, honouring
+    ``allowed_exceptions`` in the config file.
+    """
+    global _configured_allowlisted_errors
+    if _configured_allowlisted_errors is None:
+        if hasattr(config, "allowed_exceptions"):
+            _configured_allowlisted_errors = [
+                ALLOWLISTABLE_ERRORS[error_number - 1]
+                for error_number in config.allowed_exceptions
+            ]
+        else:
+            _configured_allowlisted_errors = ALLOWLISTABLE_ERRORS
+    return _configured_allowlisted_errors
+
+
+def is_allowlisted_error(erpnext_message):
+    return any(error in erpnext_message for error in get_allowlisted_errors())
 
 # possible area of further developemt
 # Real-time events - setup getting events pushed from the machine rather then polling.
@@ -88,111 +142,386 @@ ERPNEXT_VERSION = getattr(config, "ERPNEXT_VERSION", 15)
 #  - <device_id>_pull_timestamp
 #  - <device_id>_push_timestamp
 #  - <shift_type>_sync_timestamp
+#  - <device_id>_push_watermark (<site>:<device_id>_push_watermark per site)
+#  - <device_id>_freshness
+#  - shift_types
+# device leases and the watermarks they hand over are kept in
+# DEVICE_LEASE_DIRECTORY (see device_leases)
 
 
-def main():
+def main(force=False):
     """Takes care of checking if it is time to pull data based on config,
     then calling the relevent functions to pull data and push to EPRNext.
 
+    force: skip the PULL_FREQUENCY check and run a cycle right away.
     """
     try:
-        last_lift_off_timestamp = _safe_convert_date(
-            status.get("lift_off_timestamp"), "%Y-%m-%d %H:%M:%S.%f"
-        )
-        if (
-            last_lift_off_timestamp
-            and last_lift_off_timestamp
-            < datetime.datetime.now()
-            - datetime.timedelta(minutes=config.PULL_FREQUENCY)
-        ) or not last_lift_off_timestamp:
+        if getattr(config, "SYNC_ENGINE", "threads") == "asyncio":
+            import async_engine
+
+            return async_engine.main(force)
+        if force or next_cycle_time() <= datetime.datetime.now():
             status.set("lift_off_timestamp", str(datetime.datetime.now()))
             info_logger.info("Cleared for lift off!")
-            for device in config.devices:
-                device_attendance_logs = None
+            devices = cycle_devices()
+            deadline = push_deadline()
+            # fetch every device first, so that punches can be collapsed
+            # across devices before anything is pushed
+            fetched = []
+            fetch_failed = []
+            pending = []
+            for device in devices:
                 info_logger.info("Processing Device: " + device["device_id"])
                 dump_file = get_dump_file_name_and_directory(
                     device["device_id"], device["ip"]
                 )
-                if os.path.exists(dump_file):
-                    info_logger.error(
-                        "Device Attendance Dump Found in Log Directory. This can mean the program crashed unexpectedly. Retrying with dumped data."
-                    )
-                    with open(dump_file, "r") as f:
-                        file_contents = f.read()
-                        if file_contents:
-                            device_attendance_logs = list(
-                                map(
-                                    lambda x: _apply_function_to_key(
-                                        x, "timestamp", datetime.datetime.fromtimestamp
-                                    ),
-                                    json.loads(file_contents),
-                                )
-                            )
                 try:
-                    pull_process_and_push_data(device, device_attendance_logs)
-                    status.set(
-                        f'{device["device_id"]}_push_timestamp',
-                        str(datetime.datetime.now()),
-                    )
-                    if os.path.exists(dump_file):
-                        os.remove(dump_file)
-                    info_logger.info(
-                        "Successfully processed Device: " + device["device_id"]
-                    )
+                    device_attendance_logs = fetch_attendance_logs(device, dump_file)
+                    pending.extend(route_attendance_logs(device, device_attendance_logs))
+                    fetched.append((device, dump_file))
                 except:
+                    fetch_failed.append(device["device_id"])
                     error_logger.exception(
-                        "exception when calling pull_process_and_push_data function for device"
+                        "exception when fetching attendance for device"
                         + json.dumps(device, default=str)
                     )
-            if hasattr(config, "shift_type_device_mapping"):
-                update_shift_last_sync_timestamp(config.shift_type_device_mapping)
-            status.set("mission_accomplished_timestamp", str(datetime.datetime.now()))
-            info_logger.info("Mission Accomplished!")
+            suppressed = collapse_punches(
+                [(device, logs) for device, _, logs in pending],
+                getattr(config, "PUNCH_DEBOUNCE_SECONDS", None),
+            )
+            finish_cycle(
+                fetched, *push_to_sites(pending, suppressed, deadline), fetch_failed
+            )
     except:
         error_logger.exception("exception has occurred in the main function...")
 
 
-def pull_process_and_push_data(device, device_attendance_logs=None):
-    """Takes a single device config as param and pulls data from that device.
+def cycle_devices():
+    """The devices to sync in this cycle: config.devices, or those this host
+    holds a lease on with DEVICE_LEASE_DIRECTORY (see device_leases).
+    """
+    if not getattr(config, "DEVICE_LEASE_DIRECTORY", None):
+        return config.devices
+    import device_leases
 
-    params:
-    device: a single device config object from the local_config file
-    device_attendance_logs: fetching from device is skipped if this param is passed. used to restart failed fetches from previous runs.
+    return device_leases.claim_devices(config.devices)
+
+
+def route_attendance_logs(device, device_attendance_logs):
+    """[(device, site, pending attendance logs)] of the fetched logs of a
+    device, one entry per ERPNext site (see erpnext_sites).
+    """
+    import erpnext_sites
+
+    by_site, unrouted = erpnext_sites.split(device_attendance_logs)
+    if unrouted:
+        info_logger.info(
+            "\t".join(
+                [
+                    "Punches matching no site in PUNCH_ROUTES:",
+                    device["device_id"],
+                    str(unrouted),
+                ]
+            )
+        )
+    return [
+        (
+            device,
+            site,
+            (
+                get_pending_attendance_logs(device, site_attendance_logs, site)
+                if site_attendance_logs
+                else []
+            ),
+        )
+        for site, site_attendance_logs in by_site.items()
+    ]
+
+
+def finish_cycle(
+    fetched, failed_device_ids, unfinished_device_ids=(), fetch_failed_device_ids=()
+):
+    """Marks the fetched devices whose pushes all succeeded as processed,
+    then updates the Shift Types and the metrics.
+
+    fetched: [(device, dump file)]
+    unfinished_device_ids: devices with punches left at the push deadline;
+        they resume from their push watermarks next cycle.
+    fetch_failed_device_ids: devices that could not be read; their
+        freshness is marked stale.
     """
-    attendance_success_log_file = "_".join(
-        ["attendance_success_log", device["device_id"]]
+    if getattr(config, "DEVICE_TRIM_THRESHOLD", None) or any(
+        "trim_threshold" in device for device, _ in fetched
+    ):
+        import device_trim
+
+        device_trim.trim_devices(fetched, failed_device_ids, unfinished_device_ids)
+    for device, dump_file in fetched:
+        if device["device_id"] in failed_device_ids:
+            continue
+        if device["device_id"] in unfinished_device_ids:
+            # the punches are still on the device unless they were cleared on
+            # fetch: pull them again next cycle, with the newest ones
+            if not device["clear_from_device_on_fetch"] and os.path.exists(dump_file):
+                os.remove(dump_file)
+            info_logger.info(
+                "Push carried over to the next cycle: " + device["device_id"]
+            )
+            continue
+        status.set(
+            f'{device["device_id"]}_push_timestamp',
+            str(datetime.datetime.now()),
+        )
+        if os.path.exists(dump_file):
+            os.remove(dump_file)
+        info_logger.info("Successfully processed Device: " + device["device_id"])
+    if getattr(config, "DEVICE_LEASE_DIRECTORY", None):
+        import device_leases
+
+        device_leases.save_watermarks([device["device_id"] for device, _ in fetched])
+    if hasattr(config, "shift_type_device_mapping"):
+        update_shift_last_sync_timestamp(config.shift_type_device_mapping)
+    record_push_limiter_metrics()
+    fetched_device_ids = [device["device_id"] for device, _ in fetched]
+    record_freshness_metrics(
+        fetched_device_ids,
+        set(fetched_device_ids) - set(failed_device_ids) - set(unfinished_device_ids),
+        fetch_failed_device_ids,
     )
-    attendance_failed_log_file = "_".join(
-        ["attendance_failed_log", device["device_id"]]
+    status.set("mission_accomplished_timestamp", str(datetime.datetime.now()))
+    info_logger.info("Mission Accomplished!")
+
+
+def next_cycle_time():
+    """When the next cycle is due: PULL_FREQUENCY minutes after the last lift
+    off, or planned around the shifts with SHIFT_AWARE_SCHEDULING (see
+    shift_schedule).
+    """
+    last_lift_off_timestamp = _safe_convert_date(
+        status.get("lift_off_timestamp"), "%Y-%m-%d %H:%M:%S.%f"
+    )
+    if not last_lift_off_timestamp:
+        return datetime.datetime.now()
+    if _shift_aware_scheduling():
+        import shift_schedule
+
+        shift_types = shift_schedule.load_shift_types()
+        if shift_types:
+            return shift_schedule.next_cycle_time(shift_types, last_lift_off_timestamp)
+    return last_lift_off_timestamp + datetime.timedelta(minutes=config.PULL_FREQUENCY)
+
+
+def _shift_aware_scheduling():
+    return getattr(config, "SHIFT_AWARE_SCHEDULING", False) and hasattr(
+        config, "shift_type_device_mapping"
     )
-    attendance_success_logger = setup_logger(
-        attendance_success_log_file,
-        "/".join([config.LOGS_DIRECTORY, attendance_success_log_file]) + ".log",
+
+
+def push_deadline():
+    """time.monotonic() after which no push of the cycle starting now is
+    dispatched: PUSH_CYCLE_MINUTES later, or None for no deadline (the
+    default). With DEVICE_LEASE_DIRECTORY it is never later than the end of
+    the leases claimed by cycle_devices() (see device_leases.push_deadline).
+    """
+    minutes = getattr(config, "PUSH_CYCLE_MINUTES", None)
+    deadline = time.monotonic() + minutes * 60 if minutes else None
+    if getattr(config, "DEVICE_LEASE_DIRECTORY", None):
+        import device_leases
+
+        lease_deadline = device_leases.push_deadline()
+        if lease_deadline is not None:
+            deadline = (
+                lease_deadline if deadline is None else min(deadline, lease_deadline)
+            )
+    return deadline
+
+
+def push_to_sites(pending, suppressed=None, deadline=None):
+    """Pushes [(device, site, attendance logs)], the sites in parallel and
+    the devices of a site in fair-share rounds (see fair_push_rounds) until
+    they are done or deadline (time.monotonic()) is reached. Returns (ids of
+    the devices whose push failed on any site, ids of the devices with
+    punches left at the deadline).
+    """
+    by_site = {}
+    for device, site, device_attendance_logs in pending:
+        by_site.setdefault(site, []).append((device, device_attendance_logs))
+
+    def push_site(site):
+        schedulers, failed_device_ids = site_push_schedulers(
+            by_site[site], suppressed, site
+        )
+        with ThreadPoolExecutor(max_workers=push_round_size()) as executor:
+            for turns in fair_push_rounds(schedulers, deadline):
+                list(executor.map(lambda turn: turn[0].run(turn[1], deadline), turns))
+        return site_push_outcome(schedulers, site, failed_device_ids)
+
+    if len(by_site) <= 1:
+        outcomes = list(map(push_site, by_site))
+    else:
+        with ThreadPoolExecutor(max_workers=len(by_site)) as executor:
+            outcomes = list(executor.map(push_site, by_site))
+    return (
+        set().union(*(failed for failed, _ in outcomes)),
+        set().union(*(unfinished for _, unfinished in outcomes)),
     )
-    attendance_failed_logger = setup_logger(
-        attendance_failed_log_file,
-        "/".join([config.LOGS_DIRECTORY, attendance_failed_log_file]) + ".log",
+
+
+def site_push_schedulers(site_pending, suppressed=None, site=None, send=None):
+    """([(device, PushScheduler)], ids of the devices whose scheduler could not
+    be created) of [(device, attendance logs)] to push to a site.
+    """
+    schedulers = []
+    failed_device_ids = set()
+    for device, device_attendance_logs in site_pending:
+        try:
+            schedulers.append(
+                (
+                    device,
+                    new_push_scheduler(
+                        device, device_attendance_logs, suppressed, site, send
+                    ),
+                )
+            )
+        except:
+            failed_device_ids.add(device["device_id"])
+            error_logger.exception(
+                "exception when calling pull_process_and_push_data function for device"
+                + json.dumps(device, default=str)
+                + ("" if site is None else " site " + site)
+            )
+    return schedulers, failed_device_ids
+
+
+def fair_push_rounds(schedulers, deadline=None):
+    """Deficit round-robin over the schedulers of the devices of a site (see
+    push_scheduler.deficit_round_robin): each round a device may push
+    PUSH_QUANTUM punches times its 'push_weight' in config.devices (1 by
+    default), so that a large backlog does not hold back the other devices.
+    Yields the [(scheduler, limit)] of each round, to be run concurrently,
+    at most push_round_size() at a time.
+    """
+    from push_scheduler import deficit_round_robin
+
+    return deficit_round_robin(
+        [scheduler for _, scheduler in schedulers],
+        [device.get("push_weight", 1) for device, _ in schedulers],
+        getattr(config, "PUSH_QUANTUM", 100),
+        deadline,
     )
+
+
+def push_round_size():
+    """Devices of a site pushing at the same time within a round."""
+    return getattr(config, "HTTP_POOL_SIZE", 32)
+
+
+def site_push_outcome(schedulers, site=None, failed_device_ids=()):
+    """(failed device ids, unfinished device ids) once the rounds of a site
+    are over; failed_device_ids are added to the former.
+    """
+    failed_device_ids = set(failed_device_ids)
+    unfinished_device_ids = set()
+    for device, scheduler in schedulers:
+        if scheduler.halted is not None:
+            failed_device_ids.add(device["device_id"])
+            error_logger.error(
+                "API Call to ERPNext Failed for device"
+                + json.dumps(device, default=str)
+                + ("" if site is None else " site " + site)
+                + ": "
+                + scheduler.halted
+            )
+        elif not scheduler.done:
+            unfinished_device_ids.add(device["device_id"])
+            info_logger.info(
+                "\t".join(
+                    [
+                        "Push deadline reached:",
+                        device["device_id"],
+                        str(scheduler.remaining),
+                        "punches left",
+                    ]
+                    + ([] if site is None else ["site", site])
+                )
+            )
+    return failed_device_ids, unfinished_device_ids
+
+
+def fetch_attendance_logs(device, dump_file=None):
+    """Attendance logs of a device: from the dump left by an earlier cycle if
+    there is one, else pulled from the device.
+    """
+    device_attendance_logs = load_dump_file(dump_file) if dump_file else None
     if not device_attendance_logs:
         device_attendance_logs = get_all_attendance_from_device(
             device["ip"],
             device_id=device["device_id"],
             clear_from_device_on_fetch=device["clear_from_device_on_fetch"],
         )
+    return device_attendance_logs or []
+
+
+def load_dump_file(dump_file):
+    """Attendance logs of a dump left behind by an earlier cycle, or None."""
+    if not os.path.exists(dump_file):
+        return None
+    info_logger.error(
+        "Device Attendance Dump Found in Log Directory. This can mean the program crashed unexpectedly. Retrying with dumped data."
+    )
+    with open(dump_file, "r") as f:
+        file_contents = f.read()
+        if file_contents:
+            return list(
+                map(
+                    lambda x: _apply_function_to_key(
+                        x, "timestamp", datetime.datetime.fromtimestamp
+                    ),
+                    json.loads(file_contents),
+                )
+            )
+    return None
+
+
+def pull_process_and_push_data(device, device_attendance_logs=None):
+    """Takes a single device config as param and pulls data from that device.
+
+    params:
+    device: a single device config object from the local_config file
+    device_attendance_logs: fetching from device is skipped if this param is passed. used to restart failed fetches from previous runs.
+    """
+    push_attendance_logs(
+        device, get_pending_attendance_logs(device, device_attendance_logs)
+    )
+
+
+def get_pending_attendance_logs(device, device_attendance_logs=None, site=None):
+    """Pulls the attendance logs of a device (unless passed in) and returns
+    the ones that are not pushed yet (to site, see erpnext_sites).
+    """
+    import erpnext_sites
+
+    if not device_attendance_logs:
+        device_attendance_logs = fetch_attendance_logs(device)
         if not device_attendance_logs:
-            return
+            return []
     # for finding the last successfull push and restart from that point (or) from a set 'config.IMPORT_START_DATE' (whichever is later)
     index_of_last = -1
-    last_line = get_last_line_from_file(
-        "/".join([config.LOGS_DIRECTORY, attendance_success_log_file]) + ".log"
-    )
-    import_start_date = _safe_convert_date(config.IMPORT_START_DATE, "%Y%m%d")
-    if last_line or import_start_date:
-        last_user_id = None
-        last_timestamp = None
+    last_user_id = None
+    last_timestamp = None
+    push_key = erpnext_sites.push_key(device["device_id"], site)
+    watermark = status.get(f"{push_key}_push_watermark")
+    if watermark:
+        if watermark["timestamp"] is not None:
+            last_user_id = watermark["user_id"]
+            last_timestamp = datetime.datetime.fromtimestamp(watermark["timestamp"])
+    else:
+        last_line = get_last_pushed_line(device["device_id"], site)
         if last_line:
             last_user_id, last_timestamp = last_line.split("\t")[4:6]
             last_timestamp = datetime.datetime.fromtimestamp(float(last_timestamp))
+    import_start_date = _safe_convert_date(config.IMPORT_START_DATE, "%Y%m%d")
+    if last_timestamp or import_start_date:
         if import_start_date:
             if last_timestamp:
                 if last_timestamp < import_start_date:
@@ -212,124 +541,552 @@ def pull_process_and_push_data(device, device_attendance_logs=None):
                 if x["timestamp"] >= last_timestamp:
                     index_of_last = i
                     break
+    pending = device_attendance_logs[index_of_last + 1 :]
+    if watermark and watermark.get("acked_ahead"):
+        # pushed ahead of the watermark by the live lane
+        acked_ahead = {tuple(key) for key in watermark["acked_ahead"]}
+        pending = [
+            x
+            for x in pending
+            if (str(x["user_id"]), x["timestamp"].timestamp()) not in acked_ahead
+        ]
+    return pending
+
+
+def get_last_pushed_line(device_id, site=None):
+    """Last line of the success log, or of the suppressed log if that one is
+    later: a suppressed punch is as done as a pushed one.
+    """
+    last_line, last_suppressed_line = [
+        get_last_line_from_file(log_file) if os.path.exists(log_file) else None
+        for log_file in (
+            "/".join([_logs_directory(site), "_".join([prefix, device_id])]) + ".log"
+            for prefix in ("attendance_success_log", "attendance_suppressed_log")
+        )
+    ]
+    if last_suppressed_line and (
+        not last_line
+        or float(last_suppressed_line.split("\t")[5]) > float(last_line.split("\t")[5])
+    ):
+        return last_suppressed_line
+    return last_line
+
+
+def push_attendance_logs(device, device_attendance_logs, suppressed=None, site=None):
+    """Pushes attendance logs of a device to ERPNext, live punches first
+    (see push_scheduler).
+
+    suppressed: {id(log): kept log} from collapse_punches; those punches are
+    written to the suppressed log instead of being pushed.
+    site: name of the ERPNext site to push to (see erpnext_sites), None for
+    ERPNEXT_URL.
+    """
+    scheduler = new_push_scheduler(device, device_attendance_logs, suppressed, site)
+    scheduler.run()
+    if scheduler.halted is not None:
+        raise Exception("API Call to ERPNext Failed.")
 
-    for device_attendance_log in device_attendance_logs[index_of_last + 1 :]:
-        punch_direction = device["punch_direction"]
-        if punch_direction == "AUTO":
-            if device_attendance_log["punch"] in device_punch_values_OUT:
-                punch_direction = "OUT"
-            elif device_attendance_log["punch"] in device_punch_values_IN:
-                punch_direction = "IN"
-            else:
-                punch_direction = None
-        erpnext_status_code, erpnext_message = send_to_erpnext(
+
+def new_push_scheduler(
+    device, device_attendance_logs, suppressed=None, site=None, send=None
+):
+    """PushScheduler over the pending attendance logs of a device. Punches
+    newer than PUSH_LIVE_HORIZON_MINUTES go into the live lane. Progress is
+    saved as the device's push watermark in status.
+
+    send: replaces send_to_erpnext; when it is a coroutine function the
+    scheduler is to be run with arun() (see async_engine).
+    """
+    import erpnext_sites
+    import freshness
+    from push_scheduler import PushScheduler
+
+    device_id = device["device_id"]
+    push_key = erpnext_sites.push_key(device_id, site)
+    lags = freshness.LagSketch()
+    attendance_success_logger, attendance_failed_logger = get_attendance_loggers(
+        device_id, site
+    )
+    done = []
+    if suppressed:
+        suppressed_logger = get_suppressed_logger(device_id, site)
+        for index, device_attendance_log in enumerate(device_attendance_logs):
+            kept = suppressed.get(id(device_attendance_log))
+            if kept is not None:
+                suppressed_logger.info(
+                    format_attendance_log_line(
+                        kept["device_id"]
+                        + ":"
+                        + str(kept["log"]["timestamp"].timestamp()),
+                        device_attendance_log,
+                    )
+                )
+                done.append(index)
+
+    send = send or send_to_erpnext
+
+    def send_args(device_attendance_log):
+        return (
             device_attendance_log["user_id"],
             device_attendance_log["timestamp"],
-            device["device_id"],
-            punch_direction,
+            device_id,
+            get_punch_direction(device, device_attendance_log),
+            site,
+        )
+
+    def push(device_attendance_log):
+        return pushed(device_attendance_log, *send(*send_args(device_attendance_log)))
+
+    async def push_async(device_attendance_log):
+        return pushed(
+            device_attendance_log, *await send(*send_args(device_attendance_log))
         )
+
+    def pushed(device_attendance_log, erpnext_status_code, erpnext_message):
         if erpnext_status_code == 200:
+            lags.add(time.time() - device_attendance_log["timestamp"].timestamp())
             attendance_success_logger.info(
-                "\t".join(
-                    [
-                        erpnext_message,
-                        str(device_attendance_log["uid"]),
-                        str(device_attendance_log["user_id"]),
-                        str(device_attendance_log["timestamp"].timestamp()),
-                        str(device_attendance_log["punch"]),
-                        str(device_attendance_log["status"]),
-                        json.dumps(device_attendance_log, default=str),
-                    ]
-                )
+                format_attendance_log_line(erpnext_message, device_attendance_log)
             )
+            return True
+        attendance_failed_logger.error(
+            format_attendance_log_line(erpnext_status_code, device_attendance_log)
+        )
+        return is_allowlisted_error(erpnext_message)
+
+    horizon = datetime.datetime.now() - datetime.timedelta(
+        minutes=getattr(config, "PUSH_LIVE_HORIZON_MINUTES", 120)
+    )
+    previous = status.get(f"{push_key}_push_watermark")
+    if not previous:
+        # first run with a watermark: start from the last line of the logs
+        previous = {"user_id": None, "timestamp": None}
+        last_line = get_last_pushed_line(device_id, site)
+        if last_line:
+            user_id, timestamp = last_line.split("\t")[4:6]
+            previous = {"user_id": user_id, "timestamp": float(timestamp)}
+
+    def checkpoint(scheduler):
+        save_watermark(scheduler)
+        unacknowledged = scheduler.unacknowledged()
+        freshness.record(
+            push_key,
+            lags.drain(),
+            min((x["timestamp"] for x in unacknowledged), default=None),
+        )
+
+    def save_watermark(scheduler):
+        watermark = scheduler.watermark_item()
+        if watermark is None:
+            watermark_key = (previous.get("user_id"), previous.get("timestamp"))
         else:
-            attendance_failed_logger.error(
-                "\t".join(
-                    [
-                        str(erpnext_status_code),
-                        str(device_attendance_log["uid"]),
-                        str(device_attendance_log["user_id"]),
-                        str(device_attendance_log["timestamp"].timestamp()),
-                        str(device_attendance_log["punch"]),
-                        str(device_attendance_log["status"]),
-                        json.dumps(device_attendance_log, default=str),
-                    ]
-                )
+            watermark_key = (
+                str(watermark["user_id"]),
+                watermark["timestamp"].timestamp(),
+            )
+        if watermark_key[1] is None and not scheduler.acked_ahead():
+            return
+        # acks of earlier cycles that are still ahead of the watermark
+        acked_ahead = [
+            key
+            for key in previous.get("acked_ahead", [])
+            if watermark_key[1] is None or key[1] > watermark_key[1]
+        ]
+        acked_ahead += [
+            [str(x["user_id"]), x["timestamp"].timestamp()]
+            for x in scheduler.acked_ahead()
+        ]
+        if scheduler.watermark == len(scheduler.items) - 1:
+            # every pending punch is pushed, the last one acked ahead
+            # becomes the watermark
+            for key in acked_ahead:
+                if watermark_key[1] is None or key[1] > watermark_key[1]:
+                    watermark_key = tuple(key)
+            acked_ahead = []
+        status.set(
+            f"{push_key}_push_watermark",
+            {
+                "user_id": watermark_key[0],
+                "timestamp": watermark_key[1],
+                "acked_ahead": acked_ahead,
+            },
+        )
+
+    return PushScheduler(
+        device_attendance_logs,
+        push_async if inspect.iscoroutinefunction(send) else push,
+        lambda device_attendance_log: device_attendance_log["timestamp"] >= horizon,
+        # one punch at a time, as before, unless PUSH_MAX_CONCURRENCY is set
+        concurrency=getattr(config, "PUSH_MAX_CONCURRENCY", 1),
+        backlog_share=getattr(config, "PUSH_BACKLOG_SHARE", 0.25),
+        on_checkpoint=checkpoint,
+        acknowledged=done,
+    )
+
+
+def collapse_punches(pending, window_seconds):
+    """Finds repeated punches of the same user across all devices.
+
+    pending: [(device, attendance logs)] of one cycle.
+    Punches of a user are grouped into windows of window_seconds starting at
+    the first punch of each window. Per window the first IN, the last OUT
+    and the first punch without a direction are kept; every other punch is
+    suppressed. Returns {id(suppressed log): {"device_id", "log"} of the
+    punch kept in its place}; empty if window_seconds is not set.
+    """
+    suppressed = {}
+    if not window_seconds:
+        return suppressed
+    window = datetime.timedelta(seconds=window_seconds)
+    by_user = {}
+    for device, logs in pending:
+        for log in logs:
+            by_user.setdefault(str(log["user_id"]), []).append(
+                (log["timestamp"], get_punch_direction(device, log), device, log)
             )
-            if not (any(error in erpnext_message for error in allowlisted_errors)):
-                raise Exception("API Call to ERPNext Failed.")
+    for punches in by_user.values():
+        punches.sort(key=lambda punch: punch[0])
+        start = 0
+        while start < len(punches):
+            end = start + 1
+            while end < len(punches) and punches[end][0] - punches[start][0] <= window:
+                end += 1
+            kept = {}
+            for punch in punches[start:end]:
+                direction = punch[1]
+                if direction == "OUT" or direction not in kept:
+                    kept[direction] = punch
+            for timestamp, direction, device, log in punches[start:end]:
+                keeper = kept[direction]
+                if keeper[3] is not log:
+                    suppressed[id(log)] = {
+                        "device_id": keeper[2]["device_id"],
+                        "log": keeper[3],
+                    }
+            start = end
+    if suppressed:
+        info_logger.info(
+            "\t".join(["Punches suppressed by de-bouncing:", str(len(suppressed))])
+        )
+    return suppressed
+
+
+def get_attendance_loggers(device_id, site=None):
+    """Returns the (success, failed) attendance loggers of a device."""
+    return tuple(
+        _attendance_logger(prefix, device_id, site)
+        for prefix in ("attendance_success_log", "attendance_failed_log")
+    )
+
+
+def get_suppressed_logger(device_id, site=None):
+    return _attendance_logger("attendance_suppressed_log", device_id, site)
+
+
+def _attendance_logger(prefix, device_id, site=None):
+    log_file = "_".join([prefix, device_id])
+    return setup_logger(
+        log_file if site is None else "/".join([site, log_file]),
+        "/".join([_logs_directory(site), log_file]) + ".log",
+    )
+
+
+def format_attendance_log_line(first_column, device_attendance_log):
+    """TSV line of the attendance logs. The first column is the ERPNext
+    Employee Checkin name on success or the HTTP status code on failure,
+    the last column is the full record as JSON.
+    """
+    return "\t".join(
+        [
+            str(first_column),
+            str(device_attendance_log["uid"]),
+            str(device_attendance_log["user_id"]),
+            str(device_attendance_log["timestamp"].timestamp()),
+            str(device_attendance_log["punch"]),
+            str(device_attendance_log["status"]),
+            json.dumps(device_attendance_log, default=str),
+        ]
+    )
+
+
+def get_punch_direction(device, device_attendance_log):
+    """Resolves the log_type sent to ERPNext for a punch, using the device's
+    punch_direction and the device_punch_values_IN/OUT config for 'AUTO'.
+    """
+    punch_direction = device["punch_direction"]
+    if punch_direction == "AUTO":
+        if device_attendance_log["punch"] in getattr(
+            config, "device_punch_values_OUT", [1, 5]
+        ):
+            punch_direction = "OUT"
+        elif device_attendance_log["punch"] in getattr(
+            config, "device_punch_values_IN", [0, 4]
+        ):
+            punch_direction = "IN"
+        else:
+            punch_direction = None
+    return punch_direction
 
 
 def get_all_attendance_from_device(
     ip, port=4370, timeout=30, device_id=None, clear_from_device_on_fetch=False
 ):
     #  Sample Attendance Logs [{'punch': 255, 'user_id': '22', 'uid': 12349, 'status': 1, 'timestamp': datetime.datetime(2019, 2, 26, 20, 31, 29)},{'punch': 255, 'user_id': '7', 'uid': 7, 'status': 1, 'timestamp': datetime.datetime(2019, 2, 26, 20, 31, 36)}]
-    zk = ZK(ip, port=port, timeout=timeout)
-    conn = None
     attendances = []
     try:
-        conn = zk.connect()
-        x = conn.disable_device()
-        # device is disabled when fetching data
-        info_logger.info("\t".join((ip, "Device Disable Attempted. Result:", str(x))))
-        attendances = conn.get_attendance()
-        info_logger.info("\t".join((ip, "Attendances Fetched:", str(len(attendances)))))
-        status.set(f"{device_id}_push_timestamp", None)
-        status.set(f"{device_id}_pull_timestamp", str(datetime.datetime.now()))
-        if len(attendances):
-            # keeping a backup before clearing data incase the programs fails.
-            # if everything goes well then this file is removed automatically at the end.
-            dump_file_name = get_dump_file_name_and_directory(device_id, ip)
-            with open(dump_file_name, "w+") as f:
-                f.write(
-                    json.dumps(
-                        list(map(lambda x: x.__dict__, attendances)),
-                        default=datetime.datetime.timestamp,
-                    )
-                )
-            if clear_from_device_on_fetch:
+        with device_connection(ip, port, timeout) as conn:
+            started = time.monotonic()
+            x = conn.disable_device()
+            # device is disabled when fetching data
+            info_logger.info(
+                "\t".join((ip, "Device Disable Attempted. Result:", str(x)))
+            )
+            attendances = save_attendance_records(
+                iter_attendance_records(conn), device_id, ip
+            )
+            if len(attendances) and clear_from_device_on_fetch:
                 x = conn.clear_attendance()
                 info_logger.info(
                     "\t".join((ip, "Attendance Clear Attempted. Result:", str(x)))
                 )
-        x = conn.enable_device()
-        info_logger.info("\t".join((ip, "Device Enable Attempted. Result:", str(x))))
+            x = conn.enable_device()
+            seconds = time.monotonic() - started
+            info_logger.info(
+                "\t".join((ip, "Device Enable Attempted. Result:", str(x)))
+            )
+        finish_fetch(device_id, attendances, seconds)
     except:
         error_logger.exception(str(ip) + " exception when fetching from device...")
         raise Exception("Device fetch failed.")
+    return attendances
+
+
+@contextlib.contextmanager
+def device_connection(ip, port=4370, timeout=30):
+    """pyzk connection to a device, disconnected on exit."""
+    conn = None
+    try:
+        conn = pyzk.ZK(ip, port=port, timeout=timeout).connect()
+        yield conn
     finally:
         if conn:
             conn.disconnect()
-    return list(map(lambda x: x.__dict__, attendances))
 
 
-def send_to_erpnext(employee_field_value, timestamp, device_id=None, log_type=None):
+def save_attendance_records(records, device_id, ip):
+    """Writes the records fetched from a device to its dump file and returns
+    them as a list.
+    """
+    attendances = []
+    first = next(records, None)
+    if first is not None:
+        # keeping a backup before clearing data incase the programs fails.
+        # if everything goes well then this file is removed automatically at the end.
+        # records are written to it as they are decoded, under a temporary
+        # name so that an interrupted fetch never leaves a partial dump.
+        dump_file_name = get_dump_file_name_and_directory(device_id, ip)
+        with open(dump_file_name + ".part", "w+") as f:
+            f.write("[")
+            for record in _chain_first(first, records):
+                if attendances:
+                    f.write(", ")
+                f.write(json.dumps(record, default=datetime.datetime.timestamp))
+                attendances.append(record)
+            f.write("]")
+        os.replace(dump_file_name + ".part", dump_file_name)
+    info_logger.info("\t".join((ip, "Attendances Fetched:", str(len(attendances)))))
+    status.set(f"{device_id}_push_timestamp", None)
+    status.set(f"{device_id}_pull_timestamp", str(datetime.datetime.now()))
+    return attendances
+
+
+def finish_fetch(device_id, attendances, seconds):
+    """Archives the punches of a fetch that held the device disabled for
+    seconds, and records its statistics (see device_trim). Called once the
+    device is enabled again: the dump file already protects the punches.
+    """
+    archived = bool(attendances) and archive_punches(device_id, attendances)
+    import device_trim
+
+    device_trim.record_fetch(device_id, len(attendances), seconds, archived)
+
+
+def punch_archive_directory():
+    """Directory of the local punch archive, None if it is disabled."""
+    return getattr(
+        config, "PUNCH_ARCHIVE_DIRECTORY", os.path.join(config.LOGS_DIRECTORY, "archive")
+    )
+
+
+def archive_punches(device_id, device_attendance_logs):
+    """Adds fetched punches to the punch archive. A failure is only logged:
+    the dump file still protects the punches until they are pushed. Returns
+    True if they are all in the archive.
+    """
+    directory = punch_archive_directory()
+    if not directory:
+        return False
+    try:
+        import punch_archive
+
+        added = punch_archive.append_attendance_logs(
+            directory, device_id, device_attendance_logs
+        )
+        info_logger.info("\t".join((device_id, "Punches Archived:", str(added))))
+        return True
+    except Exception:
+        error_logger.exception(str(device_id) + " exception when archiving punches...")
+        return False
+
+
+def _chain_first(first, rest):
+    yield first
+    yield from rest
+
+
+# Attendance record layouts of the ZK protocol, by record size. The
+# timestamp is read as a little-endian uint32 (see decode_device_time).
+_ATTENDANCE_RECORD_FORMATS = {
+    # uid, status, timestamp, punch
+    8: struct.Struct("<HBIB"),
+    # user_id, timestamp, status, punch, reserved, workcode
+    16: struct.Struct("<IIBB2sI"),
+    # uid, user_id, status, timestamp, punch, space
+    40: struct.Struct("<H24sBIB8s"),
+}
+ATTENDANCE_DECODE_CHUNK = 4096  # records per struct.iter_unpack call
+_CMD_ATTLOG_RRQ = 13  # zk.const.CMD_ATTLOG_RRQ
+
+
+def decode_device_time(t):
+    """Decodes a device timestamp (zkemsdk.c DecodeTime, as pyzk does)."""
+    second = t % 60
+    t //= 60
+    minute = t % 60
+    t //= 60
+    hour = t % 24
+    t //= 24
+    day = t % 31 + 1
+    t //= 31
+    month = t % 12 + 1
+    year = t // 12 + 2000
+    return datetime.datetime(year, month, day, hour, minute, second)
+
+
+def iter_attendance_records(conn):
+    """Yields the attendance records of a connected device as dicts with
+    the keys of pyzk's Attendance (uid, user_id, timestamp, status, punch).
+
+    Same result as conn.get_attendance(), but the downloaded buffer is
+    decoded ATTENDANCE_DECODE_CHUNK records at a time with
+    struct.iter_unpack over a memoryview, users are looked up in a dict
+    instead of a scan per record, and no Attendance objects are created.
+    """
+    conn.read_sizes()
+    if conn.records == 0:
+        return
+    users = conn.get_users()
+    attendance_data, size = conn.read_with_buffer(_CMD_ATTLOG_RRQ)
+    if size < 4:
+        return
+    total_size = struct.unpack("I", attendance_data[:4])[0]
+    record_size = total_size / conn.records
+    if record_size not in (8, 16):
+        record_size = 40
+    record_format = _ATTENDANCE_RECORD_FORMATS[record_size]
+    record_size = record_format.size
+    data = memoryview(attendance_data)[4:]
+    end = len(data) - len(data) % record_size
+    chunk_bytes = ATTENDANCE_DECODE_CHUNK * record_size
+    if record_size == 8:
+        user_id_by_uid = {user.uid: user.user_id for user in users}
+    elif record_size == 16:
+        uid_by_user_id = {}
+        for user in users:
+            # the first user wins, like pyzk's filter()[0]
+            uid_by_user_id.setdefault(user.user_id, user.uid)
+    decode_time = decode_device_time
+    for start in range(0, end, chunk_bytes):
+        chunk = data[start : min(end, start + chunk_bytes)]
+        if record_size == 8:
+            for uid, status, timestamp, punch in record_format.iter_unpack(chunk):
+                yield {
+                    "uid": uid,
+                    "user_id": user_id_by_uid.get(uid, str(uid)),
+                    "timestamp": decode_time(timestamp),
+                    "status": status,
+                    "punch": punch,
+                }
+        elif record_size == 16:
+            for user_id, timestamp, status, punch, _, _ in record_format.iter_unpack(
+                chunk
+            ):
+                user_id = str(user_id)
+                yield {
+                    "uid": uid_by_user_id.get(user_id, user_id),
+                    "user_id": user_id,
+                    "timestamp": decode_time(timestamp),
+                    "status": status,
+                    "punch": punch,
+                }
+        else:
+            for uid, user_id, status, timestamp, punch, _ in record_format.iter_unpack(
+                chunk
+            ):
+                yield {
+                    "uid": uid,
+                    "user_id": user_id.split(b"\x00")[0].decode(errors="ignore"),
+                    "timestamp": decode_time(timestamp),
+                    "status": status,
+                    "punch": punch,
+                }
+
+
+def send_to_erpnext(
+    employee_field_value, timestamp, device_id=None, log_type=None, site=None
+):
     """
     Example: send_to_erpnext('12349',datetime.datetime.now(),'HO1','IN')
+
+    site: name of a site in ERPNEXT_SITES; None for ERPNEXT_URL.
     """
-    endpoint_app = "hrms" if ERPNEXT_VERSION > 13 else "erpnext"
+    url, headers, data, limiter, session = checkin_request(
+        employee_field_value, timestamp, device_id, log_type, site
+    )
+    response = _limited_request(
+        "POST", url, limiter=limiter, session=session, headers=headers, data=data
+    )
+    return checkin_result(
+        response, employee_field_value, timestamp, device_id, log_type
+    )
 
-    print("ERP Version", ERPNEXT_VERSION)
 
-    print("endpoint_app", endpoint_app)
+def checkin_request(employee_field_value, timestamp, device_id, log_type, site):
+    """(url, headers, data, limiter, session) of the Employee Checkin request
+    of a punch. limiter and session are None for ERPNEXT_URL.
+    """
+    limiter = session = None
+    erpnext_url = config.ERPNEXT_URL
+    api_key, api_secret = config.ERPNEXT_API_KEY, config.ERPNEXT_API_SECRET
+    erpnext_version = getattr(config, "ERPNEXT_VERSION", 15)
+    if site is not None:
+        import erpnext_sites
+
+        site = erpnext_sites.get(site)
+        limiter, session = site.limiter, site.session
+        erpnext_url, erpnext_version = site.url, site.version
+        api_key, api_secret = site.api_key, site.api_secret
+    endpoint_app = "hrms" if erpnext_version > 13 else "erpnext"
 
     # url = f"{config.ERPNEXT_URL_15}/api/method/{endpoint_app}.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field"
-    url = f"{config.ERPNEXT_URL}/api/method/{endpoint_app}.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field"
+    url = f"{erpnext_url}/api/method/{endpoint_app}.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field"
     # /api/method/erpnext.hr.doctype.employee_checkin.employee_checkin.add_log_based_on_employee_field
 
-    # print("send_to_url", url)
-    print("send_to_url", url)
-
     headers = {
-        "Authorization": "token "
-        + config.ERPNEXT_API_KEY
-        + ":"
-        + config.ERPNEXT_API_SECRET,
+        "Authorization": "token " + api_key + ":" + api_secret,
         "Accept": "application/json",
     }
 
-    print("send_to_erpnext_headers", headers)
-
     data = {
         "employee_field_value": employee_field_value,
         "timestamp": timestamp.__str__(),
@@ -337,19 +1094,14 @@ def send_to_erpnext(employee_field_value, timestamp, device_id=None, log_type=No
         "log_type": log_type,
     }
 
-    # data_attr = vars(data)
+    return url, headers, data, limiter, session
 
-    print("Employee ID", type(data))
-    print("Employee ID", data["employee_field_value"])
-
-    emp_id = data["employee_field_value"]
-
-    response = requests.request("POST", url, headers=headers, data=data)
 
+def checkin_result(response, employee_field_value, timestamp, device_id, log_type):
+    """(status code, Employee Checkin name or error) of a checkin response."""
     # print("POST Response", response.status_code)
 
     if response.status_code == 200:
-        print("emp_id", emp_id)
         return 200, json.loads(response._content)["message"]["name"]
     else:
         error_str = _safe_get_error_str(response)
@@ -383,6 +1135,30 @@ def send_to_erpnext(employee_field_value, timestamp, device_id=None, log_type=No
         return response.status_code, error_str
 
 
+def _limited_request(method, url, limiter=None, session=None, **kwargs):
+    """http_session.request() through the adaptive push_limiter (or those
+    of a site). Throttled responses (429/503) are retried after their
+    Retry-After, up to PUSH_MAX_RETRIES times.
+    """
+    limiter = limiter or push_limiter
+    session = session or http_session
+    retries = getattr(config, "PUSH_MAX_RETRIES", 3)
+    while True:
+        started_at = limiter.acquire()
+        response = None
+        try:
+            response = session.request(method, url, **kwargs)
+        finally:
+            limiter.release(
+                started_at,
+                response.status_code if response is not None else None,
+                response.headers.get("Retry-After") if response is not None else None,
+            )
+        if response.status_code not in (429, 503) or retries <= 0:
+            return response
+        retries -= 1
+
+
 def update_shift_last_sync_timestamp(shift_type_device_mapping):
     """
     ### algo for updating the sync_current_timestamp
@@ -392,6 +1168,14 @@ def update_shift_last_sync_timestamp(shift_type_device_mapping):
             - then update this min of pull timestamp to the shift
 
     """
+    import erpnext_sites
+
+    site_names = erpnext_sites.site_names()
+    shift_types = {}
+    if _shift_aware_scheduling():
+        import shift_schedule
+
+        shift_types = shift_schedule.load_shift_types()
     for shift_type_device_map in shift_type_device_mapping:
         all_devices_pushed = True
         pull_timestamp_array = []
@@ -412,50 +1196,67 @@ def update_shift_last_sync_timestamp(shift_type_device_mapping):
                 shift_type_device_map["shift_type_name"] = [
                     shift_type_device_map["shift_type_name"]
                 ]
+            # the devices were pushed to every site (see finish_cycle): the
+            # Shift Types of each site are synced, with their own timestamps
+            sites = shift_type_device_map.get("sites") or site_names or [None]
             for shift in shift_type_device_map["shift_type_name"]:
-                try:
-                    sync_current_timestamp = _safe_convert_date(
-                        status.get(f"{shift}_sync_timestamp"), "%Y-%m-%d %H:%M:%S.%f"
-                    )
-                    if (
-                        sync_current_timestamp
-                        and min_pull_timestamp > sync_current_timestamp
-                    ) or (min_pull_timestamp and not sync_current_timestamp):
-                        response_code = send_shift_sync_to_erpnext(
-                            shift, min_pull_timestamp
+                for site in sites:
+                    sync_key = shift if site is None else site + ":" + shift
+                    try:
+                        sync_current_timestamp = _safe_convert_date(
+                            status.get(f"{sync_key}_sync_timestamp"),
+                            "%Y-%m-%d %H:%M:%S.%f",
                         )
-                        if response_code == 200:
-                            status.set(
-                                f"{shift}_sync_timestamp", str(min_pull_timestamp)
+                        if shift in shift_types and not shift_schedule.sync_due(
+                            shift_types[shift],
+                            sync_current_timestamp,
+                            min_pull_timestamp,
+                        ):
+                            # planned: only once the pulls are past the shift close
+                            continue
+                        if (
+                            sync_current_timestamp
+                            and min_pull_timestamp > sync_current_timestamp
+                        ) or (min_pull_timestamp and not sync_current_timestamp):
+                            response_code = send_shift_sync_to_erpnext(
+                                shift, min_pull_timestamp, site
                             )
-                except:
-                    error_logger.exception(
-                        "Exception in update_shift_last_sync_timestamp, for shift:"
-                        + shift
-                    )
+                            if response_code == 200:
+                                status.set(
+                                    f"{sync_key}_sync_timestamp",
+                                    str(min_pull_timestamp),
+                                )
+                    except:
+                        error_logger.exception(
+                            "Exception in update_shift_last_sync_timestamp, for shift:"
+                            + sync_key
+                        )
 
 
-def send_shift_sync_to_erpnext(shift_type_name, sync_timestamp):
-    url = config.ERPNEXT_URL_15_erp + "/api/resource/Shift Type/" + shift_type_name
+def send_shift_sync_to_erpnext(shift_type_name, sync_timestamp, site=None):
+    """PUTs last_sync_of_checkin of a Shift Type, on site (see erpnext_sites)
+    or ERPNEXT_URL_15_erp.
+    """
+    session = http_session
+    if site is None:
+        base_url = config.ERPNEXT_URL_15_erp
+        api_key, api_secret = config.ERPNEXT_API_KEY, config.ERPNEXT_API_SECRET
+    else:
+        import erpnext_sites
+
+        site = erpnext_sites.get(site)
+        base_url, api_key, api_secret = site.url, site.api_key, site.api_secret
+        session = site.session
+    url = base_url + "/api/resource/Shift Type/" + shift_type_name
     headers = {
-        "Authorization": "token "
-        + config.ERPNEXT_API_KEY
-        + ":"
-        + config.ERPNEXT_API_SECRET,
+        "Authorization": "token " + api_key + ":" + api_secret,
         "Accept": "application/json",
     }
 
-    print("shift_type_name", shift_type_name)
-    print("send_shift_url", url)
-    print("send_shift_sync_to_erpnext_headers", headers)
-
     data = {"last_sync_of_checkin": str(sync_timestamp)}
 
-    print("Data last_sync_of_checkin", data)
     try:
-        response = requests.request("PUT", url, headers=headers, data=json.dumps(data))
-
-        print("PUT response", response.status_code)
+        response = session.request("PUT", url, headers=headers, data=json.dumps(data))
 
         if response.status_code == 200:
             info_logger.info(
@@ -562,14 +1363,113 @@ def _safe_get_error_str(res):
     return error_str
 
 
-# setup logger and status
-if not os.path.exists(config.LOGS_DIRECTORY):
-    os.makedirs(config.LOGS_DIRECTORY)
-error_logger = setup_logger(
-    "error_logger", "/".join([config.LOGS_DIRECTORY, "error.log"]), logging.ERROR
+def _new_http_session():
+    # one keep-alive pool shared by every push, sized for concurrent pushes
+    pool_size = getattr(config, "HTTP_POOL_SIZE", 32)
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+http_session = _Lazy(_new_http_session)
+
+
+def _new_push_limiter():
+    from push_limiter import AdaptiveLimiter
+
+    latency_target_ms = getattr(config, "PUSH_LATENCY_TARGET_MS", 500)
+    return AdaptiveLimiter(
+        latency_target=latency_target_ms / 1000.0,
+        max_limit=getattr(config, "PUSH_MAX_CONCURRENCY", 16),
+        max_rps=getattr(config, "PUSH_MAX_RPS", None),
+    )
+
+
+push_limiter = _Lazy(_new_push_limiter)
+
+
+def record_push_limiter_metrics():
+    """Exposes the push limiter state in status.json (erpnext_push_limiter)
+    and logs.log, to tune PUSH_LATENCY_TARGET_MS per site.
+    """
+    import erpnext_sites
+
+    limiters = [(None, push_limiter._value)] + [
+        (site, erpnext_sites.get(site).limiter) for site in erpnext_sites.site_names()
+    ]
+    for site, limiter in limiters:
+        if limiter is None:
+            continue
+        snapshot = limiter.snapshot()
+        if site is None:
+            status.set("erpnext_push_limiter", snapshot)
+            info_logger.info(
+                "\t".join(["ERPNext push limiter:", json.dumps(snapshot)])
+            )
+        else:
+            status.set(f"erpnext_push_limiter_{site}", snapshot)
+            info_logger.info(
+                "\t".join(["ERPNext push limiter:", site, json.dumps(snapshot)])
+            )
+
+
+def record_freshness_metrics(fetched=(), up_to_date=(), fetch_failed=()):
+    """Updates the freshness of the devices of the cycle (see
+    freshness.record_cycle) and logs the punch freshness of every device to
+    logs.log.
+    """
+    import freshness
+
+    freshness.record_cycle(fetched, up_to_date, fetch_failed)
+    freshness.log_cycle(freshness.push_keys())
+
+
+def _logs_directory(site=None):
+    """LOGS_DIRECTORY, or its subdirectory for the logs of a site."""
+    directory = config.LOGS_DIRECTORY
+    if site is not None:
+        directory = os.path.join(directory, site)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+# setup logger and status (deferred until first use)
+error_logger = _Lazy(
+    lambda: setup_logger(
+        "error_logger", "/".join([_logs_directory(), "error.log"]), logging.ERROR
+    )
+)
+info_logger = _Lazy(
+    lambda: setup_logger("info_logger", "/".join([_logs_directory(), "logs.log"]))
 )
-info_logger = setup_logger("info_logger", "/".join([config.LOGS_DIRECTORY, "logs.log"]))
-status = pickledb.load("/".join([config.LOGS_DIRECTORY, "status.json"]), True)
+status = _Lazy(
+    lambda: _SerializedStatus(
+        pickledb.load("/".join([_logs_directory(), "status.json"]), True)
+    )
+)
+
+
+class _SerializedStatus:
+    """status.json with its writes serialized. pickledb rewrites the whole
+    file on every set() from a thread it keeps in a shared attribute, so
+    concurrent sets (parallel sites, the asyncio engine's executors) race.
+    """
+
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.Lock()
+
+    def set(self, key, value):
+        with self._lock:
+            return self._db.set(key, value)
+
+    def __getattr__(self, attr):
+        return getattr(self._db, attr)
 
 
 def infinite_loop(sleep_time=15):
@@ -577,12 +1477,94 @@ def infinite_loop(sleep_time=15):
     while True:
         try:
             main()
-            time.sleep(sleep_time)
+            try:
+                wait = (next_cycle_time() - datetime.datetime.now()).total_seconds()
+            except:
+                error_logger.exception("exception when planning the next cycle")
+                wait = 0
+            # sleep_time is the shortest wait between two checks
+            time.sleep(max(sleep_time, wait))
         except BaseException as e:
             print(e)
             print("infinite_loop function", "infinite_loop")
 
 
+def _cmd_run(args):
+    infinite_loop(args.sleep)
+
+
+def _cmd_once(args):
+    main(force=args.force)
+    info_logger.info(
+        "\t".join(
+            [
+                "One-shot cycle finished.",
+                "startup_ms:",
+                "%.1f" % (args.startup_seconds * 1000),
+                "total_ms:",
+                "%.1f" % ((time.perf_counter() - _STARTED_AT) * 1000),
+            ]
+        )
+    )
+
+
+# subcommands implemented in their own modules, imported only when chosen.
+# each module provides add_arguments(parser) and run(args).
+_COMMAND_MODULES = {
+    "backfill": "push historical punches from exported files",
+    "replay": "resubmit records from the failed attendance logs",
+    "report": "count pushed and failed punches from the attendance logs",
+    "reconcile": "compare local punches with ERPNext Employee Checkin",
+    "freshness": "show how long punches take to reach ERPNext",
+    "user-sync": "add, update and remove device users to match ERPNext employees",
+}
+
+
+def build_arg_parser(command=None):
+    parser = argparse.ArgumentParser(
+        prog="erpnext_sync.py",
+        description="Pull punches from biometric devices and push them to ERPNext.",
+    )
+    subparsers = parser.add_subparsers(dest="command")
+
+    run_parser = subparsers.add_parser(
+        "run", help="pull and push every PULL_FREQUENCY minutes (default)"
+    )
+    run_parser.add_argument(
+        "--sleep", type=int, default=15, help="seconds between checks"
+    )
+    run_parser.set_defaults(handler=_cmd_run)
+
+    once_parser = subparsers.add_parser(
+        "once", help="run a single sync cycle and exit (for cron)"
+    )
+    once_parser.add_argument(
+        "--force", action="store_true", help="ignore PULL_FREQUENCY"
+    )
+    once_parser.set_defaults(handler=_cmd_once)
+
+    for name, help_text in _COMMAND_MODULES.items():
+        command_parser = subparsers.add_parser(name, help=help_text)
+        if name == command:
+            module = importlib.import_module(name.replace("-", "_"))
+            module.add_arguments(command_parser)
+            command_parser.set_defaults(handler=module.run)
+    return parser
+
+
+def cli(argv=None):
+    """Entry point. Each subcommand only loads what it needs."""
+    if argv is None:
+        argv = sys.argv[1:]
+    command = next((arg for arg in argv if not arg.startswith("-")), None)
+    parser = build_arg_parser(command)
+    args = parser.parse_args(argv)
+    if args.command is None:
+        args = parser.parse_args(["run"])
+    args.startup_seconds = time.perf_counter() - _STARTED_AT
+    return args.handler(args)
+
+
 if __name__ == "__main__":
     # Adding by Manot L.
 
@@ -604,4 +1586,8 @@ if __name__ == "__main__":
     # Finished Adding by Manot L.
 
     # below is original code
-    infinite_loop()
\ No newline at end of file
+    # run through the importable module so that subcommand modules doing
+    # "import erpnext_sync" share its config, loggers and status
+    import erpnext_sync
+
+    sys.exit(erpnext_sync.cli())
\ No newline at end of file
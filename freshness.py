@@ -0,0 +1,302 @@
+# Punch freshness: how long after the punch ERPNext acknowledged it.
+#
+# Every punch pushed with HTTP 200 gives a lag sample, acknowledgment time
+# minus the punch time on the device. The samples of a device are kept in a
+# LagSketch, a quantile sketch with bounded memory (DDSketch: logarithmic
+# buckets, so any quantile is within RELATIVE_ACCURACY of the true value,
+# whatever the number of samples). Sketches merge by adding their buckets.
+#
+# status.json keeps, per device (<device_id>_freshness):
+#   - cycle: sketch of the last sync cycle
+#   - day: sketch of the current local day, merged cycle after cycle
+#   - oldest_unpushed: punch time of the oldest punch fetched but not yet
+#     acknowledged, None when the device is up to date
+#   - last_fetch: time of the last successful fetch from the device
+#   - stale: True when the last fetch failed. Punches made since last_fetch
+#     may be waiting on the device, unseen by oldest_unpushed
+# and each cycle logs p50/p95/max to logs.log. Pushes update oldest_unpushed
+# as they go; record_cycle() updates the rest at the end of every cycle, so
+# that a device with nothing to push, or that could not be read, does not
+# keep the value of its last push.
+#
+# Usage:
+#   python3 erpnext_sync.py freshness
+#   python3 erpnext_sync.py freshness --slo 15   # exit 1 when breached
+
+import datetime
+import json
+import math
+import threading
+import time
+
+from erpnext_sync import config, info_logger, status
+
+RELATIVE_ACCURACY = 0.01
+MAX_BUCKETS = 2048
+# lags below this many seconds count as 0
+MIN_LAG = 1.0
+
+
+class LagSketch:
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, max_buckets=MAX_BUCKETS):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self._gamma)
+        self.buckets = {}
+        self.zero = 0
+        self.count = 0
+        self.max = None
+        self._lock = threading.Lock()
+
+    def add(self, lag):
+        with self._lock:
+            self.count += 1
+            self.max = lag if self.max is None else max(self.max, lag)
+            if lag < MIN_LAG:
+                self.zero += 1
+                return
+            index = math.ceil(math.log(lag) / self._log_gamma)
+            self.buckets[index] = self.buckets.get(index, 0) + 1
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+
+    def _collapse(self):
+        # the lowest buckets are merged: the high quantiles stay accurate
+        indexes = sorted(self.buckets)
+        excess = len(indexes) - self.max_buckets
+        merged = sum(self.buckets.pop(i) for i in indexes[:excess])
+        self.buckets[indexes[excess]] += merged
+
+    def merge(self, other):
+        with self._lock:
+            self.count += other.count
+            self.zero += other.zero
+            if other.max is not None:
+                self.max = other.max if self.max is None else max(self.max, other.max)
+            for index, count in other.buckets.items():
+                self.buckets[index] = self.buckets.get(index, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self._collapse()
+
+    def drain(self):
+        """A copy of the sketch; the sketch itself starts over empty."""
+        with self._lock:
+            drained = LagSketch(self.relative_accuracy, self.max_buckets)
+            drained.buckets, self.buckets = self.buckets, {}
+            drained.zero, self.zero = self.zero, 0
+            drained.count, self.count = self.count, 0
+            drained.max, self.max = self.max, None
+        return drained
+
+    def quantile(self, q):
+        """Lag in seconds at quantile q (0-1), None without samples."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        if rank < self.zero:
+            return 0.0
+        seen = self.zero
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen > rank:
+                value = 2 * self._gamma**index / (self._gamma + 1)
+                return min(value, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "count": self.count,
+            "zero": self.zero,
+            "max": self.max,
+            "buckets": sorted(self.buckets.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data["relative_accuracy"])
+        sketch.count = data["count"]
+        sketch.zero = data["zero"]
+        sketch.max = data["max"]
+        sketch.buckets = {index: count for index, count in data["buckets"]}
+        return sketch
+
+
+def summary(sketch):
+    return {
+        "count": sketch.count,
+        "p50": sketch.quantile(0.5),
+        "p95": sketch.quantile(0.95),
+        "max": sketch.max,
+    }
+
+
+def _key(device_id):
+    return f"{device_id}_freshness"
+
+
+def record(device_id, lags, oldest_unpushed):
+    """Adds the lag samples of a device to its cycle and day sketches.
+    oldest_unpushed: datetime of the oldest punch not acknowledged yet, or
+    None.
+    """
+    saved = status.get(_key(device_id)) or {}
+    cycle_id = status.get("lift_off_timestamp")
+    day = datetime.date.today().isoformat()
+    cycle = LagSketch()
+    if saved.get("cycle", {}).get("id") == cycle_id:
+        cycle = LagSketch.from_dict(saved["cycle"]["sketch"])
+    day_sketch = LagSketch()
+    if saved.get("day", {}).get("id") == day:
+        day_sketch = LagSketch.from_dict(saved["day"]["sketch"])
+    cycle.merge(lags)
+    day_sketch.merge(lags)
+    status.set(
+        _key(device_id),
+        dict(
+            saved,
+            cycle={"id": cycle_id, "sketch": cycle.to_dict()},
+            day={"id": day, "sketch": day_sketch.to_dict()},
+            oldest_unpushed=oldest_unpushed.timestamp() if oldest_unpushed else None,
+        ),
+    )
+
+
+def record_cycle(fetched, up_to_date, fetch_failed, now=None):
+    """Updates the freshness of the devices of a cycle once it is over.
+
+    fetched: ids of the devices read in this cycle.
+    up_to_date: ids of those whose punches were all acknowledged; their
+        oldest_unpushed is cleared, even if nothing was pushed.
+    fetch_failed: ids of the devices that could not be read; they are
+        marked stale until their next successful fetch.
+    """
+    import erpnext_sites
+
+    now = now or time.time()
+    sites = erpnext_sites.site_names() or [None]
+    for device_id in set(fetched) | set(fetch_failed):
+        for site in sites:
+            key = _key(erpnext_sites.push_key(device_id, site))
+            saved = dict(status.get(key) or {})
+            if device_id in fetch_failed:
+                saved["stale"] = True
+            else:
+                saved["stale"] = False
+                saved["last_fetch"] = now
+                if device_id in up_to_date:
+                    saved["oldest_unpushed"] = None
+            status.set(key, saved)
+
+
+def device_freshness(device_id, now=None):
+    """{"cycle": summary, "day": summary, "oldest_unpushed_age": seconds or
+    None, "stale_age": seconds since the last successful fetch when the last
+    fetch failed, else None} of a device, from status.json.
+    """
+    saved = status.get(_key(device_id)) or {}
+    now = now or time.time()
+    result = {}
+    for period in ("cycle", "day"):
+        sketch = LagSketch()
+        if period in saved:
+            sketch = LagSketch.from_dict(saved[period]["sketch"])
+        result[period] = summary(sketch)
+    oldest_unpushed = saved.get("oldest_unpushed")
+    result["oldest_unpushed_age"] = (
+        max(0.0, now - oldest_unpushed) if oldest_unpushed else None
+    )
+    last_fetch = saved.get("last_fetch")
+    result["stale_age"] = (
+        max(0.0, now - last_fetch) if saved.get("stale") and last_fetch else None
+    )
+    return result
+
+
+def push_keys():
+    """Status key prefixes of every device, per site with ERPNEXT_SITES."""
+    import erpnext_sites
+
+    device_ids = [device["device_id"] for device in config.devices]
+    sites = erpnext_sites.site_names() or [None]
+    return [
+        erpnext_sites.push_key(device_id, site)
+        for site in sites
+        for device_id in device_ids
+    ]
+
+
+def log_cycle(device_ids):
+    for device_id in device_ids:
+        freshness = device_freshness(device_id)
+        info_logger.info(
+            "\t".join(
+                ["Punch freshness:", device_id, json.dumps(freshness, default=str)]
+            )
+        )
+
+
+def _minutes(seconds):
+    return "-" if seconds is None else "%.1f" % (seconds / 60)
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--device-id", action="append", help="only this device (repeatable)"
+    )
+    parser.add_argument(
+        "--slo",
+        type=float,
+        help="minutes; exit with 1 if today's p95, the oldest unpushed punch or "
+        "the last fetch of a stale device is older",
+    )
+    parser.add_argument("--json", action="store_true", help="print as JSON")
+
+
+def run(args):
+    device_ids = [
+        key
+        for key in push_keys()
+        if not args.device_id or key.rsplit(":", 1)[-1] in args.device_id
+    ]
+    result = {device_id: device_freshness(device_id) for device_id in device_ids}
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        for device_id, freshness in result.items():
+            print(
+                "{}: oldest unpushed {} min{}".format(
+                    device_id,
+                    _minutes(freshness["oldest_unpushed_age"]),
+                    (
+                        ""
+                        if freshness["stale_age"] is None
+                        else ", stale: last fetched {} min ago".format(
+                            _minutes(freshness["stale_age"])
+                        )
+                    ),
+                )
+            )
+            for period in ("cycle", "day"):
+                lags = freshness[period]
+                print(
+                    "  {:<5} {:>7} punches  p50 {:>7} min  p95 {:>7} min  "
+                    "max {:>7} min".format(
+                        period,
+                        lags["count"],
+                        _minutes(lags["p50"]),
+                        _minutes(lags["p95"]),
+                        _minutes(lags["max"]),
+                    )
+                )
+    if args.slo is not None:
+        limit = args.slo * 60
+        for device_id, freshness in result.items():
+            p95 = freshness["day"]["p95"]
+            ages = [freshness["oldest_unpushed_age"], freshness["stale_age"]]
+            if (p95 is not None and p95 > limit) or any(
+                age is not None and age > limit for age in ages
+            ):
+                return 1
+    return 0
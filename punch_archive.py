@@ -0,0 +1,355 @@
+# Local archive of every punch fetched from the devices.
+#
+# Once clear_from_device_on_fetch is on, the devices forget punches after
+# they are pushed, and the dump file is removed too. The archive keeps them,
+# so that reconcile and backfill can work without the devices.
+#
+# Layout, one partition per device and (local) day:
+#   <archive>/<device_id>/<YYYY-MM-DD>/index.json
+#   <archive>/<device_id>/<YYYY-MM-DD>/<n>.seg
+#
+# A segment holds the records of one append, sorted by (timestamp, user_id),
+# as zlib-compressed columns: timestamp (delta-encoded int64 seconds),
+# user_id, uid, punch and status. index.json lists the segments with their
+# record count and min/max timestamp and user_id, so queries by date or user
+# open only the partitions and segments that can match.
+#
+# Appends only write new segments. A device that is not cleared returns
+# its whole history on every fetch, so each device has a high-water mark,
+# <archive>/<device_id>.high_water: the (timestamp, user_id) of the last
+# punch of the previous append. When a fetch contains that punch, the
+# punches up to it are the ones the previous append archived and are
+# dropped without opening any partition. The mark is never used as a
+# cutoff: punches after it are kept even when they are older (a clock set
+# back, a device that was offline), and are checked against the partitions
+# they fall in; when every new punch of a partition is later than its max
+# timestamp the partition does not need to be read for that. A partition
+# with more than MAX_SEGMENTS segments is compacted into one.
+
+import array
+import datetime
+import json
+import os
+import struct
+import zlib
+
+MAGIC = b"PNCH"
+VERSION = 1
+MAX_SEGMENTS = 16
+INDEX_FILE = "index.json"
+SEGMENT_SUFFIX = ".seg"
+HIGH_WATER_SUFFIX = ".high_water"
+DAY_CACHE_SECONDS = 900  # local days are cached per 15 minutes, see _partition_day
+
+_HEADER = struct.Struct("<4sII")  # magic, version, record count
+_COLUMN_LENGTH = struct.Struct("<I")
+
+# record tuple, same layout as backfill: (epoch timestamp, user_id, uid, punch, status)
+_TIMESTAMP, _USER_ID, _UID, _PUNCH, _STATUS = range(5)
+
+
+def _sort_key(record):
+    return (record[_TIMESTAMP], record[_USER_ID])
+
+
+def _byte_column(values):
+    # punch and status are single bytes on the devices; 255 stands for None
+    return array.array("B", (255 if v is None else v for v in values)).tobytes()
+
+
+def _from_byte_column(data):
+    return [None if v == 255 else v for v in array.array("B", data)]
+
+
+def encode_segment(records):
+    """Bytes of a segment; records must be sorted by (timestamp, user_id)."""
+    timestamps = array.array("q")
+    previous = 0
+    for record in records:
+        timestamp = int(record[_TIMESTAMP])
+        timestamps.append(timestamp - previous)
+        previous = timestamp
+    columns = [
+        timestamps.tobytes(),
+        "\n".join(record[_USER_ID] for record in records).encode("utf-8"),
+        # uid is an int or a str depending on the device's record format
+        json.dumps([record[_UID] for record in records]).encode("utf-8"),
+        _byte_column(record[_PUNCH] for record in records),
+        _byte_column(record[_STATUS] for record in records),
+    ]
+    parts = [_HEADER.pack(MAGIC, VERSION, len(records))]
+    for column in columns:
+        compressed = zlib.compress(column, 6)
+        parts.append(_COLUMN_LENGTH.pack(len(compressed)))
+        parts.append(compressed)
+    return b"".join(parts)
+
+
+def decode_segment(data, columns=(_TIMESTAMP, _USER_ID, _UID, _PUNCH, _STATUS)):
+    """Record tuples of a segment. Columns that are not asked for are not
+    decompressed and come back as None.
+    """
+    magic, version, count = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("not a punch archive segment")
+    position = _HEADER.size
+    raw = []
+    for _ in range(5):
+        (length,) = _COLUMN_LENGTH.unpack_from(data, position)
+        position += _COLUMN_LENGTH.size
+        raw.append(data[position : position + length])
+        position += length
+    decoded = [[None] * count for _ in range(5)]
+    if _TIMESTAMP in columns:
+        timestamp = 0
+        values = decoded[_TIMESTAMP]
+        for i, delta in enumerate(array.array("q", zlib.decompress(raw[_TIMESTAMP]))):
+            timestamp += delta
+            values[i] = float(timestamp)
+    if _USER_ID in columns and count:
+        decoded[_USER_ID] = zlib.decompress(raw[_USER_ID]).decode("utf-8").split("\n")
+    if _UID in columns:
+        decoded[_UID] = json.loads(zlib.decompress(raw[_UID]))
+    if _PUNCH in columns:
+        decoded[_PUNCH] = _from_byte_column(zlib.decompress(raw[_PUNCH]))
+    if _STATUS in columns:
+        decoded[_STATUS] = _from_byte_column(zlib.decompress(raw[_STATUS]))
+    return list(zip(*decoded))
+
+
+def _read_index(partition):
+    try:
+        with open(os.path.join(partition, INDEX_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"next": 0, "count": 0, "min_ts": None, "max_ts": None, "segments": []}
+
+
+def _write_atomic(path, data):
+    with open(path + ".part", "wb") as f:
+        f.write(data)
+    os.replace(path + ".part", path)
+
+
+def _write_index(partition, index):
+    segments = index["segments"]
+    index["count"] = sum(segment["count"] for segment in segments)
+    index["min_ts"] = min((s["min_ts"] for s in segments), default=None)
+    index["max_ts"] = max((s["max_ts"] for s in segments), default=None)
+    _write_atomic(
+        os.path.join(partition, INDEX_FILE), json.dumps(index, indent=1).encode()
+    )
+
+
+def _read_segment(
+    partition, segment, columns=(_TIMESTAMP, _USER_ID, _UID, _PUNCH, _STATUS)
+):
+    with open(os.path.join(partition, segment["file"]), "rb") as f:
+        return decode_segment(f.read(), columns)
+
+
+def _add_segment(partition, index, records):
+    name = "{}{}".format(index["next"], SEGMENT_SUFFIX)
+    index["next"] += 1
+    # the segment is complete on disk before the index refers to it
+    _write_atomic(os.path.join(partition, name), encode_segment(records))
+    index["segments"].append(
+        {
+            "file": name,
+            "count": len(records),
+            "min_ts": records[0][_TIMESTAMP],
+            "max_ts": records[-1][_TIMESTAMP],
+            "min_user": min(record[_USER_ID] for record in records),
+            "max_user": max(record[_USER_ID] for record in records),
+        }
+    )
+
+
+def _partition_day(timestamp, days):
+    # cached per 15 minutes: local midnight falls on a quarter hour in every
+    # time zone (+05:30, +05:45...), but not always on a UTC hour
+    bucket = int(timestamp // DAY_CACHE_SECONDS)
+    day = days.get(bucket)
+    if day is None:
+        day = days[bucket] = datetime.datetime.fromtimestamp(timestamp).strftime(
+            "%Y-%m-%d"
+        )
+    return day
+
+
+def _read_high_water(directory, device_id):
+    try:
+        with open(os.path.join(directory, device_id + HIGH_WATER_SUFFIX)) as f:
+            mark = json.load(f)
+    except FileNotFoundError:
+        return None
+    # older archives stored a bare timestamp, which is not enough to find
+    # the end of the previous append
+    return tuple(mark) if isinstance(mark, list) else None
+
+
+def _after_high_water(records, high):
+    if high is None:
+        return records
+    for position, record in enumerate(records):
+        if (float(int(record[_TIMESTAMP])), str(record[_USER_ID])) == high:
+            return records[position + 1 :]
+    return records
+
+
+def append(directory, device_id, records):
+    """Adds record tuples of a device to the archive, skipping those that are
+    already in it. Returns the number of records added.
+    """
+    records = list(records)
+    if not records:
+        return 0
+    high = _read_high_water(directory, device_id)
+    by_day = {}
+    days = {}
+    for record in _after_high_water(records, high):
+        record = (
+            float(int(record[_TIMESTAMP])),
+            str(record[_USER_ID]),
+            record[_UID],
+            record[_PUNCH],
+            record[_STATUS],
+        )
+        by_day.setdefault(_partition_day(record[_TIMESTAMP], days), {})[
+            _sort_key(record)
+        ] = record
+    added = 0
+    for day, day_records in sorted(by_day.items()):
+        partition = os.path.join(directory, device_id, day)
+        os.makedirs(partition, exist_ok=True)
+        index = _read_index(partition)
+        new = [day_records[key] for key in sorted(day_records)]
+        if index["segments"] and new[0][_TIMESTAMP] <= index["max_ts"]:
+            existing = set()
+            for segment in index["segments"]:
+                if segment["max_ts"] >= new[0][_TIMESTAMP]:
+                    existing.update(
+                        map(
+                            _sort_key,
+                            _read_segment(partition, segment, (_TIMESTAMP, _USER_ID)),
+                        )
+                    )
+            new = [record for record in new if _sort_key(record) not in existing]
+        if not new:
+            continue
+        _add_segment(partition, index, new)
+        if len(index["segments"]) > MAX_SEGMENTS:
+            _compact(partition, index)
+        _write_index(partition, index)
+        added += len(new)
+    last = (float(int(records[-1][_TIMESTAMP])), str(records[-1][_USER_ID]))
+    if last != high:
+        # written once the partitions are, so a failed append is retried
+        os.makedirs(directory, exist_ok=True)
+        _write_atomic(
+            os.path.join(directory, device_id + HIGH_WATER_SUFFIX),
+            json.dumps(last).encode(),
+        )
+    return added
+
+
+def append_attendance_logs(directory, device_id, device_attendance_logs):
+    """append() for the attendance log dicts of get_all_attendance_from_device."""
+    return append(
+        directory,
+        device_id,
+        (
+            (
+                log["timestamp"].timestamp(),
+                log["user_id"],
+                log["uid"],
+                log["punch"],
+                log["status"],
+            )
+            for log in device_attendance_logs
+        ),
+    )
+
+
+def _compact(partition, index):
+    old = index["segments"]
+    records = []
+    for segment in old:
+        records.extend(_read_segment(partition, segment))
+    records.sort(key=_sort_key)
+    index["segments"] = []
+    _add_segment(partition, index, records)
+    # the new index is written before the old segments are removed
+    _write_index(partition, index)
+    for segment in old:
+        os.remove(os.path.join(partition, segment["file"]))
+
+
+def device_ids(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        name
+        for name in os.listdir(directory)
+        if os.path.isdir(os.path.join(directory, name))
+    )
+
+
+def partitions(directory, device_id, since=None, until=None):
+    """Partition directories of a device, oldest first, that can hold
+    punches in [since, until).
+    """
+    device_directory = os.path.join(directory, device_id)
+    if not os.path.isdir(device_directory):
+        return []
+    # partition days are local days, like the datetimes passed in
+    first = since.strftime("%Y-%m-%d") if since else None
+    last = until.strftime("%Y-%m-%d") if until else None
+    return [
+        os.path.join(device_directory, day)
+        for day in sorted(os.listdir(device_directory))
+        if (first is None or day >= first) and (last is None or day <= last)
+    ]
+
+
+def iter_records(directory, device_id, since=None, until=None, user_ids=None):
+    """Yields the archived record tuples of a device in (timestamp, user_id)
+    order, optionally limited to [since, until) (datetimes) and user_ids.
+    """
+    low = since.timestamp() if since else None
+    high = until.timestamp() if until else None
+    for partition in partitions(directory, device_id, since, until):
+        records = []
+        for segment in _read_index(partition)["segments"]:
+            if low is not None and segment["max_ts"] < low:
+                continue
+            if high is not None and segment["min_ts"] >= high:
+                continue
+            if user_ids and not any(
+                segment["min_user"] <= user_id <= segment["max_user"]
+                for user_id in user_ids
+            ):
+                continue
+            for record in _read_segment(partition, segment):
+                if low is not None and record[_TIMESTAMP] < low:
+                    continue
+                if high is not None and record[_TIMESTAMP] >= high:
+                    continue
+                if user_ids and record[_USER_ID] not in user_ids:
+                    continue
+                records.append(record)
+        records.sort(key=_sort_key)
+        yield from records
+
+
+def stats(directory, device_id):
+    """(number of punches, min timestamp, max timestamp) from the indexes."""
+    count, low, high = 0, None, None
+    for partition in partitions(directory, device_id):
+        index = _read_index(partition)
+        if not index["count"]:
+            continue
+        count += index["count"]
+        low = index["min_ts"] if low is None else min(low, index["min_ts"])
+        high = index["max_ts"] if high is None else max(high, index["max_ts"])
+    return count, low, high
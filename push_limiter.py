@@ -0,0 +1,164 @@
+# Adaptive concurrency and rate limiting for pushes to ERPNext.
+#
+# The Frappe site we push to is shared with its users, so the number of
+# requests in flight follows the site's latency (AIMD, like TCP congestion
+# control):
+#   - while the p95 latency of recent requests stays under the target, the
+#     limit grows by one per round of `limit` successful requests
+#   - on 429, 5xx, connection errors or a p95 above the target, it is cut
+#     multiplicatively (at most once per round, so one burst of errors does
+#     not collapse it to the minimum)
+#   - a Retry-After header pauses every request until it has passed
+# A hard requests-per-second ceiling can be set on top.
+
+import datetime
+import email.utils
+import threading
+import time
+from collections import deque
+
+
+def parse_retry_after(value):
+    """Seconds to wait for a Retry-After header (delay-seconds or HTTP-date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (retry_at - now).total_seconds())
+
+
+def is_overload_status(status_code):
+    return status_code is None or status_code == 429 or status_code >= 500
+
+
+class AdaptiveLimiter:
+    def __init__(
+        self,
+        latency_target=0.5,
+        initial_limit=2,
+        min_limit=1,
+        max_limit=16,
+        max_rps=None,
+        decrease_factor=0.5,
+        window=50,
+    ):
+        """
+        latency_target: p95 latency in seconds to stay under.
+        max_rps: hard ceiling of requests started per second, None for none.
+        window: number of recent latencies the p95 is computed over.
+        """
+        self.latency_target = latency_target
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_rps = max_rps
+        self.decrease_factor = decrease_factor
+        self._limit = float(max(min_limit, min(initial_limit, max_limit)))
+        self._in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._round_successes = 0
+        self._last_decrease = 0.0
+        self._paused_until = 0.0
+        self._next_start = 0.0
+        self._requests = 0
+        self._throttled = 0
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    def acquire(self):
+        """Blocks until a request may start. Returns a token for release()."""
+        with self._condition:
+            while True:
+                token, wait_for = self._try_acquire()
+                if token is not None:
+                    return token
+                self._condition.wait(wait_for)
+
+    def try_acquire(self):
+        """acquire() without blocking, for event loops: (token, 0) when a
+        request may start, else (None, seconds to wait before trying again).
+        """
+        with self._condition:
+            return self._try_acquire()
+
+    def _try_acquire(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            return None, self._paused_until - now
+        if self._in_flight >= self.limit:
+            return None, 1.0  # woken up by release()
+        if self.max_rps and now < self._next_start:
+            return None, self._next_start - now
+        self._in_flight += 1
+        self._requests += 1
+        if self.max_rps:
+            self._next_start = max(now, self._next_start) + 1.0 / self.max_rps
+        return now, 0
+
+    def release(self, started_at, status_code, retry_after=None):
+        """Records the outcome of a request started with acquire().
+
+        status_code: HTTP status, or None if the request raised.
+        retry_after: value of the Retry-After response header, if any.
+        """
+        now = time.monotonic()
+        with self._condition:
+            self._in_flight -= 1
+            delay = parse_retry_after(retry_after)
+            if delay:
+                self._paused_until = max(self._paused_until, now + delay)
+            if is_overload_status(status_code):
+                self._throttled += 1
+                self._decrease(now)
+            else:
+                self._latencies.append(now - started_at)
+                p95 = self.p95()
+                if p95 is not None and p95 > self.latency_target:
+                    self._decrease(now)
+                else:
+                    self._round_successes += 1
+                    if self._round_successes >= self.limit:
+                        self._round_successes = 0
+                        self._limit = min(self.max_limit, self._limit + 1)
+            self._condition.notify_all()
+
+    def _decrease(self, now):
+        # one cut per round trip; the requests already in flight were sent
+        # under the old limit and would otherwise cut it again
+        if now - self._last_decrease < (self.p95() or self.latency_target):
+            return
+        self._last_decrease = now
+        self._round_successes = 0
+        self._limit = max(self.min_limit, self._limit * self.decrease_factor)
+        self._latencies.clear()
+
+    def p95(self):
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def snapshot(self):
+        """Current state, to be exposed as metrics."""
+        with self._condition:
+            p95 = self.p95()
+            return {
+                "limit": self.limit,
+                "in_flight": self._in_flight,
+                "p95_ms": round(p95 * 1000, 1) if p95 is not None else None,
+                "latency_target_ms": round(self.latency_target * 1000, 1),
+                "max_rps": self.max_rps,
+                "requests": self._requests,
+                "throttled": self._throttled,
+            }
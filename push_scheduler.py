@@ -0,0 +1,241 @@
+# Two-lane scheduling of the pushes of one device.
+#
+# After an outage a device can have weeks of punches to push. Pushed oldest
+# first, they would hold back today's punches, which HR watches live. The
+# pending punches are split into two lanes:
+#   - live: punches newer than the horizon
+#   - backlog: everything older
+# While live punches are waiting they get the concurrency, except for
+# backlog_share of it that keeps the backlog draining without taking over.
+# Once the live lane is empty the backlog may use all of it.
+#
+# Punches are acknowledged out of order, so the resume point is a
+# watermark: the last punch (in device order) that is acknowledged together
+# with every punch before it. Punches acknowledged ahead of the watermark
+# are reported by acked_ahead(), so that they are skipped, not pushed again,
+# when the device is resumed from the watermark.
+#
+# run(limit, deadline) pushes until both lanes are empty, a push fails with
+# an error that is not allowlisted, or limit/deadline is reached, and can be
+# called again to continue. arun() does the same on the running event loop
+# when push is a coroutine function.
+#
+# deficit_round_robin() shares a cycle between the schedulers of several
+# devices, so that a device with weeks of backlog does not hold back the
+# others: each round, every scheduler may push its quantum (times its
+# weight) plus what it left unused of its previous quanta, and the rounds
+# go on until every scheduler is done or the deadline is reached. The
+# schedulers of a round run side by side, so a slow device only delays the
+# end of the round, not the turns of the others.
+
+import asyncio
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class PushScheduler:
+    def __init__(
+        self,
+        items,
+        push,
+        is_live,
+        concurrency=16,
+        backlog_share=0.25,
+        on_checkpoint=None,
+        checkpoint_interval=5,
+        acknowledged=(),
+    ):
+        """
+        items: the pending items, in device order.
+        push: pushes an item; returns True when it is acknowledged (pushed,
+            or failed with an allowlisted error) and False when pushing must
+            stop. An exception counts as False.
+        is_live: True for the items of the live lane.
+        acknowledged: indexes of items that are already done (e.g.
+            suppressed punches); they only move the watermark.
+        on_checkpoint: called with the scheduler every checkpoint_interval
+            seconds while running and when run() returns.
+        """
+        self.items = items
+        self.push = push
+        self.concurrency = max(1, concurrency)
+        # may be 0: the backlog then waits for the live lane to empty
+        self.backlog_slots = int(self.concurrency * backlog_share)
+        self.on_checkpoint = on_checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self._lanes = {True: deque(), False: deque()}
+        self._acked = set()
+        self.watermark = -1  # index of the last item of the acknowledged prefix
+        acknowledged = set(acknowledged)
+        for index, item in enumerate(items):
+            if index in acknowledged:
+                self._ack(index)
+            else:
+                self._lanes[bool(is_live(item))].append(index)
+        self.halted = None
+        self.pushed = 0
+        self.failed = 0
+
+    @property
+    def remaining(self):
+        return len(self._lanes[True]) + len(self._lanes[False])
+
+    @property
+    def done(self):
+        return self.halted is not None or not self.remaining
+
+    def _ack(self, index):
+        self._acked.add(index)
+        while self.watermark + 1 in self._acked:
+            self.watermark += 1
+            self._acked.discard(self.watermark)
+
+    def watermark_item(self):
+        return self.items[self.watermark] if self.watermark >= 0 else None
+
+    def acked_ahead(self):
+        """Items acknowledged after the watermark, in device order."""
+        return [self.items[index] for index in sorted(self._acked)]
+
+    def unacknowledged(self):
+        """Items not acknowledged yet, in device order."""
+        return [
+            self.items[index]
+            for index in range(self.watermark + 1, len(self.items))
+            if index not in self._acked
+        ]
+
+    def _next(self, in_flight_backlog):
+        live, backlog = self._lanes[True], self._lanes[False]
+        # the backlog keeps up to its share of the slots while live items
+        # wait, and may use every slot once the live lane is empty
+        if backlog and (not live or in_flight_backlog < self.backlog_slots):
+            return backlog.popleft(), False
+        if live:
+            return live.popleft(), True
+        return None, None
+
+    def _may_dispatch(self, in_flight, dispatched, limit, deadline):
+        return (
+            self.halted is None
+            and in_flight < self.concurrency
+            and (limit is None or dispatched < limit)
+            and (deadline is None or time.monotonic() < deadline)
+        )
+
+    def _finish(self, index, live, result):
+        """Records the outcome of a push; result() returns push()'s value."""
+        try:
+            acknowledged = result()
+        except Exception as e:
+            acknowledged = False
+            self.halted = self.halted or str(e)
+        self.pushed += 1
+        if acknowledged:
+            self._ack(index)
+        else:
+            self.failed += 1
+            self.halted = self.halted or "push failed"
+            # not pushed: it stays ahead of the watermark
+            self._lanes[live].appendleft(index)
+
+    def run(self, limit=None, deadline=None):
+        """Pushes at most limit items, dispatching none after deadline
+        (time.monotonic()). Returns the number of items pushed.
+        """
+        started_with = self.pushed
+        dispatched = 0
+        pending = {}  # future -> (index, is_live)
+        in_flight_backlog = 0
+        last_checkpoint = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                while self._may_dispatch(len(pending), dispatched, limit, deadline):
+                    index, live = self._next(in_flight_backlog)
+                    if index is None:
+                        break
+                    pending[executor.submit(self.push, self.items[index])] = (
+                        index,
+                        live,
+                    )
+                    dispatched += 1
+                    if not live:
+                        in_flight_backlog += 1
+                if not pending:
+                    break
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    index, live = pending.pop(future)
+                    if not live:
+                        in_flight_backlog -= 1
+                    self._finish(index, live, future.result)
+                if (
+                    self.on_checkpoint
+                    and time.monotonic() - last_checkpoint > self.checkpoint_interval
+                ):
+                    self.on_checkpoint(self)
+                    last_checkpoint = time.monotonic()
+        if self.on_checkpoint:
+            self.on_checkpoint(self)
+        return self.pushed - started_with
+
+    async def arun(self, limit=None, deadline=None):
+        """run() on the running event loop, for a push coroutine function."""
+        started_with = self.pushed
+        dispatched = 0
+        pending = {}  # task -> (index, is_live)
+        in_flight_backlog = 0
+        last_checkpoint = time.monotonic()
+        while True:
+            while self._may_dispatch(len(pending), dispatched, limit, deadline):
+                index, live = self._next(in_flight_backlog)
+                if index is None:
+                    break
+                task = asyncio.ensure_future(self.push(self.items[index]))
+                pending[task] = (index, live)
+                dispatched += 1
+                if not live:
+                    in_flight_backlog += 1
+            if not pending:
+                break
+            finished, _ = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for task in finished:
+                index, live = pending.pop(task)
+                if not live:
+                    in_flight_backlog -= 1
+                self._finish(index, live, task.result)
+            if (
+                self.on_checkpoint
+                and time.monotonic() - last_checkpoint > self.checkpoint_interval
+            ):
+                self.on_checkpoint(self)
+                last_checkpoint = time.monotonic()
+        if self.on_checkpoint:
+            self.on_checkpoint(self)
+        return self.pushed - started_with
+
+
+def deficit_round_robin(schedulers, weights, quantum, deadline=None):
+    """Yields rounds, lists of (scheduler, limit): the caller runs each
+    scheduler of the round for at most limit items, concurrently or not,
+    before resuming. weights are positive multipliers of quantum, one per
+    scheduler. Stops when every scheduler is done or at deadline
+    (time.monotonic()).
+    """
+    deficits = [0] * len(schedulers)
+    active = [index for index, scheduler in enumerate(schedulers) if not scheduler.done]
+    while active and (deadline is None or time.monotonic() < deadline):
+        turns = []
+        for index in active:
+            deficits[index] += quantum * weights[index]
+            # a weight below 1 accumulates over several rounds
+            if deficits[index] >= 1:
+                turns.append((index, schedulers[index].pushed))
+        if turns:
+            yield [(schedulers[index], int(deficits[index])) for index, _ in turns]
+        for index, started_with in turns:
+            deficits[index] -= schedulers[index].pushed - started_with
+        active = [index for index in active if not schedulers[index].done]
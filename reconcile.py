@@ -0,0 +1,427 @@
+# Reconciliation of local punches with ERPNext Employee Checkin.
+#
+# For each device, the punches in the punch archive (or in dump/attlog files
+# passed on the command line) are compared with the Employee Checkin rows
+# that ERPNext has for that device_id, keyed on (attendance_device_id, time):
+#   - missing: punched locally but not in ERPNext
+#   - unexpected: in ERPNext for the device but not punched locally
+#
+# Usage:
+#   python3 erpnext_sync.py reconcile --since 20241001 --until 20241101
+#   python3 erpnext_sync.py reconcile --device-id HO1 --since 20241001 --push-missing
+#
+# Both sides are read in time order and merged as streams, so a month of
+# punches for thousands of employees is never held in memory: checkins are
+# listed page by page (a few pages fetched concurrently ahead of the merge)
+# with only the fields needed, and the results are written to
+# reconcile_<device_id>_missing.tsv and reconcile_<device_id>_unexpected.tsv
+# in the logs directory as they are found. Punches suppressed by de-bouncing
+# (attendance_suppressed_log_*) are not reported as missing.
+#
+# --push-missing pushes the missing punches afterwards; outcomes go to
+# attendance_reconcile_log_<device_id>.log.
+#
+# With ERPNEXT_SITES each site (every site unless --site is given) is
+# reconciled with the local punches that PUNCH_ROUTES sends to it, and its
+# files and logs are written to LOGS_DIRECTORY/<site>/.
+
+import datetime
+import itertools
+import json
+import os
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+import backfill
+import erpnext_sync
+import punch_archive
+import replay
+from erpnext_sync import config, info_logger
+
+PAGE_LENGTH = 500
+PAGE_WORKERS = 4
+RECONCILE_LOG_PREFIX = "attendance_reconcile_log_"
+SUPPRESSED_LOG_PREFIX = "attendance_suppressed_log_"
+
+_TIMESTAMP, _USER_ID, _UID, _PUNCH, _STATUS = range(5)
+
+
+def _headers(api_key=None, api_secret=None):
+    return {
+        "Authorization": "token "
+        + (api_key or config.ERPNEXT_API_KEY)
+        + ":"
+        + (api_secret or config.ERPNEXT_API_SECRET),
+        "Accept": "application/json",
+    }
+
+
+def _get(path, params, site=None):
+    """GET from ERPNEXT_URL, or from a site of ERPNEXT_SITES."""
+    if site is None:
+        response = erpnext_sync._limited_request(
+            "GET", config.ERPNEXT_URL + path, headers=_headers(), params=params
+        )
+    else:
+        import erpnext_sites
+
+        site = erpnext_sites.get(site)
+        response = erpnext_sync._limited_request(
+            "GET",
+            site.url + path,
+            limiter=site.limiter,
+            session=site.session,
+            headers=_headers(site.api_key, site.api_secret),
+            params=params,
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+def get_count(doctype, filters, site=None):
+    return int(
+        _get(
+            "/api/method/frappe.client.get_count",
+            {"doctype": doctype, "filters": json.dumps(filters)},
+            site,
+        )["message"]
+    )
+
+
+def iter_list(doctype, fields, filters, order_by, page_length=PAGE_LENGTH, site=None):
+    """Yields the rows of a list query in order. Pages are fetched by
+    PAGE_WORKERS threads, at most 2 * PAGE_WORKERS pages ahead of the reader.
+    """
+    count = get_count(doctype, filters, site)
+    path = "/api/resource/" + doctype
+    params = {
+        "fields": json.dumps(fields),
+        "filters": json.dumps(filters),
+        "order_by": order_by,
+        "limit_page_length": page_length,
+    }
+
+    def page(start):
+        return _get(path, dict(params, limit_start=start), site)["data"]
+
+    starts = iter(range(0, count, page_length))
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as executor:
+        ahead = deque(
+            executor.submit(page, start)
+            for start in itertools.islice(starts, 2 * PAGE_WORKERS)
+        )
+        while ahead:
+            rows = ahead.popleft().result()
+            for start in itertools.islice(starts, 1):
+                ahead.append(executor.submit(page, start))
+            yield from rows
+
+
+def employee_device_ids(site=None):
+    """{Employee name: attendance_device_id} of every employee."""
+    return {
+        row["name"]: (row.get("attendance_device_id") or "").strip()
+        for row in iter_list(
+            "Employee", ["name", "attendance_device_id"], [], "name asc", site=site
+        )
+    }
+
+
+def _epoch(value):
+    return int(datetime.datetime.fromisoformat(str(value)).timestamp())
+
+
+def iter_checkins(device_id, since, until, device_ids_by_employee, site=None):
+    """Yields (time, attendance_device_id, row) of the device's checkins in
+    time order.
+    """
+    filters = [["device_id", "=", device_id]]
+    if since:
+        filters.append(["time", ">=", str(since)])
+    if until:
+        filters.append(["time", "<", str(until)])
+    for row in iter_list(
+        "Employee Checkin",
+        ["name", "employee", "time"],
+        filters,
+        "time asc, name asc",
+        site=site,
+    ):
+        user_id = device_ids_by_employee.get(row["employee"]) or (
+            "employee:" + row["employee"]
+        )
+        yield _epoch(row["time"]), user_id, row
+
+
+def iter_local_punches(device_id, since, until, paths=None, site=None):
+    """Yields (time, user_id, record) of the device's local punches in time
+    order, from the punch archive or, if given, from dump/attlog files. With
+    a site, only the punches routed to it.
+    """
+    import erpnext_sites
+
+    if paths:
+
+        def records():
+            for path in paths:
+                for record in backfill.iter_input_file(path):
+                    if since and record[_TIMESTAMP] < since.timestamp():
+                        continue
+                    if until and record[_TIMESTAMP] >= until.timestamp():
+                        continue
+                    yield record
+
+        records, _ = backfill.sorted_unique_records(
+            records(), temp_dir=erpnext_sync._logs_directory()
+        )
+    else:
+        records = punch_archive.iter_records(
+            erpnext_sync.punch_archive_directory(), device_id, since, until
+        )
+    for record in records:
+        if site is not None and erpnext_sites.site_for(record[_USER_ID]) != site:
+            continue
+        yield int(record[_TIMESTAMP]), str(record[_USER_ID]), record
+
+
+def suppressed_keys(device_id, since, until, site=None):
+    keys = set()
+    low = since.timestamp() if since else None
+    high = until.timestamp() if until else None
+    for columns in replay.iter_log_lines(
+        replay.log_files(
+            SUPPRESSED_LOG_PREFIX, device_id, erpnext_sync._logs_directory(site)
+        )
+    ):
+        timestamp = float(columns[replay._TIMESTAMP])
+        if (low is None or timestamp >= low) and (high is None or timestamp < high):
+            keys.add((int(timestamp), columns[replay._USER_ID]))
+    return keys
+
+
+def merge(local, remote):
+    """Sort-merges two (time, user_id, item) streams in time order. Yields
+    ("missing", item) for local items with no remote match and
+    ("unexpected", item) for remote items with no local match. Only the
+    items of one second are held at a time.
+    """
+    local_groups = itertools.groupby(local, key=lambda x: x[0])
+    remote_groups = itertools.groupby(remote, key=lambda x: x[0])
+    local_group = next(local_groups, None)
+    remote_group = next(remote_groups, None)
+    while local_group or remote_group:
+        if remote_group is None or (
+            local_group is not None and local_group[0] < remote_group[0]
+        ):
+            for _, _, item in local_group[1]:
+                yield "missing", item
+            local_group = next(local_groups, None)
+        elif local_group is None or remote_group[0] < local_group[0]:
+            for _, _, item in remote_group[1]:
+                yield "unexpected", item
+            remote_group = next(remote_groups, None)
+        else:
+            remote_by_user = {}
+            for _, user_id, item in remote_group[1]:
+                remote_by_user.setdefault(user_id, []).append(item)
+            for _, user_id, item in local_group[1]:
+                if remote_by_user.get(user_id):
+                    remote_by_user[user_id].pop()
+                else:
+                    yield "missing", item
+            for items in remote_by_user.values():
+                for item in items:
+                    yield "unexpected", item
+            local_group = next(local_groups, None)
+            remote_group = next(remote_groups, None)
+
+
+def output_paths(device_id, site=None):
+    directory = erpnext_sync._logs_directory(site)
+    return (
+        os.path.join(directory, "reconcile_{}_missing.tsv".format(device_id)),
+        os.path.join(directory, "reconcile_{}_unexpected.tsv".format(device_id)),
+    )
+
+
+def reconcile(
+    device_id,
+    since=None,
+    until=None,
+    paths=None,
+    device_ids_by_employee=None,
+    site=None,
+):
+    """Writes the missing and unexpected punches of a device, on site (see
+    erpnext_sites). Returns a Counter of "missing", "unexpected" and
+    "suppressed".
+    """
+    if device_ids_by_employee is None:
+        device_ids_by_employee = employee_device_ids(site)
+    suppressed = suppressed_keys(device_id, since, until, site)
+    counts = Counter()
+    missing_path, unexpected_path = output_paths(device_id, site)
+    with open(missing_path, "w") as missing, open(unexpected_path, "w") as unexpected:
+        missing.write("user_id\ttimestamp\ttime\tuid\tpunch\tstatus\n")
+        unexpected.write("name\temployee\tattendance_device_id\ttime\n")
+        for kind, item in merge(
+            iter_local_punches(device_id, since, until, paths, site),
+            iter_checkins(device_id, since, until, device_ids_by_employee, site),
+        ):
+            if kind == "missing":
+                if (int(item[_TIMESTAMP]), str(item[_USER_ID])) in suppressed:
+                    counts["suppressed"] += 1
+                    continue
+                missing.write(
+                    "\t".join(
+                        [
+                            str(item[_USER_ID]),
+                            str(item[_TIMESTAMP]),
+                            str(datetime.datetime.fromtimestamp(item[_TIMESTAMP])),
+                            json.dumps(item[_UID]),
+                            json.dumps(item[_PUNCH]),
+                            json.dumps(item[_STATUS]),
+                        ]
+                    )
+                    + "\n"
+                )
+            else:
+                unexpected.write(
+                    "\t".join(
+                        [
+                            item["name"],
+                            item["employee"],
+                            device_ids_by_employee.get(item["employee"], ""),
+                            str(item["time"]),
+                        ]
+                    )
+                    + "\n"
+                )
+            counts[kind] += 1
+    info_logger.info(
+        "\t".join(
+            [
+                "Reconcile:",
+                device_id,
+                "missing",
+                str(counts["missing"]),
+                "unexpected",
+                str(counts["unexpected"]),
+            ]
+            + ([] if site is None else ["site", site])
+        )
+    )
+    return counts
+
+
+def iter_missing(device_id, site=None):
+    """Record tuples of the last reconcile's missing file, in time order."""
+    with open(output_paths(device_id, site)[0]) as f:
+        next(f)  # header
+        for line in f:
+            user_id, timestamp, _, uid, punch, status = line.rstrip("\n").split("\t")
+            yield (
+                float(timestamp),
+                user_id,
+                json.loads(uid),
+                json.loads(punch),
+                json.loads(status),
+            )
+
+
+def push_missing(device_id, total, concurrency=backfill.DEFAULT_CONCURRENCY, site=None):
+    pushed, _ = backfill.push_records(
+        backfill.find_device(device_id),
+        iter_missing(device_id, site),
+        total,
+        concurrency=concurrency,
+        log_result=replay.replay_log_writer(device_id, RECONCILE_LOG_PREFIX, site),
+        label="Reconcile",
+        site=site,
+    )
+    return pushed
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="dump/attlog files to compare instead of the punch archive (needs one --device-id)",
+    )
+    parser.add_argument(
+        "--device-id",
+        action="append",
+        help="reconcile only this device (repeatable); defaults to every configured device",
+    )
+    parser.add_argument("--since", type=backfill.parse_date, help="YYYYMMDD, inclusive")
+    parser.add_argument("--until", type=backfill.parse_date, help="YYYYMMDD, exclusive")
+    parser.add_argument(
+        "--site",
+        action="append",
+        help="reconcile only this ERPNEXT_SITES site (repeatable)",
+    )
+    parser.add_argument(
+        "--push-missing",
+        action="store_true",
+        help="push the missing punches to ERPNext",
+    )
+    parser.add_argument("--concurrency", type=int, default=backfill.DEFAULT_CONCURRENCY)
+
+
+def sites(args):
+    """Sites selected by --site, every site of ERPNEXT_SITES by default, or
+    [None] without ERPNEXT_SITES. Unlike replay there are no older root logs
+    to cover: the local punches are compared with the sites they route to.
+    """
+    import erpnext_sites
+
+    return args.site or erpnext_sites.site_names() or [None]
+
+
+def run(args):
+    device_ids = args.device_id or [d["device_id"] for d in config.devices]
+    if args.files and len(device_ids) != 1:
+        print("Reconciling files needs exactly one --device-id")
+        return 2
+    exit_code = 0
+    for site in sites(args):
+        device_ids_by_employee = employee_device_ids(site)
+        label = "" if site is None else site + ":"
+        for device_id in device_ids:
+            counts = reconcile(
+                device_id,
+                args.since,
+                args.until,
+                args.files,
+                device_ids_by_employee,
+                site,
+            )
+            missing_path, unexpected_path = output_paths(device_id, site)
+            print(
+                "{}{}: {} missing in ERPNext ({}), {} unexpected in ERPNext ({}), "
+                "{} suppressed by de-bouncing".format(
+                    label,
+                    device_id,
+                    counts["missing"],
+                    missing_path,
+                    counts["unexpected"],
+                    unexpected_path,
+                    counts["suppressed"],
+                )
+            )
+            if args.push_missing and counts["missing"]:
+                try:
+                    pushed = push_missing(
+                        device_id, counts["missing"], args.concurrency, site
+                    )
+                    print(
+                        "{}{}: {} missing punches sent".format(label, device_id, pushed)
+                    )
+                except backfill.BackfillHalted as e:
+                    print(
+                        "{}{}: push halted, run again to retry: {}".format(
+                            label, device_id, e
+                        )
+                    )
+                    exit_code = 1
+    return exit_code
@@ -0,0 +1,235 @@
+# Bulk replay of the failed-attendance logs.
+#
+# Every line of attendance_failed_log_<device_id>.log (and its rotated .1-.50
+# files) keeps the full record as JSON in the last TSV column. After an
+# ERPNext outage or a fix to employee mappings, this resubmits those records
+# without wiping state and re-pulling from the devices.
+#
+# Usage:
+#   python3 erpnext_sync.py replay [--device-id HO1] [--site a] [--dry-run]
+#
+# With ERPNEXT_SITES the logs of each site (LOGS_DIRECTORY/<site>/) are
+# replayed to that site, every site unless --site is given. The logs at the
+# root of LOGS_DIRECTORY, from before ERPNEXT_SITES was set, are replayed to
+# ERPNEXT_URL as well.
+#
+# Outcomes go to attendance_replay_log_<device_id>.log (same TSV layout as the
+# other attendance logs) rather than the success log, since the success log's
+# last line is where pull_process_and_push_data resumes from. Records found
+# in the success log or already replayed or backfilled (INFO lines of the
+# replay and backfill logs) are skipped, so running replay again only
+# retries what is still missing.
+
+import glob
+import json
+import os
+
+import backfill
+import erpnext_sync
+from erpnext_sync import config, error_logger, info_logger
+
+FAILED_LOG_PREFIX = "attendance_failed_log_"
+SUCCESS_LOG_PREFIX = "attendance_success_log_"
+REPLAY_LOG_PREFIX = "attendance_replay_log_"
+MAX_ROTATED_FILES = 50  # backupCount of setup_logger
+
+# columns of an attendance log line, after asctime and levelname
+_LEVEL, _FIRST, _UID, _USER_ID, _TIMESTAMP, _PUNCH, _STATUS, _RECORD = range(1, 9)
+
+
+def log_files(prefix, device_id, logs_directory=None):
+    """Current and rotated log files of a device, oldest first."""
+    base = os.path.join(
+        logs_directory or config.LOGS_DIRECTORY, prefix + device_id + ".log"
+    )
+    files = []
+    for index in range(MAX_ROTATED_FILES, 0, -1):
+        path = "{}.{}".format(base, index)
+        if os.path.exists(path):
+            files.append(path)
+    if os.path.exists(base):
+        files.append(base)
+    return files
+
+
+def iter_log_lines(paths):
+    """Yields the TSV columns of every well-formed attendance log line."""
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                columns = line.rstrip("\n").split("\t")
+                if len(columns) > _RECORD:
+                    yield columns
+
+
+def record_key(columns):
+    return (columns[_USER_ID], columns[_TIMESTAMP])
+
+
+def resolved_keys(device_id, logs_directory=None):
+    """Keys of records that are known to be in ERPNext."""
+    keys = set()
+    for columns in iter_log_lines(
+        log_files(SUCCESS_LOG_PREFIX, device_id, logs_directory)
+    ):
+        keys.add(record_key(columns))
+    for prefix in (REPLAY_LOG_PREFIX, backfill.BACKFILL_LOG_PREFIX):
+        for columns in iter_log_lines(log_files(prefix, device_id, logs_directory)):
+            if columns[_LEVEL] == "INFO":
+                keys.add(record_key(columns))
+    return keys
+
+
+def iter_replayable_records(
+    device_id, resolved, since=None, until=None, logs_directory=None
+):
+    """Yields record tuples (see backfill) of failed records whose key is not
+    in resolved. Keys are added to resolved as they are yielded, so each
+    record comes out once even if it failed in many cycles.
+    """
+    for columns in iter_log_lines(
+        log_files(FAILED_LOG_PREFIX, device_id, logs_directory)
+    ):
+        key = record_key(columns)
+        if key in resolved:
+            continue
+        try:
+            timestamp = float(columns[_TIMESTAMP])
+            record = json.loads(columns[_RECORD])
+        except ValueError:
+            continue
+        if since and timestamp < since.timestamp():
+            continue
+        if until and timestamp >= until.timestamp():
+            continue
+        resolved.add(key)
+        yield (
+            timestamp,
+            columns[_USER_ID],
+            record.get("uid"),
+            record.get("punch"),
+            record.get("status"),
+        )
+
+
+def device_ids_with_failed_logs(logs_directory=None):
+    device_ids = set()
+    pattern = os.path.join(
+        logs_directory or config.LOGS_DIRECTORY, FAILED_LOG_PREFIX + "*.log*"
+    )
+    for path in glob.glob(pattern):
+        name = os.path.basename(path)[len(FAILED_LOG_PREFIX) :]
+        device_ids.add(name.split(".log", 1)[0])
+    return sorted(device_ids)
+
+
+def replay_log_writer(device_id, prefix=REPLAY_LOG_PREFIX, site=None):
+    """log_result for backfill.push_records. Successes and duplicates are
+    written as INFO and are not replayed again; other failures as ERROR.
+    """
+    return backfill.outcome_log_writer(device_id, prefix, site)
+
+
+def replay(
+    device_id,
+    concurrency=backfill.DEFAULT_CONCURRENCY,
+    since=None,
+    until=None,
+    dry_run=False,
+    site=None,
+):
+    """Replays the failed records of a device to site (see erpnext_sites),
+    from that site's logs. Returns (records found, records sent).
+    """
+    logs_directory = erpnext_sync._logs_directory(site)
+    resolved = resolved_keys(device_id, logs_directory)
+    # a counting pass over the logs first, for the progress ETA; the logs are
+    # streamed twice rather than holding the records in memory
+    total = sum(
+        1
+        for _ in iter_replayable_records(
+            device_id, set(resolved), since, until, logs_directory
+        )
+    )
+    info_logger.info(
+        "\t".join(
+            ["Replay:", str(total), "failed records for", device_id]
+            + ([] if site is None else ["site", site])
+        )
+    )
+    if dry_run or not total:
+        return total, 0
+    pushed, _ = backfill.push_records(
+        backfill.find_device(device_id),
+        iter_replayable_records(device_id, resolved, since, until, logs_directory),
+        total,
+        concurrency=concurrency,
+        log_result=replay_log_writer(device_id, site=site),
+        label="Replay",
+        site=site,
+    )
+    return total, pushed
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--device-id",
+        action="append",
+        help="replay only this device (repeatable); defaults to every device with a failed log",
+    )
+    parser.add_argument(
+        "--site",
+        action="append",
+        help="replay only the logs of this ERPNEXT_SITES site (repeatable)",
+    )
+    parser.add_argument("--concurrency", type=int, default=backfill.DEFAULT_CONCURRENCY)
+    parser.add_argument("--since", type=backfill.parse_date, help="YYYYMMDD, inclusive")
+    parser.add_argument("--until", type=backfill.parse_date, help="YYYYMMDD, exclusive")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="only count what would be replayed"
+    )
+
+
+def sites(args):
+    """Sites selected by --site; by default None (the logs at the root of
+    LOGS_DIRECTORY, written before ERPNEXT_SITES was set or without it) and
+    every site of ERPNEXT_SITES, like report.
+    """
+    import erpnext_sites
+
+    return args.site or [None] + erpnext_sites.site_names()
+
+
+def run(args):
+    exit_code = 0
+    for site in sites(args):
+        logs_directory = erpnext_sync._logs_directory(site)
+        label = "" if site is None else site + ":"
+        for device_id in args.device_id or device_ids_with_failed_logs(logs_directory):
+            try:
+                found, pushed = replay(
+                    device_id,
+                    concurrency=args.concurrency,
+                    since=args.since,
+                    until=args.until,
+                    dry_run=args.dry_run,
+                    site=site,
+                )
+                print(
+                    "{}{}: {} records to replay, {} sent".format(
+                        label, device_id, found, pushed
+                    )
+                )
+            except backfill.BackfillHalted as e:
+                error_logger.error(
+                    "\t".join(
+                        ["Replay halted by ERPNext error.", label + device_id, str(e)]
+                    )
+                )
+                print(
+                    "{}{}: replay halted, run again to retry: {}".format(
+                        label, device_id, e
+                    )
+                )
+                exit_code = 1
+    return exit_code
@@ -0,0 +1,340 @@
+# Push statistics from the attendance logs.
+#
+# Scans attendance_success_log_<device_id>.log and attendance_failed_log_*
+# (with their rotated .1-.50 files) and counts punches per device, user, day
+# and error (the HTTP status code in the first column of failed lines).
+#
+# Usage:
+#   python3 erpnext_sync.py report --since 20241001 --until 20241002
+#   python3 erpnext_sync.py report --device-id HO1 --json
+#
+# With ERPNEXT_SITES the logs of every site (LOGS_DIRECTORY/<site>/) are
+# scanned too, or only those of --site; their devices are reported as
+# "<site>:<device_id>".
+#
+# Files are memory-mapped and scanned in parallel, one process per file.
+# Only the leading columns of a line are split off; the JSON record at the
+# end is never parsed. While scanning, a small index of each file is saved
+# under .report_index/ in the file's directory: its punch time range and the byte
+# offset and time range of every INDEX_BLOCK_LINES lines. Rotated files
+# never change, so later queries with --since/--until skip whole files and
+# blocks outside the range without reading them. Indexes are keyed by inode,
+# so they stay valid when a file is renamed by rotation, and are rebuilt
+# when its size or mtime changes.
+
+import datetime
+import glob
+import json
+import mmap
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import backfill
+import punch_archive
+from erpnext_sync import config
+
+LOG_PREFIXES = {
+    "success": "attendance_success_log_",
+    "failed": "attendance_failed_log_",
+}
+INDEX_DIRECTORY = ".report_index"
+INDEX_BLOCK_LINES = 1024
+
+# leading columns of an attendance log line
+_FIRST, _UID, _USER_ID, _TIMESTAMP = 2, 3, 4, 5
+
+
+def find_log_files(logs_directory, device_ids=None, sites=(None,)):
+    """[(path, kind, device)] of every success and failed log file in
+    logs_directory (site None) and in the subdirectories of sites. device is
+    the device_id, "<site>:<device_id>" for the logs of a site.
+    """
+    files = []
+    for site in sites:
+        directory = (
+            logs_directory if site is None else os.path.join(logs_directory, site)
+        )
+        for kind, prefix in LOG_PREFIXES.items():
+            for path in glob.glob(os.path.join(directory, prefix + "*.log*")):
+                name = os.path.basename(path)[len(prefix) :]
+                device_id, suffix = name.split(".log", 1)
+                if suffix and not suffix[1:].isdigit():
+                    continue
+                if device_ids and device_id not in device_ids:
+                    continue
+                files.append(
+                    (path, kind, device_id if site is None else site + ":" + device_id)
+                )
+    # biggest first, so that one large file does not finish last
+    return sorted(files, key=lambda f: os.path.getsize(f[0]), reverse=True)
+
+
+def _file_key(stat):
+    return [stat.st_ino, stat.st_size, stat.st_mtime_ns]
+
+
+def _index_path(logs_directory, inode):
+    return os.path.join(logs_directory, INDEX_DIRECTORY, "{}.json".format(inode))
+
+
+def load_index(logs_directory, path):
+    """Saved index of a log file, or None if missing or out of date."""
+    key = _file_key(os.stat(path))
+    try:
+        with open(_index_path(logs_directory, key[0])) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get("key") == key else None
+
+
+def save_index(logs_directory, index):
+    os.makedirs(os.path.join(logs_directory, INDEX_DIRECTORY), exist_ok=True)
+    path = _index_path(logs_directory, index["key"][0])
+    with open(path + ".part", "w") as f:
+        json.dump(index, f)
+    os.replace(path + ".part", path)
+
+
+def prune_indexes(logs_directory, paths):
+    """Removes the indexes of log files that no longer exist."""
+    inodes = {str(os.stat(path).st_ino) for path in paths}
+    for index_file in glob.glob(
+        os.path.join(logs_directory, INDEX_DIRECTORY, "*.json")
+    ):
+        if os.path.basename(index_file)[: -len(".json")] not in inodes:
+            os.remove(index_file)
+
+
+def _overlaps(low, high, since, until):
+    if low is None:
+        return False
+    return (since is None or high >= since) and (until is None or low < until)
+
+
+def scan_file(path, kind, device_id, since=None, until=None, user_ids=None, index=None):
+    """Counts the lines of one log file; runs in a worker process.
+
+    since/until: epoch seconds, until exclusive.
+    index: the saved index of the file, to skip blocks outside the range.
+    Returns (Counter, new index or None).
+    """
+    counts = Counter()
+    size = os.path.getsize(path)
+    if index is not None:
+        if not _overlaps(index["min"], index["max"], since, until):
+            return counts, None
+        offsets = [0] + [block[0] for block in index["blocks"][1:]] + [size]
+        ranges = [
+            (offsets[i], offsets[i + 1])
+            for i, block in enumerate(index["blocks"])
+            if _overlaps(block[1], block[2], since, until)
+        ]
+        new_index = None
+    else:
+        ranges = [(0, size)]
+        new_index = {
+            "key": _file_key(os.stat(path)),
+            "min": None,
+            "max": None,
+            "blocks": [],
+        }
+    if not size or not ranges:
+        return counts, new_index
+
+    days = {}  # local day of each hour, fromtimestamp() per line is slow
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end in ranges:
+            position = start
+            lines = 0
+            block = None
+            while position < end:
+                newline = mm.find(b"\n", position, end)
+                if newline < 0:
+                    newline = end
+                columns = mm[position:newline].split(b"\t", _TIMESTAMP + 1)
+                line_start, position = position, newline + 1
+                try:
+                    timestamp = float(columns[_TIMESTAMP])
+                except (IndexError, ValueError):
+                    continue
+                if new_index is not None:
+                    if lines % INDEX_BLOCK_LINES == 0:
+                        block = [line_start, timestamp, timestamp]
+                        new_index["blocks"].append(block)
+                    block[1] = min(block[1], timestamp)
+                    block[2] = max(block[2], timestamp)
+                    lines += 1
+                if (since is not None and timestamp < since) or (
+                    until is not None and timestamp >= until
+                ):
+                    continue
+                user_id = columns[_USER_ID].decode(errors="replace")
+                if user_ids and user_id not in user_ids:
+                    continue
+                bucket = int(timestamp // punch_archive.DAY_CACHE_SECONDS)
+                day = days.get(bucket)
+                if day is None:
+                    day = days[bucket] = datetime.datetime.fromtimestamp(
+                        timestamp
+                    ).strftime("%Y-%m-%d")
+                counts["device", device_id, kind] += 1
+                counts["user", device_id, user_id, kind] += 1
+                counts["day", device_id, day, kind] += 1
+                if kind == "failed":
+                    error = columns[_FIRST].decode(errors="replace")
+                    counts["error", device_id, error] += 1
+    if new_index is not None and new_index["blocks"]:
+        new_index["min"] = min(block[1] for block in new_index["blocks"])
+        new_index["max"] = max(block[2] for block in new_index["blocks"])
+    return counts, new_index
+
+
+def collect(
+    logs_directory=None,
+    device_ids=None,
+    user_ids=None,
+    since=None,
+    until=None,
+    workers=None,
+    sites=(None,),
+):
+    """Aggregated Counter over every log file; see scan_file for the keys.
+
+    sites: see find_log_files.
+    """
+    logs_directory = logs_directory or config.LOGS_DIRECTORY
+    since = since.timestamp() if since else None
+    until = until.timestamp() if until else None
+    files = find_log_files(logs_directory, device_ids, sites)
+    counts = Counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                scan_file,
+                path,
+                kind,
+                device_id,
+                since,
+                until,
+                user_ids,
+                load_index(os.path.dirname(path), path),
+            )
+            for path, kind, device_id in files
+        ]
+        for future, (path, _, _) in zip(futures, files):
+            file_counts, index = future.result()
+            counts.update(file_counts)
+            if index is not None:
+                save_index(os.path.dirname(path), index)
+    if not device_ids:
+        for site in sites:
+            directory = (
+                logs_directory if site is None else os.path.join(logs_directory, site)
+            )
+            prune_indexes(
+                directory,
+                [
+                    path
+                    for path, _, _ in files
+                    if os.path.normpath(os.path.dirname(path))
+                    == os.path.normpath(directory)
+                ],
+            )
+    return counts
+
+
+def summarize(counts):
+    """Nested dicts of the counters, for --json and printing."""
+    summary = {"devices": {}, "users": {}, "days": {}, "errors": {}}
+    for key, count in sorted(counts.items()):
+        if key[0] == "device":
+            _, device_id, kind = key
+            summary["devices"].setdefault(device_id, {})[kind] = count
+        elif key[0] == "user":
+            _, device_id, user_id, kind = key
+            users = summary["users"].setdefault(device_id, {})
+            users.setdefault(user_id, {})[kind] = count
+        elif key[0] == "day":
+            _, device_id, day, kind = key
+            days = summary["days"].setdefault(device_id, {})
+            days.setdefault(day, {})[kind] = count
+        else:
+            _, device_id, error = key
+            summary["errors"].setdefault(device_id, {})[error] = count
+    return summary
+
+
+def print_summary(summary, show_users=False):
+    for device_id, kinds in summary["devices"].items():
+        print(
+            "{}: {} pushed, {} failed".format(
+                device_id, kinds.get("success", 0), kinds.get("failed", 0)
+            )
+        )
+        for day, day_kinds in summary["days"].get(device_id, {}).items():
+            print(
+                "  {}  {:>7} pushed {:>7} failed".format(
+                    day, day_kinds.get("success", 0), day_kinds.get("failed", 0)
+                )
+            )
+        errors = summary["errors"].get(device_id)
+        if errors:
+            print(
+                "  errors: "
+                + ", ".join("HTTP {} x {}".format(e, n) for e, n in errors.items())
+            )
+        users = summary["users"].get(device_id, {})
+        failed_users = sorted(u for u, k in users.items() if k.get("failed"))
+        if failed_users:
+            print("  users with failures: " + ", ".join(failed_users))
+        if show_users:
+            for user_id, user_kinds in users.items():
+                print(
+                    "  user {:<10} {:>7} pushed {:>7} failed".format(
+                        user_id,
+                        user_kinds.get("success", 0),
+                        user_kinds.get("failed", 0),
+                    )
+                )
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--device-id", action="append", help="only this device (repeatable)"
+    )
+    parser.add_argument(
+        "--user-id", action="append", help="only this user (repeatable)"
+    )
+    parser.add_argument(
+        "--site",
+        action="append",
+        help="only the logs of this ERPNEXT_SITES site (repeatable)",
+    )
+    parser.add_argument("--since", type=backfill.parse_date, help="YYYYMMDD, inclusive")
+    parser.add_argument("--until", type=backfill.parse_date, help="YYYYMMDD, exclusive")
+    parser.add_argument("--users", action="store_true", help="list counts per user")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument(
+        "--workers", type=int, help="processes, defaults to the CPU count"
+    )
+
+
+def run(args):
+    import erpnext_sites
+
+    counts = collect(
+        device_ids=args.device_id,
+        user_ids=set(args.user_id) if args.user_id else None,
+        since=args.since,
+        until=args.until,
+        workers=args.workers,
+        sites=args.site or [None] + erpnext_sites.site_names(),
+    )
+    summary = summarize(counts)
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary, show_users=args.users)
+    return 0
@@ -0,0 +1,169 @@
+# Shift-aware scheduling of the sync cycles (SHIFT_AWARE_SCHEDULING).
+#
+# HRMS auto-attendance marks a shift only once the Shift Type's
+# last_sync_of_checkin is past the shift end plus its
+# allow_check_out_after_shift_end_time, and it runs once an hour. With a
+# fixed PULL_FREQUENCY the devices are either polled far more often than
+# needed or the shift close is synced late and attendance misses a run.
+#
+# The Shift Types of shift_type_device_mapping are loaded from ERPNext once
+# and cached in status.json ('shift_types'), refreshed every
+# SHIFT_TYPE_REFRESH_HOURS. From their times the cycles are planned as:
+#   - every SHIFT_POLL_MINUTES from the check-in opening
+#     (begin_check_in_before_shift_start_time) until SHIFT_WINDOW_MINUTES
+#     after the start, and from SHIFT_WINDOW_MINUTES before the end until
+#     the close
+#   - one cycle at the close: end + allow_check_out_after_shift_end_time +
+#     SHIFT_SYNC_DELAY_MINUTES; last_sync_of_checkin of the shift is updated
+#     at the end of the first cycle that pulled after the close
+#   - every PULL_FREQUENCY minutes otherwise
+# Without any Shift Type loaded the fixed PULL_FREQUENCY is used.
+
+import datetime
+import time
+
+from erpnext_sync import config, error_logger, http_session, info_logger, status
+
+_shift_types = None
+
+
+def shift_type_names():
+    names = []
+    for shift_type_device_map in getattr(config, "shift_type_device_mapping", []):
+        shift_type_name = shift_type_device_map["shift_type_name"]
+        if isinstance(shift_type_name, str):
+            shift_type_name = [shift_type_name]
+        names.extend(name for name in shift_type_name if name not in names)
+    return names
+
+
+def parse_time(value):
+    """Seconds since midnight of a Frappe Time value ('8:00:00',
+    '22:30:00.000000').
+    """
+    hours, minutes, seconds = str(value).split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def fetch_shift_type(name):
+    url = config.ERPNEXT_URL + "/api/resource/Shift Type/" + name
+    headers = {
+        "Authorization": "token "
+        + config.ERPNEXT_API_KEY
+        + ":"
+        + config.ERPNEXT_API_SECRET,
+        "Accept": "application/json",
+    }
+    response = http_session.request("GET", url, headers=headers)
+    response.raise_for_status()
+    doc = response.json()["data"]
+    return {
+        "start_time": parse_time(doc["start_time"]),
+        "end_time": parse_time(doc["end_time"]),
+        "begin_check_in": int(doc.get("begin_check_in_before_shift_start_time") or 0),
+        "allow_check_out": int(doc.get("allow_check_out_after_shift_end_time") or 0),
+    }
+
+
+def load_shift_types(refresh=False):
+    """{Shift Type name: times} of the configured shifts, from the cache
+    unless it is older than SHIFT_TYPE_REFRESH_HOURS. If ERPNext cannot be
+    reached the cached times are kept.
+    """
+    global _shift_types
+    if _shift_types is None:
+        _shift_types = status.get("shift_types") or {"fetched": 0, "shifts": {}}
+    names = shift_type_names()
+    max_age = getattr(config, "SHIFT_TYPE_REFRESH_HOURS", 24) * 3600
+    if (
+        refresh
+        or time.time() - _shift_types["fetched"] > max_age
+        or any(name not in _shift_types["shifts"] for name in names)
+    ):
+        shifts = {}
+        for name in names:
+            try:
+                shifts[name] = fetch_shift_type(name)
+            except:
+                error_logger.exception("exception when loading Shift Type: " + name)
+                if name in _shift_types["shifts"]:
+                    shifts[name] = _shift_types["shifts"][name]
+        if len(shifts) == len(names):
+            _shift_types = {"fetched": time.time(), "shifts": shifts}
+            status.set("shift_types", _shift_types)
+            info_logger.info("Shift Types loaded: " + ", ".join(names))
+        else:
+            # retried at the next cycle
+            _shift_types = dict(
+                _shift_types, shifts=dict(_shift_types["shifts"], **shifts)
+            )
+    return _shift_types["shifts"]
+
+
+def shift_instants(shift, day):
+    """(check-in opening, start, end, close) datetimes of the shift that
+    starts on day (a date). The end of a night shift is on the next day.
+    """
+    midnight = datetime.datetime.combine(day, datetime.time())
+    start = midnight + datetime.timedelta(seconds=shift["start_time"])
+    end = midnight + datetime.timedelta(seconds=shift["end_time"])
+    if end <= start:
+        end += datetime.timedelta(days=1)
+    opening = start - datetime.timedelta(minutes=shift["begin_check_in"])
+    close = end + datetime.timedelta(
+        minutes=shift["allow_check_out"]
+        + getattr(config, "SHIFT_SYNC_DELAY_MINUTES", 1)
+    )
+    return opening, start, end, close
+
+
+def _instants(shift, around):
+    # the shifts that started the day before can still be open
+    for days in (-1, 0, 1):
+        yield shift_instants(shift, around.date() + datetime.timedelta(days=days))
+
+
+def busy_windows(shift_types, around):
+    """[(from, to)] of the tight polling windows of the shifts near around;
+    each window ending at a close ends at that close.
+    """
+    window = datetime.timedelta(minutes=getattr(config, "SHIFT_WINDOW_MINUTES", 30))
+    windows = []
+    for shift in shift_types.values():
+        for opening, start, end, close in _instants(shift, around):
+            windows.append((opening, start + window))
+            windows.append((min(end - window, close), close))
+    return windows
+
+
+def next_cycle_time(shift_types, last_cycle):
+    """When the cycle after the one that lifted off at last_cycle is due."""
+    windows = busy_windows(shift_types, last_cycle)
+    if any(start <= last_cycle < end for start, end in windows):
+        interval = getattr(config, "SHIFT_POLL_MINUTES", 5)
+    else:
+        interval = config.PULL_FREQUENCY
+    due = last_cycle + datetime.timedelta(minutes=interval)
+    # never sleep past the start of a window or a close
+    for start, end in windows + busy_windows(shift_types, due):
+        for boundary in (start, end):
+            if last_cycle < boundary < due:
+                due = boundary
+    return due
+
+
+def sync_due(shift, last_sync, pull_timestamp):
+    """Whether a close of the shift falls in (last_sync, pull_timestamp], so
+    that last_sync_of_checkin should be moved to pull_timestamp.
+    """
+    if last_sync is None:
+        return True
+    if pull_timestamp <= last_sync:
+        return False
+    day = last_sync.date() - datetime.timedelta(days=1)
+    while day <= pull_timestamp.date():
+        close = shift_instants(shift, day)[3]
+        if last_sync < close <= pull_timestamp:
+            return True
+        day += datetime.timedelta(days=1)
+    return False
@@ -0,0 +1,13 @@
+import pytest
+
+
+class FakeStatus(dict):
+    """In-memory stand-in for the status store (pickledb) of erpnext_sync."""
+
+    def set(self, key, value):
+        self[key] = value
+
+
+@pytest.fixture
+def fake_status():
+    return FakeStatus()
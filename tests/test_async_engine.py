@@ -0,0 +1,274 @@
+"""AsyncZK against a fake terminal speaking the TCP framing of the ZK
+protocol, decoded with erpnext_sync.iter_attendance_records."""
+
+import asyncio
+import datetime
+import logging
+import struct
+import time
+
+import pytest
+
+zk = pytest.importorskip("zk")
+
+import async_engine  # noqa: E402
+import erpnext_sync  # noqa: E402
+import push_limiter  # noqa: E402
+
+SESSION_ID = 42
+
+
+def encode_device_time(d):
+    return (
+        ((d.year % 100) * 12 * 31 + (d.month - 1) * 31 + d.day - 1) * 86400
+        + (d.hour * 60 + d.minute) * 60
+        + d.second
+    )
+
+
+def user_record(uid, user_id, name):
+    return struct.pack(
+        "<HB8s24sIx7sx24s", uid, 0, b"", name.encode(), 0, b"", user_id.encode()
+    )
+
+
+def attendance_record(uid, user_id, timestamp):
+    return struct.pack(
+        "<H24sBIB8s",
+        uid,
+        user_id.encode(),
+        1,
+        encode_device_time(timestamp),
+        0,
+        b"\0" * 8,
+    )
+
+
+def with_total_size(records):
+    data = b"".join(records)
+    return struct.pack("<I", len(data)) + data
+
+
+class FakeTerminal:
+    """Answers the commands of get_all_attendance_from_device; every
+    buffered chunk is sent as data_packets CMD_DATA packets.
+    """
+
+    def __init__(self, users, attendances, data_packets=2):
+        self.data_packets = data_packets
+        self.buffers = {
+            async_engine.CMD_USERTEMP_RRQ: with_total_size(users),
+            13: with_total_size(attendances),
+        }
+        self.sizes = [0] * 20
+        self.sizes[4] = len(users)
+        self.sizes[8] = len(attendances)
+        self.commands = []
+
+    async def handle(self, reader, writer):
+        buffer = b""
+
+        def send(code, payload=b"", reply_id=0):
+            packet = struct.pack("<4H", code, 0, SESSION_ID, reply_id) + payload
+            writer.write(
+                struct.pack("<HHI", *async_engine.MACHINE_PREPARE_DATA, len(packet))
+                + packet
+            )
+
+        while True:
+            try:
+                _, _, length = struct.unpack("<HHI", await reader.readexactly(8))
+                packet = await reader.readexactly(length)
+            except asyncio.IncompleteReadError:
+                break
+            command, _, _, reply_id = struct.unpack("<4H", packet[:8])
+            data = packet[8:]
+            self.commands.append(command)
+            if command == async_engine.CMD_GET_FREE_SIZES:
+                send(
+                    async_engine.CMD_ACK_OK, struct.pack("<20i", *self.sizes), reply_id
+                )
+            elif command == async_engine.CMD_PREPARE_BUFFER:
+                _, buffered_command, _, _ = struct.unpack("<bhii", data)
+                buffer = self.buffers[buffered_command]
+                send(
+                    async_engine.CMD_ACK_OK,
+                    b"\0" + struct.pack("<I", len(buffer)),
+                    reply_id,
+                )
+            elif command == async_engine.CMD_READ_BUFFER:
+                start, size = struct.unpack("<ii", data)
+                chunk = buffer[start : start + size]
+                send(
+                    async_engine.CMD_PREPARE_DATA, struct.pack("<II", size, 0), reply_id
+                )
+                step = -(-len(chunk) // self.data_packets)
+                for i in range(0, len(chunk), step):
+                    send(async_engine.CMD_DATA, chunk[i : i + step])
+                send(async_engine.CMD_ACK_OK)
+            else:
+                send(async_engine.CMD_ACK_OK, b"", reply_id)
+            await writer.drain()
+            if command == async_engine.CMD_EXIT:
+                break
+        writer.close()
+
+
+def test_checksum_matches_pyzk():
+    packet = struct.pack("<4H", 1000, 0, 0, 65534) + b"\x01\x02\x03"
+    pyzk_checksum = zk.ZK("127.0.0.1")._ZK__create_checksum(tuple(packet))
+    assert async_engine.checksum(packet) == struct.unpack("H", pyzk_checksum)[0]
+
+
+def test_download_and_decode_attendance(monkeypatch):
+    # small chunks, so that the buffers are read in several of them
+    monkeypatch.setattr(async_engine, "MAX_CHUNK", 100)
+    start = datetime.datetime(2026, 10, 1, 8)
+    users = [user_record(uid, str(900 + uid), "U%d" % uid) for uid in range(1, 6)]
+    attendances = [
+        attendance_record(1 + i % 5, str(900 + 1 + i % 5), start.replace(minute=i))
+        for i in range(30)
+    ]
+    terminal = FakeTerminal(users, attendances)
+
+    async def download():
+        server = await asyncio.start_server(terminal.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            conn = await async_engine.AsyncZK("127.0.0.1", port, timeout=5).connect()
+            await conn.disable_device()
+            downloaded = await conn.download_attendance()
+            await conn.enable_device()
+            await conn.disconnect()
+        return downloaded
+
+    downloaded = asyncio.run(download())
+    assert [user.user_id for user in downloaded.get_users()] == [
+        str(900 + uid) for uid in range(1, 6)
+    ]
+    records = list(erpnext_sync.iter_attendance_records(downloaded))
+    assert records == [
+        {
+            "uid": 1 + i % 5,
+            "user_id": str(900 + 1 + i % 5),
+            "timestamp": start.replace(minute=i),
+            "status": 1,
+            "punch": 0,
+        }
+        for i in range(30)
+    ]
+    assert terminal.commands[:2] == [
+        async_engine.CMD_CONNECT,
+        async_engine.CMD_DISABLEDEVICE,
+    ]
+    assert terminal.commands.count(async_engine.CMD_FREE_DATA) == 2
+    assert terminal.commands[-2:] == [
+        async_engine.CMD_ENABLEDEVICE,
+        async_engine.CMD_EXIT,
+    ]
+
+
+# CONNECT, PREPARE_BUFFER (CMD_ATTLOG_RRQ), READ_BUFFER, FREE_DATA and EXIT,
+# captured on the wire between pyzk's TCP client and a FakeTerminal holding
+# three punches; the reply to READ_BUFFER comes as PREPARE_DATA, two DATA
+# packets and ACK_OK. AsyncZK must send the same bytes as pyzk.
+RECORDED_EXCHANGE = [
+    ("send", "5050827d08000000e80317fc00000000"),
+    ("recv", "5050827d08000000d00700002a000000"),
+    ("send", "5050827d13000000df05f4ec2a000100010d000000000000000000"),
+    ("recv", "5050827d0d000000d00700002a000100007c000000"),
+    ("send", "5050827d10000000e00577f92a000200000000007c000000"),
+    ("recv", "5050827d10000000dc0500002a0002007c00000000000000"),
+    (
+        "recv",
+        "5050827d46000000dd0500002a00000078000000010039303100000000000000"
+        "000000000000000000000000000001006f3f3300000000000000000002003930"
+        "3200000000000000000000000000",
+    ),
+    (
+        "recv",
+        "5050827d46000000dd0500002a0000000000000000000000013c6f3f33000000"
+        "0000000000000100393031000000000000000000000000000000000000000000"
+        "01786f3f33000000000000000000",
+    ),
+    ("recv", "5050827d08000000d00700002a000000"),
+    ("send", "5050827d08000000de05f4f92a000300"),
+    ("recv", "5050827d08000000d00700002a000300"),
+    ("send", "5050827d08000000e903e8fb2a000400"),
+    ("recv", "5050827d08000000d00700002a000400"),
+]
+
+
+def test_replays_recorded_tcp_exchange():
+    sent = []
+
+    async def terminal(reader, writer):
+        for direction, packet in RECORDED_EXCHANGE:
+            packet = bytes.fromhex(packet)
+            if direction == "send":
+                top = await reader.readexactly(8)
+                sent.append(top + await reader.readexactly(len(packet) - 8))
+                assert sent[-1] == packet
+            else:
+                writer.write(packet)
+                await writer.drain()
+        writer.close()
+
+    async def read():
+        server = await asyncio.start_server(terminal, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            conn = await async_engine.AsyncZK("127.0.0.1", port, timeout=5).connect()
+            data = await conn.read_with_buffer(13)
+            await conn.disconnect()
+        return data
+
+    data, size = asyncio.run(read())
+    assert len(sent) == 5
+    start = datetime.datetime(2026, 10, 1, 8)
+    assert data == with_total_size(
+        [
+            attendance_record(1 + i % 2, str(901 + i % 2), start.replace(minute=i))
+            for i in range(3)
+        ]
+    )
+    assert size == 124
+
+
+def test_disconnect_error_does_not_hide_the_fetch_error(monkeypatch, caplog):
+    class BrokenZK:
+        def __init__(self, *args, **kwargs):
+            pass
+
+        async def connect(self):
+            return self
+
+        async def disable_device(self):
+            raise ConnectionResetError("stream broken")
+
+        async def disconnect(self):
+            raise ConnectionResetError("still broken")
+
+    monkeypatch.setattr(async_engine, "AsyncZK", BrokenZK)
+    monkeypatch.setattr(async_engine, "error_logger", logging.getLogger("test"))
+    with pytest.raises(Exception, match="Device fetch failed") as e:
+        asyncio.run(async_engine.get_all_attendance_from_device("10.0.0.1"))
+    assert "stream broken" in str(e.value.__context__)
+    assert "exception when disconnecting" in caplog.text
+
+
+def test_acquire_wakes_up_on_release():
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=1)
+
+    async def push():
+        first = await async_engine.acquire(limiter)
+        waiting = asyncio.ensure_future(async_engine.acquire(limiter))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        started = time.monotonic()
+        async_engine.release(limiter, first, 200)
+        await waiting
+        return time.monotonic() - started
+
+    # try_acquire asks to wait 1 second while the request is in flight
+    assert asyncio.run(push()) < 0.5
@@ -0,0 +1,94 @@
+"""iter_attendance_records must decode exactly what pyzk's get_attendance()
+does, for each of the three attendance record sizes."""
+
+import datetime
+import random
+import struct
+
+import pytest
+
+zk = pytest.importorskip("zk")
+from zk.user import User  # noqa: E402
+
+import erpnext_sync  # noqa: E402
+
+
+def encode_device_time(d):
+    return (
+        ((d.year % 100) * 12 * 31 + (d.month - 1) * 31 + d.day - 1) * 86400
+        + (d.hour * 60 + d.minute) * 60
+        + d.second
+    )
+
+
+def attendance_buffer(record_size, count, seed=0):
+    rng = random.Random(seed)
+    records = []
+    for _ in range(count):
+        timestamp = encode_device_time(
+            datetime.datetime(2024, 1, 1)
+            + datetime.timedelta(seconds=rng.randint(0, 10**7))
+        )
+        if record_size == 8:
+            records.append(
+                struct.pack(
+                    "<HBIB", rng.randint(1, 60), 1, timestamp, rng.choice([0, 1, 4, 5])
+                )
+            )
+        elif record_size == 16:
+            records.append(
+                struct.pack(
+                    "<IIBB2sI",
+                    rng.randint(1, 60),
+                    timestamp,
+                    1,
+                    rng.choice([0, 1]),
+                    b"\0\0",
+                    0,
+                )
+            )
+        else:
+            user_id = str(rng.randint(1, 900)).encode()
+            records.append(
+                struct.pack(
+                    "<H24sBIB8s",
+                    rng.randint(1, 60),
+                    user_id,
+                    15,
+                    timestamp,
+                    0,
+                    b"\0" * 8,
+                )
+            )
+    body = b"".join(records)
+    # a trailing partial record is ignored
+    return struct.pack("I", len(body)) + body + b"\x01\x02"
+
+
+def fake_device(record_size, count):
+    buffer = attendance_buffer(record_size, count, seed=record_size)
+    users = [User(i, "", 0, user_id=str(i * 10 if i % 3 else i)) for i in range(1, 50)]
+    conn = zk.ZK("127.0.0.1")
+    conn.read_sizes = lambda: None
+    conn.records = count
+    conn.get_users = lambda: users
+    conn.read_with_buffer = lambda command, fct=0, ext=0: (buffer, len(buffer))
+    return conn
+
+
+@pytest.mark.parametrize("record_size", [8, 16, 40])
+def test_matches_pyzk_get_attendance(record_size, monkeypatch):
+    # several decode chunks, the last one partial
+    monkeypatch.setattr(erpnext_sync, "ATTENDANCE_DECODE_CHUNK", 64)
+    conn = fake_device(record_size, 1000)
+    expected = [attendance.__dict__ for attendance in conn.get_attendance()]
+    records = list(erpnext_sync.iter_attendance_records(conn))
+    assert records == expected
+    # same key order, so the JSON column of the attendance logs is unchanged
+    assert [list(record) for record in records] == [list(x) for x in expected]
+
+
+def test_no_records():
+    conn = fake_device(8, 10)
+    conn.records = 0
+    assert list(erpnext_sync.iter_attendance_records(conn)) == []
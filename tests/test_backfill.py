@@ -0,0 +1,150 @@
+import logging
+import os
+import types
+
+import pytest
+
+import backfill
+import erpnext_sites
+import erpnext_sync
+
+
+class FakeERPNext:
+    """send_to_erpnext that fails the punches of the users in errors."""
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+        self.sites = []
+
+    def __call__(self, user_id, timestamp, device_id, log_type, site=None):
+        self.sent.append((user_id, timestamp))
+        self.sites.append((site, user_id))
+        if user_id in self.errors:
+            return 417, self.errors[user_id]
+        return 200, "EMP-CKIN-" + user_id
+
+
+@pytest.fixture
+def erpnext(monkeypatch, tmp_path, fake_status):
+    fake = FakeERPNext()
+    monkeypatch.setattr(erpnext_sync, "send_to_erpnext", fake)
+    monkeypatch.setattr(erpnext_sync, "get_punch_direction", lambda *args: None)
+    monkeypatch.setattr(
+        erpnext_sync,
+        "is_allowlisted_error",
+        lambda message: erpnext_sync.DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE
+        in message,
+    )
+    monkeypatch.setattr(erpnext_sync, "record_push_limiter_metrics", lambda: None)
+    monkeypatch.setattr(
+        erpnext_sync, "config", types.SimpleNamespace(LOGS_DIRECTORY=str(tmp_path))
+    )
+    monkeypatch.setattr(backfill, "config", types.SimpleNamespace(devices=[]))
+    monkeypatch.setattr(backfill, "status", fake_status)
+    monkeypatch.setattr(erpnext_sites, "_sites", {})
+    monkeypatch.setattr(backfill, "info_logger", logging.getLogger("test"))
+    monkeypatch.setattr(backfill, "error_logger", logging.getLogger("test"))
+    return fake
+
+
+def write_attlog(path, users):
+    with open(path, "w") as f:
+        for minute, user_id in enumerate(users):
+            f.write(f"{user_id:>8}\t2024-01-01 08:{minute:02d}:00\t1\t0\t0\t0\n")
+
+
+def test_sorted_unique_records_merges_spilled_runs(tmp_path):
+    records = [(t % 7, str(t % 3), None, 0, 1) for t in range(40, 0, -1)]
+    unique, total = backfill.sorted_unique_records(
+        records, chunk_size=5, temp_dir=str(tmp_path)
+    )
+    # 8 sorted runs of 5, each key repeated across several of them
+    assert len(os.listdir(tmp_path)) == 8
+    unique = list(unique)
+    assert total == len(unique) == 21
+    assert unique == sorted({(r[0], r[1]): r for r in records}.values())
+    assert os.listdir(tmp_path) == []
+
+
+def test_sorted_unique_records_in_memory(tmp_path):
+    records = [(2.0, "a", 1, 0, 1), (1.0, "b", 2, 0, 1), (2.0, "a", 1, 0, 1)]
+    unique, total = backfill.sorted_unique_records(records, temp_dir=str(tmp_path))
+    assert (list(unique), total) == ([records[1], records[0]], 2)
+    assert os.listdir(tmp_path) == []
+
+
+def test_halts_and_resumes_from_checkpoint(erpnext, tmp_path):
+    path = str(tmp_path / "attlog.dat")
+    write_attlog(path, ["1", "2", "3", "4", "5"])
+    erpnext.errors = {"3": "ValidationError: not allowlisted"}
+    with pytest.raises(backfill.BackfillHalted, match="not allowlisted"):
+        backfill.backfill([path], device_id="A", concurrency=1)
+    checkpoint = backfill.status["A_backfill_checkpoint"]["checkpoint"]
+    assert checkpoint[1] == "2"
+
+    erpnext.errors = {}
+    erpnext.sent = []
+    pushed, skipped = backfill.backfill([path], device_id="A", concurrency=1)
+    assert [user_id for user_id, _ in erpnext.sent] == ["3", "4", "5"]
+    assert (pushed, skipped) == (3, 2)
+
+    # a changed input is pushed again from the start
+    write_attlog(path, ["1", "2", "3", "4", "5", "6"])
+    erpnext.sent = []
+    assert backfill.backfill([path], device_id="A", concurrency=1) == (6, 0)
+
+
+def test_allowlisted_errors_do_not_halt(erpnext, tmp_path):
+    path = str(tmp_path / "attlog.dat")
+    write_attlog(path, ["1", "2", "3"])
+    erpnext.errors = {"2": erpnext_sync.DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE}
+    assert backfill.backfill([path], device_id="A", concurrency=2) == (3, 0)
+    assert backfill.status["A_backfill_checkpoint"]["checkpoint"][1] == "3"
+
+
+def test_outcomes_go_to_the_backfill_log(erpnext, tmp_path, caplog):
+    path = str(tmp_path / "attlog.dat")
+    write_attlog(path, ["1", "2"])
+    erpnext.errors = {"2": erpnext_sync.DUPLICATE_EMPLOYEE_CHECKIN_ERROR_MESSAGE}
+    backfill.backfill([path], device_id="BFLOG", concurrency=1)
+    lines = [
+        (record.name, record.levelname, *record.getMessage().split("\t")[:3:2])
+        for record in caplog.records
+        if record.name.startswith("attendance_")
+    ]
+    assert lines == [
+        ("attendance_backfill_log_BFLOG", "INFO", "EMP-CKIN-1", "1"),
+        ("attendance_backfill_log_BFLOG", "INFO", backfill.DUPLICATE_MARKER, "2"),
+    ]
+
+
+def test_backfill_routes_punches_to_sites(erpnext, tmp_path, monkeypatch, caplog):
+    caplog.set_level(logging.INFO, logger="test")
+    monkeypatch.setattr(erpnext_sites, "_sites", {"a": None, "b": None})
+    monkeypatch.setattr(
+        erpnext_sites,
+        "_router",
+        erpnext_sites.PunchRouter(
+            [{"site": "a", "prefixes": ["1"]}, {"site": "b", "prefixes": ["2"]}]
+        ),
+    )
+    path = str(tmp_path / "attlog.dat")
+    write_attlog(path, ["11", "21", "3", "12"])
+    assert backfill.backfill([path], device_id="A", concurrency=1) == (3, 0)
+    assert erpnext.sites == [("a", "11"), ("a", "12"), ("b", "21")]
+    assert backfill.status["a:A_backfill_checkpoint"]["checkpoint"][1] == "12"
+    assert backfill.status["b:A_backfill_checkpoint"]["checkpoint"][1] == "21"
+    assert "A_backfill_checkpoint" not in backfill.status
+    assert "Punches matching no site in PUNCH_ROUTES:\tA\t1" in caplog.text
+    assert {
+        record.name for record in caplog.records if record.name.startswith("a")
+    } == {"a/attendance_backfill_log_A"}
+    assert (tmp_path / "b" / "attendance_backfill_log_A.log").exists()
+
+    # --site b only
+    erpnext.sites = []
+    assert backfill.backfill(
+        [path], device_id="A", concurrency=1, sites=["b"], restart=True
+    ) == (1, 0)
+    assert erpnext.sites == [("b", "21")]
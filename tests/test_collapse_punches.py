@@ -0,0 +1,66 @@
+import datetime
+import logging
+import types
+
+import pytest
+
+import erpnext_sync
+
+T0 = datetime.datetime(2026, 10, 1, 8, 0, 0)
+
+
+@pytest.fixture(autouse=True)
+def no_local_config(monkeypatch):
+    monkeypatch.setattr(erpnext_sync, "config", types.SimpleNamespace())
+    monkeypatch.setattr(erpnext_sync, "info_logger", logging.getLogger(__name__))
+
+
+def punch(user_id, seconds, punch_value):
+    return {
+        "uid": int(user_id),
+        "user_id": user_id,
+        "timestamp": T0 + datetime.timedelta(seconds=seconds),
+        "status": 1,
+        "punch": punch_value,
+    }
+
+
+def device(device_id, punch_direction="AUTO"):
+    return {"device_id": device_id, "punch_direction": punch_direction}
+
+
+def test_disabled_without_window():
+    logs = [punch("1", 0, 0), punch("1", 1, 0)]
+    assert erpnext_sync.collapse_punches([(device("A"), logs)], None) == {}
+
+
+def test_keeps_first_in_and_last_out_across_devices():
+    a = [punch("1", 0, 0), punch("1", 5, 0), punch("1", 3600, 1), punch("1", 3620, 1)]
+    b = [punch("1", 20, 0), punch("1", 3610, 1)]
+    suppressed = erpnext_sync.collapse_punches([(device("A"), a), (device("B"), b)], 60)
+    assert set(suppressed) == {id(a[1]), id(b[0]), id(a[2]), id(b[1])}
+    assert suppressed[id(b[0])] == {"device_id": "A", "log": a[0]}
+    assert suppressed[id(b[1])] == {"device_id": "A", "log": a[3]}
+
+
+def test_windows_start_at_the_first_punch():
+    # 0 and 50 collapse; 100 is 100 s after the window start, so it opens a new one
+    logs = [punch("1", 0, 0), punch("1", 50, 0), punch("1", 100, 0)]
+    suppressed = erpnext_sync.collapse_punches([(device("A"), logs)], 60)
+    assert set(suppressed) == {id(logs[1])}
+
+
+def test_in_and_out_in_one_window_are_both_kept():
+    logs = [punch("1", 0, 0), punch("1", 30, 1)]
+    assert erpnext_sync.collapse_punches([(device("A"), logs)], 60) == {}
+
+
+def test_users_are_independent():
+    logs = [punch("1", 0, 0), punch("2", 1, 0)]
+    assert erpnext_sync.collapse_punches([(device("A"), logs)], 60) == {}
+
+
+def test_punches_without_direction_keep_the_first():
+    logs = [punch("1", 0, 0), punch("1", 10, 0)]
+    suppressed = erpnext_sync.collapse_punches([(device("A", None), logs)], 60)
+    assert suppressed == {id(logs[1]): {"device_id": "A", "log": logs[0]}}
@@ -0,0 +1,124 @@
+"""Two host processes sharing a lease directory. Time is passed in
+explicitly, so that expiry does not depend on the speed of the test."""
+
+import multiprocessing
+import time
+import types
+
+import pytest
+
+import device_leases
+import erpnext_sync
+
+DEVICES = ["A", "B", "C", "D"]
+LEASE_SECONDS = 60
+
+
+def serve(path, holder, commands, results):
+    store = device_leases.LeaseStore(path, holder, LEASE_SECONDS)
+    for method, args in iter(commands.get, None):
+        results.put(getattr(store, method)(*args))
+
+
+class Host:
+    def __init__(self, context, path, holder):
+        self.commands = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(
+            target=serve, args=(path, holder, self.commands, self.results)
+        )
+        self.process.start()
+
+    def send(self, method, *args):
+        self.commands.put((method, args))
+
+    def result(self):
+        return self.results.get(timeout=30)
+
+    def call(self, method, *args):
+        self.send(method, *args)
+        return self.result()
+
+    def claim(self, now):
+        held, _ = self.call("claim", DEVICES, now)
+        return set(held)
+
+    def stop(self):
+        self.commands.put(None)
+        self.process.join(30)
+
+
+@pytest.fixture
+def hosts(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    path = str(tmp_path / device_leases.LEASE_FILE)
+    # the tables are created before the hosts race for them
+    device_leases.LeaseStore(path, "setup", LEASE_SECONDS)
+    started = [Host(context, path, holder) for holder in ("host-1", "host-2")]
+    yield started
+    for host in started:
+        if host.process.is_alive():
+            host.process.kill()
+
+
+def test_devices_are_split_and_taken_over(hosts):
+    first, second = hosts
+    assert first.claim(now=0) == set(DEVICES)
+    # the second host joins: nothing is free yet
+    assert second.claim(now=1) == set()
+    # the first host gives up what is above its share...
+    assert len(first.claim(now=2)) == 2
+    # ...and the second one takes it
+    assert len(second.claim(now=3)) == 2
+    assert first.claim(now=4) | second.claim(now=5) == set(DEVICES)
+    assert not first.claim(now=6) & second.claim(now=7)
+
+    # the first host stops without releasing anything
+    first.process.kill()
+    assert len(second.claim(now=8 + LEASE_SECONDS / 2)) == 2
+    # its leases and heartbeat expire after one lease period
+    assert second.claim(now=7 + LEASE_SECONDS) == set(DEVICES)
+
+
+def test_concurrent_claims_never_overlap(hosts):
+    for now in range(20):
+        for host in hosts:
+            host.send("claim", DEVICES, now)
+        held = [set(host.result()[0]) for host in hosts]
+        assert not held[0] & held[1]
+    assert held[0] | held[1] == set(DEVICES)
+    assert len(held[0]) == len(held[1]) == 2
+
+
+def test_state_is_handed_over(hosts):
+    first, second = hosts
+    first.claim(now=0)
+    watermark = {"A_push_watermark": {"user_id": "7", "timestamp": 100.0}}
+    first.call("save_state", "A", watermark)
+    first.process.kill()
+    _, acquired = second.call("claim", DEVICES, 1 + LEASE_SECONDS)
+    assert "A" in acquired
+    assert second.call("load_state", "A") == watermark
+
+
+def test_pushes_stop_before_the_leases_expire(tmp_path, monkeypatch):
+    store = device_leases.LeaseStore(
+        str(tmp_path / device_leases.LEASE_FILE), "host-1", LEASE_SECONDS
+    )
+    assert store.push_deadline() is None
+    store.claim(DEVICES, now=0)
+    margin = device_leases.LEASE_MARGIN * LEASE_SECONDS
+    assert store.push_deadline(now=10) == pytest.approx(LEASE_SECONDS - margin - 10)
+
+    # the cycle deadline is capped by the leases, with or without
+    # PUSH_CYCLE_MINUTES
+    store.claim(DEVICES)
+    monkeypatch.setattr(device_leases, "_store", store)
+    config = types.SimpleNamespace(DEVICE_LEASE_DIRECTORY=str(tmp_path))
+    monkeypatch.setattr(erpnext_sync, "config", config)
+    lease_end = time.monotonic() + LEASE_SECONDS - margin
+    assert erpnext_sync.push_deadline() == pytest.approx(lease_end, abs=1)
+    config.PUSH_CYCLE_MINUTES = 60
+    assert erpnext_sync.push_deadline() == pytest.approx(lease_end, abs=1)
+    config.PUSH_CYCLE_MINUTES = 0.5
+    assert erpnext_sync.push_deadline() == pytest.approx(time.monotonic() + 30, abs=1)
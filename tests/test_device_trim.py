@@ -0,0 +1,105 @@
+import contextlib
+import datetime
+import logging
+import types
+
+import pytest
+
+import device_trim
+
+NIGHT = datetime.datetime(2026, 10, 19, 2, 30)
+DEVICE = {"device_id": "A", "ip": "10.0.0.1", "clear_from_device_on_fetch": False}
+
+
+class FakeConn:
+    def __init__(self, records):
+        self.records = records
+        self.calls = []
+
+    def __getattr__(self, name):
+        def call():
+            self.calls.append(name)
+
+        return call
+
+    def clear_attendance(self):
+        self.calls.append("clear_attendance")
+        self.records = 0
+
+
+@pytest.fixture
+def device(monkeypatch, fake_status):
+    fake = types.SimpleNamespace(
+        status=fake_status, conn=FakeConn(records=5000), connected=[]
+    )
+
+    @contextlib.contextmanager
+    def device_connection(ip):
+        fake.connected.append(ip)
+        yield fake.conn
+
+    monkeypatch.setattr(device_trim, "status", fake.status)
+    monkeypatch.setattr(device_trim, "info_logger", logging.getLogger("test"))
+    monkeypatch.setattr(
+        device_trim,
+        "config",
+        types.SimpleNamespace(
+            DEVICE_TRIM_THRESHOLD=1000, DEVICE_TRIM_WINDOW=("01:00", "05:00")
+        ),
+    )
+    monkeypatch.setattr(
+        device_trim.erpnext_sync, "device_connection", device_connection
+    )
+    return fake
+
+
+def test_in_window_across_midnight():
+    window = ("22:00", "04:00")
+    assert device_trim.in_window(NIGHT.replace(hour=23), window)
+    assert device_trim.in_window(NIGHT.replace(hour=1), window)
+    assert not device_trim.in_window(NIGHT.replace(hour=12), window)
+
+
+def test_trims_once_pushed_and_records_the_gain(device):
+    device_trim.record_fetch("A", 5000, 42.0, archived=False)
+    assert device_trim.trim_devices([(DEVICE, None)], now=NIGHT) == {"A"}
+    # the device stays disabled from the size check to the clear
+    assert device.conn.calls == [
+        "disable_device",
+        "read_sizes",
+        "clear_attendance",
+        "read_sizes",
+        "enable_device",
+    ]
+    device_trim.record_fetch("A", 3, 0.5, archived=False)
+    trim = device.status["A_trim"]
+    assert (trim["records_before"], trim["records_after"]) == (5000, 0)
+    assert (trim["fetch_seconds_before"], trim["fetch_seconds_after"]) == (42.0, 0.5)
+
+
+@pytest.mark.parametrize(
+    "records_fetched, archived, unfinished, now",
+    [
+        (500, True, (), NIGHT),  # under the threshold
+        (5000, True, (), NIGHT.replace(hour=9)),  # outside the window
+        (5000, False, {"A"}, NIGHT),  # not pushed yet
+        (4990, True, (), NIGHT),  # new punches since the fetch
+    ],
+)
+def test_not_trimmed(device, records_fetched, archived, unfinished, now):
+    device_trim.record_fetch("A", records_fetched, 42.0, archived)
+    assert device_trim.trim_devices([(DEVICE, None)], (), unfinished, now) == set()
+    assert "clear_attendance" not in device.conn.calls
+    assert "A_trim" not in device.status
+
+
+@pytest.mark.parametrize("failed, unfinished", [({"A"}, ()), ((), {"A"})])
+def test_archived_punches_are_not_trimmed_before_they_are_pushed(
+    device, failed, unfinished
+):
+    # the archive alone is not enough: ERPNext still misses these punches
+    device_trim.record_fetch("A", 5000, 42.0, archived=True)
+    assert (
+        device_trim.trim_devices([(DEVICE, None)], failed, unfinished, NIGHT) == set()
+    )
+    assert device.conn.calls == []
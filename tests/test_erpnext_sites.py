@@ -0,0 +1,57 @@
+import types
+
+import pytest
+
+import erpnext_sites
+
+
+def test_route_precedence():
+    router = erpnext_sites.PunchRouter(
+        [
+            {"site": "a", "ranges": [[1000, 1999], [5000, 5000]]},
+            {"site": "b", "prefixes": ["1", "B"], "user_ids": ["1500"]},
+            {"site": "c", "prefixes": ["B7"]},
+        ],
+        default_site="d",
+    )
+    assert router.site_for("1500") == "b"  # explicit before range
+    assert router.site_for(1234) == "a"
+    assert router.site_for("5000") == "a"
+    assert router.site_for("2000") == "d"
+    assert router.site_for("15") == "b"  # prefix
+    assert router.site_for("B71") == "c"  # longest prefix
+    assert router.site_for("B1") == "b"
+    assert erpnext_sites.PunchRouter([]).site_for("1") is None
+
+
+def test_overlapping_ranges_are_rejected():
+    with pytest.raises(ValueError):
+        erpnext_sites.PunchRouter(
+            [
+                {"site": "a", "ranges": [[1, 10]]},
+                {"site": "b", "ranges": [[10, 20]]},
+            ]
+        )
+
+
+def test_split(monkeypatch):
+    monkeypatch.setattr(erpnext_sites, "_sites", {"a": None, "b": None})
+    monkeypatch.setattr(
+        erpnext_sites,
+        "_router",
+        erpnext_sites.PunchRouter([{"site": "b", "prefixes": ["2"]}], "a"),
+    )
+    logs = [{"user_id": "1"}, {"user_id": "2"}, {"user_id": "21"}]
+    by_site, unrouted = erpnext_sites.split(logs)
+    assert by_site == {"a": [logs[0]], "b": logs[1:]}
+    assert unrouted == 0
+    assert erpnext_sites.push_key("HO1", "b") == "b:HO1"
+    assert erpnext_sites.push_key("HO1") == "HO1"
+
+
+def test_single_site_without_config(monkeypatch):
+    monkeypatch.setattr(erpnext_sites, "config", types.SimpleNamespace())
+    monkeypatch.setattr(erpnext_sites, "_sites", None)
+    logs = [{"user_id": "1"}]
+    assert erpnext_sites.split(logs) == ({None: logs}, 0)
+    assert erpnext_sites.site_names() == []
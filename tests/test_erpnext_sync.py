@@ -0,0 +1,21 @@
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_is_lazy():
+    # in a fresh interpreter, as other tests import these modules
+    modules = ["local_config", "requests", "pickledb", "zk", "thai_strftime"]
+    loaded = subprocess.check_output(
+        [
+            sys.executable,
+            "-c",
+            "import sys, erpnext_sync; print(' '.join(m for m in %r if m in sys.modules))"
+            % modules,
+        ],
+        cwd=ROOT,
+        text=True,
+    )
+    assert loaded.split() == []
@@ -0,0 +1,93 @@
+import datetime
+import random
+
+import pytest
+
+import erpnext_sites
+import freshness
+
+
+@pytest.fixture
+def status(monkeypatch, fake_status):
+    fake_status["lift_off_timestamp"] = "2026-10-01 08:00:00.000000"
+    monkeypatch.setattr(freshness, "status", fake_status)
+    return fake_status
+
+
+def exact_quantile(values, q):
+    return sorted(values)[int(q * (len(values) - 1))]
+
+
+def test_quantiles_within_relative_accuracy():
+    rng = random.Random(1)
+    values = [rng.lognormvariate(5, 1.5) for _ in range(20000)]
+    sketch = freshness.LagSketch()
+    for value in values:
+        sketch.add(value)
+    for q in (0.5, 0.9, 0.95, 0.99):
+        expected = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - expected) <= 0.011 * expected
+    assert sketch.max == max(values)
+    assert len(sketch.buckets) < 1000
+
+
+def test_merge_and_round_trip():
+    a, b, both = freshness.LagSketch(), freshness.LagSketch(), freshness.LagSketch()
+    for i in range(1, 1000):
+        (a if i % 2 else b).add(i)
+        both.add(i)
+    a.merge(freshness.LagSketch.from_dict(b.to_dict()))
+    assert a.to_dict() == both.to_dict()
+
+
+def test_memory_is_bounded():
+    sketch = freshness.LagSketch(max_buckets=10)
+    for i in range(1, 100000, 7):
+        sketch.add(i)
+    assert len(sketch.buckets) == 10
+    # the high quantiles keep their accuracy
+    assert abs(sketch.quantile(0.99) - 99000) < 0.011 * 99000
+
+
+def test_record_per_cycle_and_day(status):
+    lags = freshness.LagSketch()
+    for lag in (0.2, 30, 60, 600):
+        lags.add(lag)
+    oldest = datetime.datetime.now() - datetime.timedelta(minutes=20)
+    freshness.record("A", lags.drain(), oldest)
+    assert lags.count == 0
+
+    status["lift_off_timestamp"] = "2026-10-01 09:00:00.000000"
+    lags.add(120)
+    freshness.record("A", lags.drain(), None)
+
+    result = freshness.device_freshness("A")
+    assert result["cycle"]["count"] == 1
+    assert result["day"]["count"] == 5
+    assert result["day"]["max"] == 600
+    assert result["oldest_unpushed_age"] is None
+    assert freshness.device_freshness("B")["day"]["p95"] is None
+
+
+def test_record_cycle_clears_and_marks_stale(status, monkeypatch):
+    monkeypatch.setattr(erpnext_sites, "site_names", lambda: [])
+    oldest = datetime.datetime.now() - datetime.timedelta(minutes=20)
+    for device_id in "ABC":
+        freshness.record(device_id, freshness.LagSketch(), oldest)
+
+    # A had nothing left to push, B's pushes failed, C could not be read
+    freshness.record_cycle(["A", "B"], ["A"], ["C"], now=1000.0)
+    assert status["A_freshness"]["oldest_unpushed"] is None
+    assert status["B_freshness"]["oldest_unpushed"] == oldest.timestamp()
+    assert status["C_freshness"]["stale"]
+
+    freshness.record_cycle([], [], ["A"], now=2000.0)
+    # A was last read at 1000
+    result = freshness.device_freshness("A", now=2600.0)
+    assert result["stale_age"] == 1600.0
+    assert result["oldest_unpushed_age"] is None
+    # pushes keep the fetch state
+    freshness.record("A", freshness.LagSketch(), None)
+    assert freshness.device_freshness("A", now=2600.0)["stale_age"] == 1600.0
+    freshness.record_cycle(["A"], ["A"], [], now=3000.0)
+    assert freshness.device_freshness("A", now=3600.0)["stale_age"] is None
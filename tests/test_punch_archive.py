@@ -0,0 +1,130 @@
+import datetime
+import os
+import time
+
+import punch_archive
+
+T0 = datetime.datetime(2026, 9, 1, 8, 0, 0)
+
+
+def record(seconds, user_id="1", uid=1, punch=0, status=1):
+    return (
+        (T0 + datetime.timedelta(seconds=seconds)).timestamp(),
+        user_id,
+        uid,
+        punch,
+        status,
+    )
+
+
+def test_segment_round_trip():
+    records = [record(0), record(5, "22", "22", None, 15), record(5, "7", 7, 255, 0)]
+    records.sort(key=punch_archive._sort_key)
+    decoded = punch_archive.decode_segment(punch_archive.encode_segment(records))
+    # 255 is the stored form of None
+    assert decoded[0] == records[0]
+    assert decoded[1] == (records[1][0], "22", "22", None, 15)
+    assert decoded[2] == (records[2][0], "7", 7, None, 0)
+
+
+def test_append_skips_punches_already_archived(tmp_path):
+    directory = str(tmp_path)
+    assert punch_archive.append(directory, "A", [record(0), record(60)]) == 2
+    # a device that is not cleared returns everything again
+    assert (
+        punch_archive.append(directory, "A", [record(0), record(60), record(120)]) == 1
+    )
+    assert punch_archive.append(directory, "A", [record(60)]) == 0
+    assert [r[0] for r in punch_archive.iter_records(directory, "A")] == [
+        record(0)[0],
+        record(60)[0],
+        record(120)[0],
+    ]
+
+
+def test_append_keeps_punches_older_than_the_high_water_mark(tmp_path):
+    directory = str(tmp_path)
+    history = [record(0), record(60), record(120)]
+    assert punch_archive.append(directory, "A", history) == 3
+    # the device clock was set back: the next punch is recorded "earlier"
+    history.append(record(30, "2"))
+    assert punch_archive.append(directory, "A", history) == 1
+    # a cleared device only returns new punches, older ones included
+    assert punch_archive.append(directory, "A", [record(90, "3"), record(150)]) == 2
+    assert punch_archive.append(directory, "A", [record(90, "3"), record(150)]) == 0
+    assert [(r[0], r[1]) for r in punch_archive.iter_records(directory, "A")] == [
+        (record(0)[0], "1"),
+        (record(30)[0], "2"),
+        (record(60)[0], "1"),
+        (record(90)[0], "3"),
+        (record(120)[0], "1"),
+        (record(150)[0], "1"),
+    ]
+
+
+def test_partitions_by_day_and_range_queries(tmp_path):
+    directory = str(tmp_path)
+    day = 86400
+    punch_archive.append(
+        directory, "A", [record(0, "1"), record(day, "2"), record(2 * day, "3")]
+    )
+    assert len(os.listdir(tmp_path / "A")) == 3
+    since = T0 + datetime.timedelta(days=1)
+    until = T0 + datetime.timedelta(days=2)
+    assert [r[1] for r in punch_archive.iter_records(directory, "A", since, until)] == [
+        "2"
+    ]
+    assert [
+        r[1] for r in punch_archive.iter_records(directory, "A", user_ids={"3"})
+    ] == ["3"]
+    assert punch_archive.stats(directory, "A") == (3, record(0)[0], record(2 * day)[0])
+    assert list(punch_archive.iter_records(directory, "B")) == []
+
+
+def test_compaction(tmp_path, monkeypatch):
+    monkeypatch.setattr(punch_archive, "MAX_SEGMENTS", 3)
+    directory = str(tmp_path)
+    for i in range(5):
+        punch_archive.append(directory, "A", [record(10 * i)])
+    (partition,) = punch_archive.partitions(directory, "A")
+    segments = punch_archive._read_index(partition)["segments"]
+    assert len(segments) <= 3
+    assert sorted(f for f in os.listdir(partition) if f.endswith(".seg")) == sorted(
+        s["file"] for s in segments
+    )
+    assert len(list(punch_archive.iter_records(directory, "A"))) == 5
+
+
+def test_full_history_does_not_reopen_old_partitions(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    day = 86400
+    history = [record(i * day) for i in range(5)]
+    punch_archive.append(directory, "A", history)
+    opened = []
+    read_index = punch_archive._read_index
+    monkeypatch.setattr(
+        punch_archive,
+        "_read_index",
+        lambda partition: opened.append(partition) or read_index(partition),
+    )
+    # the next fetch returns the whole history again, plus a new punch
+    assert punch_archive.append(directory, "A", history + [record(4 * day + 60)]) == 1
+    assert [os.path.basename(p) for p in opened] == [
+        (T0 + datetime.timedelta(days=4)).strftime("%Y-%m-%d")
+    ]
+    assert punch_archive.device_ids(directory) == ["A"]
+    assert len(list(punch_archive.iter_records(directory, "A"))) == 6
+
+
+def test_partition_day_at_half_hour_midnight(monkeypatch):
+    monkeypatch.setenv("TZ", "Asia/Kolkata")
+    time.tzset()
+    try:
+        midnight = datetime.datetime(2024, 1, 2).timestamp()
+        assert midnight % 3600 == 1800  # +05:30
+        days = {}
+        assert punch_archive._partition_day(midnight - 600, days) == "2024-01-01"
+        assert punch_archive._partition_day(midnight + 600, days) == "2024-01-02"
+    finally:
+        monkeypatch.undo()
+        time.tzset()
@@ -0,0 +1,118 @@
+import datetime
+import email.utils
+
+import pytest
+
+import push_limiter
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(push_limiter.time, "monotonic", clock)
+    return clock
+
+
+def push(limiter, clock, status_code=200, latency=0.1, retry_after=None):
+    token, wait_for = limiter.try_acquire()
+    assert token is not None, wait_for
+    clock.now += latency
+    limiter.release(token, status_code, retry_after)
+
+
+def test_additive_increase(clock):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=2, max_limit=4)
+    for expected in [3, 4]:
+        for _ in range(limiter.limit):
+            push(limiter, clock)
+        assert limiter.limit == expected
+    for _ in range(10):
+        push(limiter, clock)
+    assert limiter.limit == 4
+
+
+@pytest.mark.parametrize("status_code", [429, 503, None])
+def test_multiplicative_decrease_once_per_round(clock, status_code):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=8, latency_target=0.5)
+    push(limiter, clock, status_code)
+    assert limiter.limit == 4
+    # a burst of errors from requests already in flight cuts it once
+    push(limiter, clock, status_code)
+    assert limiter.limit == 4
+    clock.now += 1
+    push(limiter, clock, status_code)
+    assert limiter.limit == 2
+    clock.now += 1
+    push(limiter, clock, status_code)
+    push(limiter, clock, status_code)
+    assert limiter.limit == 1
+    assert limiter.snapshot()["throttled"] == 5
+
+
+def test_decrease_on_latency_over_target(clock):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=8, latency_target=0.5)
+    push(limiter, clock, latency=0.9)
+    assert limiter.limit == 4
+
+
+def test_limits_requests_in_flight(clock):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=2)
+    tokens = [limiter.try_acquire()[0] for _ in range(2)]
+    assert limiter.try_acquire()[0] is None
+    limiter.release(tokens[0], 200)
+    assert limiter.try_acquire()[0] is not None
+
+
+def test_retry_after_seconds_pauses_every_request(clock):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=4)
+    push(limiter, clock, 429, retry_after="30")
+    assert limiter.try_acquire() == (None, pytest.approx(30.0))
+    clock.now += 30
+    assert limiter.try_acquire()[0] is not None
+
+
+def test_retry_after_http_date(clock):
+    retry_at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+        seconds=120
+    )
+    value = email.utils.format_datetime(retry_at, usegmt=True)
+    assert push_limiter.parse_retry_after(value) == pytest.approx(120, abs=2)
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=4)
+    push(limiter, clock, 503, retry_after=value)
+    token, wait_for = limiter.try_acquire()
+    assert token is None and wait_for == pytest.approx(120, abs=2)
+
+
+@pytest.mark.parametrize(
+    "value, expected",
+    [(None, None), ("", None), ("-5", 0.0), ("soon", None), ("1.5", 1.5)],
+)
+def test_parse_retry_after(value, expected):
+    assert push_limiter.parse_retry_after(value) == expected
+
+
+def test_parse_retry_after_past_date():
+    assert push_limiter.parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT") == 0.0
+
+
+def test_max_rps(clock):
+    limiter = push_limiter.AdaptiveLimiter(initial_limit=16, max_limit=16, max_rps=4)
+    started = []
+    while clock.now < 1002.0:
+        token, wait_for = limiter.try_acquire()
+        if token is None:
+            assert 0 < wait_for <= 0.25
+            clock.now += wait_for
+        else:
+            started.append(token)
+            limiter.release(token, 200)
+    assert len(started) == 8
+    assert all(b - a == pytest.approx(0.25) for a, b in zip(started, started[1:]))
@@ -0,0 +1,178 @@
+import asyncio
+import threading
+import time
+
+from push_scheduler import PushScheduler, deficit_round_robin
+
+
+def is_live(item):
+    return item >= 100
+
+
+def test_live_lane_gets_the_capacity_first():
+    order = []
+    lock = threading.Lock()
+
+    def push(item):
+        with lock:
+            order.append(item)
+        return True
+
+    items = list(range(8)) + [100, 101, 102]
+    scheduler = PushScheduler(items, push, is_live, concurrency=1, backlog_share=0)
+    scheduler.run()
+    # one slot: live items go first, the backlog drains once they are done
+    assert order == [100, 101, 102] + list(range(8))
+    assert scheduler.watermark == len(items) - 1
+    assert scheduler.acked_ahead() == []
+
+
+def test_backlog_keeps_its_share():
+    backlog_in_flight = []
+    in_flight = {"backlog": 0}
+    lock = threading.Lock()
+
+    def push(item):
+        with lock:
+            if not is_live(item):
+                in_flight["backlog"] += 1
+            backlog_in_flight.append(in_flight["backlog"])
+        time.sleep(0.005)
+        with lock:
+            if not is_live(item):
+                in_flight["backlog"] -= 1
+        return True
+
+    items = list(range(20)) + list(range(100, 140))
+    scheduler = PushScheduler(items, push, is_live, concurrency=8, backlog_share=0.25)
+    scheduler.run(limit=30)
+    # while live items were waiting, at most 2 of the 8 slots went to the backlog
+    assert max(backlog_in_flight) <= 2
+    assert scheduler.pushed == 30
+
+
+def test_watermark_with_out_of_order_acks():
+    release = threading.Event()
+
+    def push(item):
+        if item == 1:
+            release.wait(5)
+        return True
+
+    items = [0, 1, 2, 100, 101]
+    scheduler = PushScheduler(items, push, is_live, concurrency=4, backlog_share=0.5)
+    checkpoints = []
+
+    def on_checkpoint(s):
+        checkpoints.append((s.watermark, list(s.acked_ahead())))
+        if s.remaining == 0:
+            release.set()
+
+    scheduler.on_checkpoint = on_checkpoint
+    scheduler.checkpoint_interval = 0
+    scheduler.run()
+    # item 1 held the watermark at 0 while later items were acknowledged
+    assert any(w == 0 and 2 in ahead for w, ahead in checkpoints)
+    assert scheduler.watermark == 4
+    assert scheduler.acked_ahead() == []
+
+
+def test_halts_and_keeps_the_failed_item():
+    def push(item):
+        return item != 2
+
+    scheduler = PushScheduler(list(range(5)), push, is_live, concurrency=1)
+    scheduler.run()
+    assert scheduler.halted is not None
+    assert scheduler.failed == 1
+    assert scheduler.watermark == 1
+    assert scheduler.done and scheduler.remaining == 3
+
+
+def test_acknowledged_items_are_not_pushed():
+    pushed = []
+    scheduler = PushScheduler(
+        [0, 1, 2, 3],
+        lambda item: pushed.append(item) or True,
+        is_live,
+        concurrency=1,
+        acknowledged=[0, 2],
+    )
+    assert scheduler.watermark == 0
+    assert scheduler.acked_ahead() == [2]
+    scheduler.run()
+    assert pushed == [1, 3]
+    assert scheduler.watermark == 3
+
+
+def test_limit_and_deadline_resume():
+    pushed = []
+    scheduler = PushScheduler(
+        list(range(10)), lambda item: pushed.append(item) or True, is_live, 1
+    )
+    assert scheduler.run(limit=4) == 4
+    assert scheduler.run(deadline=time.monotonic() - 1) == 0
+    assert not scheduler.done
+    assert scheduler.run() == 6
+    assert pushed == list(range(10))
+    assert scheduler.done
+
+
+def test_arun_with_a_coroutine_push():
+    pushed = []
+
+    async def push(item):
+        await asyncio.sleep(0)
+        pushed.append(item)
+        return item != 102
+
+    items = list(range(6)) + [100, 101, 102]
+    scheduler = PushScheduler(items, push, is_live, concurrency=1, backlog_share=0)
+    assert asyncio.run(scheduler.arun(limit=2)) == 2
+    asyncio.run(scheduler.arun())
+    assert pushed == [100, 101, 102]
+    assert scheduler.halted is not None
+    assert scheduler.acked_ahead() == [100, 101]
+
+
+def test_deficit_round_robin_interleaves_devices():
+    order = []
+
+    def push(item):
+        order.append(item)
+        return True
+
+    big = PushScheduler(
+        [("big", i) for i in range(50)], push, lambda item: False, concurrency=1
+    )
+    small = PushScheduler(
+        [("small", i) for i in range(6)], push, lambda item: False, concurrency=1
+    )
+    for turns in deficit_round_robin([big, small], [2, 1], quantum=2):
+        for scheduler, limit in turns:
+            scheduler.run(limit)
+    # the small device is done after 3 rounds, not after the 50 items of the big one
+    assert [device for device, _ in order[:6]] == ["big"] * 4 + ["small"] * 2
+    assert order.index(("small", 5)) == 17
+    assert big.done and small.done and len(order) == 56
+
+
+def test_deficit_round_robin_stops_at_the_deadline():
+    scheduler = PushScheduler(list(range(10)), lambda item: True, is_live)
+    rounds = deficit_round_robin([scheduler], [1], quantum=3, deadline=time.monotonic())
+    assert list(rounds) == []
+    assert scheduler.remaining == 10
+
+
+def test_deficit_round_robin_rounds_run_side_by_side():
+    # the turns of a round are handed out together, so a slow device does
+    # not delay the turn of the others within the round
+    slow = PushScheduler(list(range(4)), lambda item: True, is_live)
+    fast = PushScheduler(list(range(100, 110)), lambda item: True, is_live)
+    rounds = deficit_round_robin([slow, fast], [1, 1], quantum=2)
+    turns = next(rounds)
+    assert turns == [(slow, 2), (fast, 2)]
+    # the slow device pushed one item of its turn; the unused one carries over
+    slow.run(1)
+    fast.run(2)
+    assert next(rounds) == [(slow, 3), (fast, 2)]
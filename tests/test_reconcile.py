@@ -0,0 +1,33 @@
+import reconcile
+
+
+def stream(items):
+    return [(t, user_id, (t, user_id)) for t, user_id in items]
+
+
+def test_merge_reports_both_sides():
+    local = stream([(1, "a"), (2, "a"), (2, "b"), (5, "c")])
+    remote = stream([(2, "b"), (3, "x"), (5, "c"), (9, "d")])
+    result = sorted(reconcile.merge(iter(local), iter(remote)))
+    assert result == [
+        ("missing", (1, "a")),
+        ("missing", (2, "a")),
+        ("unexpected", (3, "x")),
+        ("unexpected", (9, "d")),
+    ]
+
+
+def test_merge_counts_repeated_punches():
+    # two punches of the same user in one second, one of them in ERPNext
+    local = stream([(1, "a"), (1, "a")])
+    remote = stream([(1, "a")])
+    assert list(reconcile.merge(iter(local), iter(remote))) == [("missing", (1, "a"))]
+
+
+def test_merge_is_streaming():
+    def local():
+        yield from stream([(1, "a"), (2, "a")])
+        raise AssertionError("read past the second group")
+
+    merged = reconcile.merge(local(), iter(stream([(5, "x")])))
+    assert next(merged) == ("missing", (1, "a"))
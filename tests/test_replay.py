@@ -0,0 +1,115 @@
+import argparse
+import datetime
+import json
+import os
+
+import erpnext_sites
+import replay
+
+
+def log_line(level, first, user_id, timestamp):
+    record = {"user_id": user_id, "timestamp": str(timestamp), "punch": 0}
+    return "\t".join(
+        [
+            "2024-01-02 00:00:00,000",
+            level,
+            str(first),
+            "None",
+            user_id,
+            str(float(timestamp)),
+            "0",
+            "1",
+            json.dumps(record),
+        ]
+    )
+
+
+def write_log(path, lines):
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def make_logs(directory):
+    write_log(
+        os.path.join(directory, "attendance_success_log_A.log"),
+        [log_line("INFO", "EMP-CKIN-1", "1", 100)],
+    )
+    write_log(
+        os.path.join(directory, "attendance_replay_log_A.log"),
+        [
+            log_line("INFO", "EMP-CKIN-2", "2", 200),
+            log_line("INFO", replay.backfill.DUPLICATE_MARKER, "3", 300),
+            log_line("ERROR", "417", "4", 400),
+        ],
+    )
+    write_log(
+        os.path.join(directory, "attendance_backfill_log_A.log"),
+        [log_line("INFO", "EMP-CKIN-6", "6", 600)],
+    )
+    # older failures are in the rotated file
+    write_log(
+        os.path.join(directory, "attendance_failed_log_A.log.1"),
+        [
+            log_line("ERROR", code, user_id, t)
+            for code, user_id, t in [
+                (500, "1", 100),
+                (500, "2", 200),
+                (500, "4", 400),
+            ]
+        ],
+    )
+    write_log(
+        os.path.join(directory, "attendance_failed_log_A.log"),
+        [
+            log_line("ERROR", code, user_id, t)
+            for code, user_id, t in [
+                (500, "3", 300),
+                (500, "4", 400),
+                (500, "5", 500),
+            ]
+        ],
+    )
+
+
+def test_resolved_keys_merge_success_replayed_and_backfilled(tmp_path):
+    make_logs(str(tmp_path))
+    assert replay.resolved_keys("A", str(tmp_path)) == {
+        ("1", "100.0"),
+        ("2", "200.0"),
+        ("3", "300.0"),
+        ("6", "600.0"),
+    }
+
+
+def test_replays_only_unresolved_records_once(tmp_path):
+    make_logs(str(tmp_path))
+    resolved = replay.resolved_keys("A", str(tmp_path))
+    records = list(
+        replay.iter_replayable_records("A", resolved, logs_directory=str(tmp_path))
+    )
+    # "4" failed twice and its replay failed too: it comes out once
+    assert [(t, user_id) for t, user_id, *_ in records] == [(400.0, "4"), (500.0, "5")]
+    assert ("5", "500.0") in resolved
+
+
+def test_replay_since_until(tmp_path):
+    make_logs(str(tmp_path))
+    since = datetime.datetime.fromtimestamp(450)
+    records = replay.iter_replayable_records(
+        "A", set(), since=since, logs_directory=str(tmp_path)
+    )
+    assert [user_id for _, user_id, *_ in records] == ["5"]
+
+
+def test_device_ids_with_failed_logs(tmp_path):
+    make_logs(str(tmp_path))
+    write_log(str(tmp_path / "attendance_failed_log_B.log.3"), [])
+    assert replay.device_ids_with_failed_logs(str(tmp_path)) == ["A", "B"]
+
+
+def test_sites_include_the_root_logs(monkeypatch):
+    monkeypatch.setattr(erpnext_sites, "_sites", {"a": None, "b": None})
+    assert replay.sites(argparse.Namespace(site=None)) == [None, "a", "b"]
+    assert replay.sites(argparse.Namespace(site=["b"])) == ["b"]
+    monkeypatch.setattr(erpnext_sites, "_sites", {})
+    assert replay.sites(argparse.Namespace(site=None)) == [None]
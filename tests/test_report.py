@@ -0,0 +1,92 @@
+import datetime
+import json
+import os
+
+import report
+
+T0 = datetime.datetime(2026, 9, 1)
+
+
+def write_log(path, lines):
+    with open(path, "w") as f:
+        for first, user_id, seconds in lines:
+            timestamp = (T0 + datetime.timedelta(seconds=seconds)).timestamp()
+            record = {"uid": int(user_id), "user_id": user_id}
+            columns = ["2026-10-01 00:00:00,000", "INFO", first, user_id, user_id]
+            columns += [str(timestamp), "0", "1", json.dumps(record)]
+            f.write("\t".join(columns) + "\n")
+
+
+def make_logs(logs_directory):
+    day = 86400
+    # rotated file: day 0 and 1, current file: day 2
+    write_log(
+        os.path.join(logs_directory, "attendance_success_log_A.log.1"),
+        [("EMP-1", "1", 10), ("EMP-2", "2", 20), ("EMP-3", "1", day + 5)],
+    )
+    write_log(
+        os.path.join(logs_directory, "attendance_success_log_A.log"),
+        [("EMP-4", "2", 2 * day + 1)],
+    )
+    write_log(
+        os.path.join(logs_directory, "attendance_failed_log_A.log"),
+        [("417", "9", 30), ("417", "9", 40), ("500", "2", day + 50)],
+    )
+
+
+def test_counts(tmp_path):
+    make_logs(str(tmp_path))
+    summary = report.summarize(report.collect(str(tmp_path), workers=1))
+    assert summary["devices"] == {"A": {"success": 4, "failed": 3}}
+    assert summary["errors"] == {"A": {"417": 2, "500": 1}}
+    assert summary["users"]["A"]["9"] == {"failed": 2}
+    assert summary["days"]["A"]["2026-09-01"] == {"success": 2, "failed": 2}
+
+
+def test_time_range_uses_the_index(tmp_path, monkeypatch):
+    make_logs(str(tmp_path))
+    monkeypatch.setattr(report, "INDEX_BLOCK_LINES", 1)
+    full = report.collect(str(tmp_path), workers=1)
+    assert len(os.listdir(tmp_path / report.INDEX_DIRECTORY)) == 3
+
+    since, until = T0 + datetime.timedelta(days=1), T0 + datetime.timedelta(days=2)
+    bounded = report.collect(str(tmp_path), since=since, until=until, workers=1)
+    assert bounded["device", "A", "success"] == 1
+    assert bounded["device", "A", "failed"] == 1
+    assert sum(full.values()) > sum(bounded.values())
+
+    # with the index, a file outside the range is not read at all
+    path = str(tmp_path / "attendance_success_log_A.log")
+    index = report.load_index(str(tmp_path), path)
+    counts, new_index = report.scan_file(
+        path, "success", "A", since.timestamp(), until.timestamp(), index=index
+    )
+    assert not counts and new_index is None
+
+
+def test_index_is_rebuilt_when_the_file_changes(tmp_path):
+    make_logs(str(tmp_path))
+    report.collect(str(tmp_path), workers=1)
+    path = str(tmp_path / "attendance_success_log_A.log")
+    assert report.load_index(str(tmp_path), path) is not None
+    with open(path, "a") as f:
+        f.write("partial line\n")
+    assert report.load_index(str(tmp_path), path) is None
+
+
+def test_site_logs(tmp_path):
+    make_logs(str(tmp_path))
+    os.mkdir(tmp_path / "b")
+    write_log(
+        str(tmp_path / "b" / "attendance_success_log_A.log"), [("EMP-9", "700", 10)]
+    )
+    counts = report.collect(str(tmp_path), workers=1, sites=[None, "b"])
+    assert counts["device", "A", "success"] == 4
+    assert counts["device", "b:A", "success"] == 1
+    assert os.listdir(tmp_path / "b" / report.INDEX_DIRECTORY)
+    # without the site, its logs and indexes are left alone
+    assert (
+        "b:A"
+        not in report.summarize(report.collect(str(tmp_path), workers=1))["devices"]
+    )
+    assert os.listdir(tmp_path / "b" / report.INDEX_DIRECTORY)
@@ -0,0 +1,73 @@
+import datetime
+import types
+
+import pytest
+
+import shift_schedule
+
+DAY = datetime.date(2026, 10, 1)
+# 08:00-17:00, check-in from 07:00, check-out until 18:00
+DAY_SHIFT = {
+    "start_time": 8 * 3600,
+    "end_time": 17 * 3600,
+    "begin_check_in": 60,
+    "allow_check_out": 60,
+}
+# 22:00-06:00 on the next day
+NIGHT_SHIFT = dict(DAY_SHIFT, start_time=22 * 3600, end_time=6 * 3600)
+
+
+@pytest.fixture(autouse=True)
+def schedule_config(monkeypatch):
+    monkeypatch.setattr(
+        shift_schedule,
+        "config",
+        types.SimpleNamespace(
+            PULL_FREQUENCY=60,
+            SHIFT_POLL_MINUTES=5,
+            SHIFT_WINDOW_MINUTES=30,
+            SHIFT_SYNC_DELAY_MINUTES=1,
+        ),
+    )
+
+
+def at(hour, minute=0, day=DAY):
+    return datetime.datetime.combine(day, datetime.time(hour, minute))
+
+
+def test_parse_time():
+    assert shift_schedule.parse_time("8:00:00") == 8 * 3600
+    assert shift_schedule.parse_time("22:30:00.000000") == 22.5 * 3600
+
+
+def test_night_shift_ends_next_day():
+    opening, start, end, close = shift_schedule.shift_instants(NIGHT_SHIFT, DAY)
+    assert (opening, start) == (at(21), at(22))
+    next_day = DAY + datetime.timedelta(days=1)
+    assert end == at(6, day=next_day)
+    assert close == at(7, 1, day=next_day)
+
+
+def test_polls_rarely_between_shifts():
+    shifts = {"Day": DAY_SHIFT}
+    assert shift_schedule.next_cycle_time(shifts, at(11)) == at(12)
+    # the next cycle does not run past the check-in opening
+    assert shift_schedule.next_cycle_time(shifts, at(6, 30)) == at(7)
+
+
+def test_polls_tightly_around_transitions():
+    shifts = {"Day": DAY_SHIFT}
+    assert shift_schedule.next_cycle_time(shifts, at(7, 10)) == at(7, 15)
+    assert shift_schedule.next_cycle_time(shifts, at(16, 40)) == at(16, 45)
+    # a cycle lands right at the close, then polling is rare again
+    assert shift_schedule.next_cycle_time(shifts, at(17, 58)) == at(18, 1)
+    assert shift_schedule.next_cycle_time(shifts, at(18, 1)) == at(19, 1)
+
+
+def test_sync_due_once_per_close():
+    assert shift_schedule.sync_due(DAY_SHIFT, None, at(9))
+    assert not shift_schedule.sync_due(DAY_SHIFT, at(9), at(17, 30))
+    assert shift_schedule.sync_due(DAY_SHIFT, at(17, 30), at(18, 5))
+    assert not shift_schedule.sync_due(DAY_SHIFT, at(18, 5), at(23))
+    # the night shift that started the day before closes in the morning
+    assert shift_schedule.sync_due(NIGHT_SHIFT, at(6), at(7, 5))
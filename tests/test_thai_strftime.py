@@ -0,0 +1,250 @@
+"""Conformance tests for thai_strftime.
+
+Every directive in _NEED_L10N and every extension flag in _EXTENSIONS is
+checked against a golden table, and random format strings are checked
+against an independent reference implementation. thai_strftime(),
+compile_thai_format() and thai_strftime_many() must all agree.
+
+Per-call timings are in benchmarks/thai_strftime_bench.py.
+"""
+
+import random
+import re
+import warnings
+from datetime import datetime, timedelta
+
+import pytest
+
+import thai_strftime as ts
+from thai_strftime import compile_thai_format, thai_strftime, thai_strftime_many
+
+# Wednesday, 6 October 1976 (BE 2519), ISO year 1976
+DT = datetime(1976, 10, 6, 1, 40, 0)
+
+GOLDEN_L10N = {
+    # fmt: (buddhist era, AD)
+    "%A": ("วันพุธ", "วันพุธ"),
+    "%a": ("พ", "พ"),
+    "%B": ("ตุลาคม", "ตุลาคม"),
+    "%b": ("ต.ค.", "ต.ค."),
+    "%C": ("26", "20"),
+    "%c": ("พ   6 ต.ค. 01:40:00 2519", "พ   6 ต.ค. 01:40:00 1976"),
+    "%D": ("10/06/19", "10/06/76"),
+    "%F": ("2519-10-06", "1976-10-06"),
+    "%G": ("2519", "1976"),
+    "%g": ("19", "76"),
+    "%v": (" 6-ต.ค.-2519", " 6-ต.ค.-1976"),
+    "%X": ("01:40:00", "01:40:00"),
+    "%x": ("06/10/2519", "06/10/1976"),
+    "%Y": ("2519", "1976"),
+    "%y": ("19", "76"),
+    "%+": ("พ   6 ต.ค. 2519 01:40:00", "พ   6 ต.ค. 1976 01:40:00"),
+}
+
+GOLDEN_EXTENSIONS = {
+    # "E": alternative representation, not implemented (no-op)
+    "%Ey": "19",
+    "%EY": "2519",
+    # "O": alternative numeric symbols (Thai digits)
+    "%Od": "๐๖",
+    "%Oy": "๑๙",
+    "%OH": "๐๑",
+    # "-": no padding
+    "%-d": "6",
+    "%-H": "1",
+    "%-M": "40",
+    "%-v": "6-ต.ค.-2519",
+    "%-j": "280",
+    # "_": space padding
+    "%_d": " 6",
+    "%_H": " 1",
+    "%_m": "10",
+    # "0": zero padding
+    "%0v": "06-ต.ค.-2519",
+    "%0d": "06",
+    # "^": upper case
+    "%^p": "AM",
+    "%^b": "ต.ค.",
+    # "#": swap case
+    "%#p": "am",
+    # flags at the end of the string have no meaning
+    "%-": "-",
+    "%O": "O",
+    "%": "%",
+    "%%": "%",
+}
+
+GOLDEN_FORMATS = {
+    "%a %-d %b %y": "พ 6 ต.ค. 19",
+    "%A %d %B %Y": "วันพุธ 06 ตุลาคม 2519",
+    "%a %_d %b %y": "พ  6 ต.ค. 19",
+    "%D (%v)": "10/06/19 ( 6-ต.ค.-2519)",
+    "%H:%M %p": "01:40 AM",
+    "%H:%M %#p": "01:40 am",
+    "วันที่ %-d {%B}": "วันที่ 6 {ตุลาคม}",
+    "100%% %Y": "100% 2519",
+    "": "",
+}
+
+
+def all_implementations(dt_obj, fmt, thai_digit=False, buddhist_era=True):
+    return [
+        thai_strftime(dt_obj, fmt, thai_digit, buddhist_era),
+        compile_thai_format(fmt, thai_digit, buddhist_era)(dt_obj),
+        next(thai_strftime_many([dt_obj], fmt, thai_digit, buddhist_era)),
+    ]
+
+
+def test_golden_table_covers_every_directive_and_extension():
+    assert {fmt[1] for fmt in GOLDEN_L10N} == set(ts._NEED_L10N)
+    assert {fmt[1] for fmt in GOLDEN_EXTENSIONS if len(fmt) == 3} == set(ts._EXTENSIONS)
+
+
+@pytest.mark.parametrize("fmt", sorted(GOLDEN_L10N))
+def test_localized_directives(fmt):
+    buddhist_era, ad = GOLDEN_L10N[fmt]
+    assert all_implementations(DT, fmt) == [buddhist_era] * 3
+    assert all_implementations(DT, fmt, buddhist_era=False) == [ad] * 3
+
+
+@pytest.mark.parametrize("fmt", sorted(GOLDEN_EXTENSIONS))
+def test_extension_flags(fmt):
+    assert all_implementations(DT, fmt) == [GOLDEN_EXTENSIONS[fmt]] * 3
+
+
+@pytest.mark.parametrize("fmt", sorted(GOLDEN_FORMATS))
+def test_formats(fmt):
+    assert all_implementations(DT, fmt) == [GOLDEN_FORMATS[fmt]] * 3
+
+
+def test_thai_digit():
+    expected = "๕ นาฬิกา ๕๙ นาที"
+    dt_obj = datetime(2019, 6, 9, 5, 59)
+    fmt = "%-H นาฬิกา %-M นาที"
+    assert all_implementations(dt_obj, fmt, thai_digit=True) == [expected] * 3
+
+
+def test_iso_year_differs_from_calendar_year():
+    # 1 January 2021 belongs to ISO week 53 of 2020
+    dt_obj = datetime(2021, 1, 1)
+    assert all_implementations(dt_obj, "%G %g") == ["2563 63"] * 3
+
+
+def test_compile_thai_format_is_cached():
+    assert compile_thai_format("%A %d") is compile_thai_format("%A %d")
+    assert compile_thai_format("%A %d") is not compile_thai_format("%A %d", True)
+
+
+def test_thai_strftime_many_is_lazy():
+    def datetimes():
+        yield DT
+        raise AssertionError("consumed past the first item")
+
+    assert next(thai_strftime_many(datetimes(), "%Y")) == "2519"
+
+
+def test_thai_strftime_many_spans_batches():
+    dts = [DT + timedelta(hours=7 * i, seconds=i) for i in range(50)]
+    fmt = "%a %-d %b %y %H:%M:%S"
+    expected = [thai_strftime(dt_obj, fmt, thai_digit=True) for dt_obj in dts]
+    assert list(thai_strftime_many(dts, fmt, True, batch_size=7)) == expected
+
+
+# Reference implementation, written independently of thai_strftime's
+# character-by-character parser: a regular expression splits the format and
+# a table gives each Thai directive. Other directives use the same
+# platform strftime() fallback.
+
+
+def _reference_l10n(dt_obj, fmt_char, year):
+    weekday = ts._TH_ABBR_WEEKDAYS[dt_obj.weekday()]
+    month = ts._TH_ABBR_MONTHS[dt_obj.month - 1]
+    hms = "%02d:%02d:%02d" % (dt_obj.hour, dt_obj.minute, dt_obj.second)
+    iso_year = dt_obj.isocalendar()[0] + (year - dt_obj.year)
+    return {
+        "A": ts._TH_FULL_WEEKDAYS[dt_obj.weekday()],
+        "a": weekday,
+        "B": ts._TH_FULL_MONTHS[dt_obj.month - 1],
+        "b": month,
+        "C": "%02d" % (year // 100 + 1),
+        "c": "%-2s %2d %s %s %04d" % (weekday, dt_obj.day, month, hms, year),
+        "D": "%02d/%02d/%02d" % (dt_obj.month, dt_obj.day, year % 100),
+        "F": "%04d-%02d-%02d" % (year, dt_obj.month, dt_obj.day),
+        "G": "%04d" % iso_year,
+        "g": "%02d" % (iso_year % 100),
+        "v": "%2d-%s-%04d" % (dt_obj.day, month, year),
+        "X": hms,
+        "x": "%02d/%02d/%04d" % (dt_obj.day, dt_obj.month, year),
+        "Y": "%04d" % year,
+        "y": "%02d" % (year % 100),
+        "+": "%-2s %2d %s %d %s" % (weekday, dt_obj.day, month, year, hms),
+    }[fmt_char]
+
+
+_REFERENCE_FLAGS = {
+    "-": lambda s: s[1:] if s[:1] in (" ", "0") else s,
+    "_": lambda s: " " + s[1:] if s[:1] == "0" else s,
+    "0": lambda s: "0" + s[1:] if s[:1] == " " else s,
+    "^": str.upper,
+    "#": str.swapcase,
+    "E": lambda s: s,
+    "O": lambda s: s.translate(ts._HA_TH_DIGITS),
+}
+
+_REFERENCE_TOKEN = re.compile(r"%([EO_^#0-])(.)|%(.)|(%)$|([^%])", re.DOTALL)
+
+
+def reference_strftime(dt_obj, fmt, thai_digit=False, buddhist_era=True):
+    year = dt_obj.year + (543 if buddhist_era else 0)
+    out = []
+    for flag, flagged, directive, trailing, text in _REFERENCE_TOKEN.findall(fmt):
+        if flag:
+            directive = flagged
+        if directive:
+            if not flag and directive in _REFERENCE_FLAGS:
+                out.append(directive)  # flag at the end of the string
+                continue
+            if directive in ts._NEED_L10N:
+                value = _reference_l10n(dt_obj, directive, year)
+            else:
+                value = ts._std_strftime(dt_obj, directive)
+            if flag:
+                value = _REFERENCE_FLAGS[flag](value)
+            out.append(value)
+        else:
+            out.append(trailing or text)
+    text = "".join(out)
+    return text.translate(ts._HA_TH_DIGITS) if thai_digit else text
+
+
+# directives whose output is well defined on every platform
+_FUZZ_ALPHABET = ts._NEED_L10N + ts._EXTENSIONS + "dHIjmMSfp%" + "%%%%" + " :/-{}กข0"
+
+
+def _random_datetime(rng):
+    return datetime(
+        rng.randint(1000, 9999),
+        rng.randint(1, 12),
+        rng.randint(1, 28),
+        rng.randint(0, 23),
+        rng.randint(0, 59),
+        rng.randint(0, 59),
+        rng.randint(0, 999999),
+    )
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_formats_match_reference(seed):
+    rng = random.Random(seed)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        for _ in range(500):
+            fmt = "".join(rng.choice(_FUZZ_ALPHABET) for _ in range(rng.randint(1, 10)))
+            dt_obj = _random_datetime(rng)
+            thai_digit = rng.random() < 0.5
+            buddhist_era = rng.random() < 0.8
+            expected = reference_strftime(dt_obj, fmt, thai_digit, buddhist_era)
+            assert (
+                all_implementations(dt_obj, fmt, thai_digit, buddhist_era)
+                == [expected] * 3
+            ), fmt
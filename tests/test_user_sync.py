@@ -0,0 +1,73 @@
+import pytest
+
+zk = pytest.importorskip("zk")
+from zk.user import User  # noqa: E402
+
+import user_sync  # noqa: E402
+
+ADMIN = 14  # zk.const.USER_ADMIN
+
+
+class FakeConnection:
+    def __init__(self, fail_on=None):
+        self.calls = []
+        self.fail_on = fail_on
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            self.calls.append((name, kwargs))
+            if name == self.fail_on:
+                raise RuntimeError(name)
+
+        return call
+
+
+def test_diff_adds_updates_and_removes():
+    users = [
+        User(1, "Somchai", 0, user_id="101"),
+        User(2, "Old name", 0, password="12", card=77, user_id="102"),
+        User(3, "Left", 0, user_id="103"),
+        User(4, "Admin", ADMIN, user_id="900"),
+    ]
+    employees = {"101": "Somchai", "102": "New name", "104": "Malee"}
+    changes = user_sync.diff(employees, users)
+    assert changes.add == [("104", "Malee")]
+    assert [(user.uid, name) for user, name in changes.update] == [(2, "New name")]
+    # the admin is kept
+    assert [user.uid for user in changes.remove] == [3]
+    assert user_sync.diff(employees, users, remove=False).remove == []
+
+
+def test_names_compare_as_the_device_stores_them():
+    long_name = "สมชาย ใจดีมากมาย"  # more than 24 bytes in UTF-8
+    stored = user_sync.device_name(long_name, 72)
+    assert len(stored.encode()) <= 24
+    users = [User(1, stored, 0, user_id="101")]
+    assert not any(user_sync.diff({"101": long_name}, users))
+    assert user_sync.device_name("Somchai Jaidee", 28) == "Somchai"
+
+
+def test_apply_disables_the_device_only_around_the_writes():
+    conn = FakeConnection()
+    user_sync.apply(conn, user_sync.Changes([], [], []))
+    assert conn.calls == []
+
+    user = User(2, "Old name", 0, password="12", card=77, user_id="102")
+    user_sync.apply(
+        conn, user_sync.Changes([("104", "Malee")], [(user, "New name")], [user])
+    )
+    assert [name for name, _ in conn.calls] == [
+        "disable_device",
+        "set_user",
+        "set_user",
+        "delete_user",
+        "enable_device",
+    ]
+    assert conn.calls[2][1]["uid"] == 2 and conn.calls[2][1]["card"] == 77
+
+
+def test_apply_enables_the_device_after_a_failure():
+    conn = FakeConnection(fail_on="set_user")
+    with pytest.raises(RuntimeError):
+        user_sync.apply(conn, user_sync.Changes([("104", "Malee")], [], []))
+    assert conn.calls[-1][0] == "enable_device"
@@ -51,6 +51,7 @@
 
 import warnings
 from datetime import datetime
+from functools import lru_cache, partial
 
 _TH_ABBR_WEEKDAYS = ["จ", "อ", "พ", "พฤ", "ศ", "ส", "อา"]
 _TH_FULL_WEEKDAYS = [
@@ -416,4 +417,493 @@ def thai_strftime(
     if thai_digit:
         thaidate_text = thaidate_text.translate(_HA_TH_DIGITS)
 
-    return thaidate_text
\ No newline at end of file
+    return thaidate_text
+
+
+# Precompiled formatter for thai_strftime()
+#
+# thai_strftime() re-parses the format string and dispatches every directive
+# through the if/elif chain of _thai_strftime() on each call.
+# compile_thai_format() parses the format once into a str.format() template
+# and a list of specialised steps, one per directive:
+#   - Thai directives get a function with the Buddhist era offset baked in
+#   - runs of plain numeric directives (with ASCII text in between) are
+#     merged into a single datetime.strftime() call
+#   - extension flags wrap the step of the directive they apply to
+#   - anything else goes through _std_strftime(), same as thai_strftime()
+
+_STRFTIME_MERGEABLE = "dHIjmMSUWwfuVe"  # numeric, never empty when supported
+_strftime_supported = {}
+
+
+def _is_mergeable(fmt_char: str) -> bool:
+    # merged directives skip _std_strftime()'s normalization, so only
+    # directives this platform supports are merged
+    if fmt_char not in _strftime_supported:
+        directive = "%{}".format(fmt_char)
+        try:
+            str_ = datetime(2001, 2, 3, 4, 5, 6).strftime(directive)
+            supported = bool(str_) and str_ != directive
+        except ValueError:
+            supported = False
+        _strftime_supported[fmt_char] = supported
+    return fmt_char in _STRFTIME_MERGEABLE and _strftime_supported[fmt_char]
+
+
+def _hms(dt_obj: datetime) -> str:
+    # same as dt_obj.strftime("%H:%M:%S")
+    return "%02d:%02d:%02d" % (dt_obj.hour, dt_obj.minute, dt_obj.second)
+
+
+def _thai_step(fmt_char: str, buddhist_era: bool):
+    """Specialised equivalent of _thai_strftime(dt_obj, fmt_char, buddhist_era)."""
+    offset = _BE_AD_DIFFERENCE if buddhist_era else 0
+
+    if fmt_char == "A":
+        return lambda dt: _TH_FULL_WEEKDAYS[dt.weekday()]
+    if fmt_char == "a":
+        return lambda dt: _TH_ABBR_WEEKDAYS[dt.weekday()]
+    if fmt_char == "B":
+        return lambda dt: _TH_FULL_MONTHS[dt.month - 1]
+    if fmt_char == "b":
+        return lambda dt: _TH_ABBR_MONTHS[dt.month - 1]
+    if fmt_char == "C":
+        return lambda dt: str(int((dt.year + offset) / 100) + 1).zfill(2)
+    if fmt_char == "c":
+        return lambda dt: "{:<2} {:>2} {} {} {}".format(
+            _TH_ABBR_WEEKDAYS[dt.weekday()],
+            dt.day,
+            _TH_ABBR_MONTHS[dt.month - 1],
+            _hms(dt),
+            str(dt.year + offset).zfill(4),
+        )
+    if fmt_char == "D":
+        return lambda dt: "%02d/%02d/%s" % (
+            dt.month,
+            dt.day,
+            (str(dt.year + offset)[-2:]).zfill(2),
+        )
+    if fmt_char == "F":
+        return lambda dt: "%s-%02d-%02d" % (
+            str(dt.year + offset).zfill(4),
+            dt.month,
+            dt.day,
+        )
+    if fmt_char == "G":
+        return lambda dt: str(dt.isocalendar()[0] + offset).zfill(4)
+    if fmt_char == "g":
+        return lambda dt: (str(dt.isocalendar()[0] + offset)[-2:]).zfill(2)
+    if fmt_char == "v":
+        return lambda dt: "{:>2}-{}-{}".format(
+            dt.day, _TH_ABBR_MONTHS[dt.month - 1], str(dt.year + offset).zfill(4)
+        )
+    if fmt_char == "X":
+        return _hms
+    if fmt_char == "x":
+        return lambda dt: "%02d/%02d/%s" % (
+            dt.day,
+            dt.month,
+            str(dt.year + offset).zfill(4),
+        )
+    if fmt_char == "Y":
+        return lambda dt: str(dt.year + offset).zfill(4)
+    if fmt_char == "y":
+        return lambda dt: (str(dt.year + offset)[-2:]).zfill(2)
+    if fmt_char == "+":
+        return lambda dt: "{:<2} {:>2} {} {} {}".format(
+            _TH_ABBR_WEEKDAYS[dt.weekday()],
+            dt.day,
+            _TH_ABBR_MONTHS[dt.month - 1],
+            dt.year + offset,
+            _hms(dt),
+        )
+    return partial(_std_strftime, fmt_char=fmt_char)
+
+
+def _no_padding(str_: str) -> str:
+    return str_[1:] if str_[0] in " 0" else str_
+
+
+def _space_padding(str_: str) -> str:
+    return " " + str_[1:] if str_[0] == "0" else str_
+
+
+def _zero_padding(str_: str) -> str:
+    return "0" + str_[1:] if str_[0] == " " else str_
+
+
+def _thai_digits(str_: str) -> str:
+    return str_.translate(_HA_TH_DIGITS)
+
+
+_EXTENSION_STEPS = {
+    "-": _no_padding,  # GNU libc extension, no padding
+    "_": _space_padding,  # GNU libc extension, space padding
+    "0": _zero_padding,  # GNU libc extension, zero padding
+    "^": str.upper,  # GNU libc extension, upper case
+    "#": str.swapcase,  # GNU libc extension, swap case
+    "E": None,  # POSIX extension, alternative representation, not implemented
+    "O": _thai_digits,  # POSIX extension, alternative numeric symbols
+}
+
+
+def _extension_step(fmt_char_ext: str, step):
+    transform = _EXTENSION_STEPS[fmt_char_ext]
+    if transform is None:
+        return step
+    return lambda dt: transform(step(dt))
+
+
+# "%-d" and friends: two-digit directives with the padding removed
+_UNPADDED_STEPS = {
+    "d": lambda dt: str(dt.day),
+    "m": lambda dt: str(dt.month),
+    "H": lambda dt: str(dt.hour),
+    "M": lambda dt: str(dt.minute),
+    "S": lambda dt: str(dt.second),
+}
+
+
+def _tokenize(fmt: str):
+    """
+    Splits fmt the same way thai_strftime() walks it, into
+    ("text", str) and ("directive", fmt_char, fmt_char_ext or None) tokens.
+    """
+    tokens = []
+    i = 0
+    fmt_len = len(fmt)
+    while i < fmt_len:
+        if fmt[i] == "%":
+            j = i + 1
+            if j < fmt_len:
+                fmt_char = fmt[j]
+                if fmt_char in _NEED_L10N:
+                    tokens.append(("directive", fmt_char, None))
+                elif fmt_char in _EXTENSIONS:
+                    k = j + 1
+                    if k < fmt_len:
+                        tokens.append(("directive", fmt[k], fmt_char))
+                        i = i + 1  # consume char after format char
+                    else:
+                        # format char at string's end has no meaning
+                        tokens.append(("text", fmt_char))
+                elif fmt_char == "%":
+                    tokens.append(("text", "%"))
+                else:
+                    tokens.append(("directive", fmt_char, None))
+                i = i + 1  # consume char after "%"
+            else:
+                # % char at string's end has no meaning
+                tokens.append(("text", "%"))
+        else:
+            tokens.append(("text", fmt[i]))
+        i = i + 1
+    return tokens
+
+
+def _is_strftime_text(token) -> bool:
+    return token[0] == "text" and " " <= token[1] <= "~"
+
+
+def _is_strftime_directive(token) -> bool:
+    return (
+        token[0] == "directive"
+        and token[2] is None
+        and token[1] not in _NEED_L10N
+        and _is_mergeable(token[1])
+    )
+
+
+# what each directive's output depends on, for thai_strftime_many()
+_DATE_DIRECTIVES = "AaBbCDFGgvxYydjmUWwuVe"
+_TIME_DIRECTIVES = "XHIMSp"
+_DATE, _TIME, _OTHER = "date", "time", "other"
+
+
+def _directive_kind(fmt_chars: str) -> str:
+    if all(c in _DATE_DIRECTIVES for c in fmt_chars):
+        return _DATE
+    if all(c in _TIME_DIRECTIVES for c in fmt_chars):
+        return _TIME
+    return _OTHER  # %c, %+, %f, time zones, mixed runs and unknown
+
+
+def _split_thai_steps(fmt_char: str, buddhist_era: bool):
+    """%c and %+ as (step, kind) pairs, date parts apart from the time."""
+    offset = _BE_AD_DIFFERENCE if buddhist_era else 0
+    if fmt_char == "c":
+        return [
+            (
+                lambda dt: "{:<2} {:>2} {} ".format(
+                    _TH_ABBR_WEEKDAYS[dt.weekday()],
+                    dt.day,
+                    _TH_ABBR_MONTHS[dt.month - 1],
+                ),
+                _DATE,
+            ),
+            (_hms, _TIME),
+            (lambda dt: " " + str(dt.year + offset).zfill(4), _DATE),
+        ]
+    return [
+        (
+            lambda dt: "{:<2} {:>2} {} {} ".format(
+                _TH_ABBR_WEEKDAYS[dt.weekday()],
+                dt.day,
+                _TH_ABBR_MONTHS[dt.month - 1],
+                dt.year + offset,
+            ),
+            _DATE,
+        ),
+        (_hms, _TIME),
+    ]
+
+
+@lru_cache(maxsize=256)
+def _compile_steps(fmt: str, buddhist_era: bool, split_by_kind: bool = False):
+    """
+    Returns (str.format() template, steps, kinds) for fmt, where kinds tells
+    whether each step depends on the date, the time of day or anything else.
+
+    With split_by_kind, merged strftime() runs stop where the kind changes
+    and %c and %+ are split, so that more steps are date or time only.
+    """
+    tokens = _tokenize(fmt)
+    template_parts = []
+    steps = []
+    kinds = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if _is_strftime_directive(token) or _is_strftime_text(token):
+            # merge the run into one strftime() call if it has a directive
+            j = i
+            has_directive = False
+            run_kind = None
+            while j < len(tokens) and (
+                _is_strftime_directive(tokens[j]) or _is_strftime_text(tokens[j])
+            ):
+                if tokens[j][0] == "directive":
+                    kind = _directive_kind(tokens[j][1])
+                    if split_by_kind and run_kind not in (None, kind):
+                        break
+                    run_kind = kind
+                    has_directive = True
+                j = j + 1
+            if has_directive:
+                strftime_fmt = "".join(
+                    "%" + t[1] if t[0] == "directive" else t[1].replace("%", "%%")
+                    for t in tokens[i:j]
+                )
+                steps.append(partial(datetime.strftime, format=strftime_fmt))
+                kinds.append(
+                    _directive_kind(
+                        "".join(t[1] for t in tokens[i:j] if t[0] != "text")
+                    )
+                )
+                template_parts.append("{}")
+            else:
+                template_parts.extend(t[1] for t in tokens[i:j])
+            i = j
+            continue
+        if token[0] == "text":
+            template_parts.append(token[1])
+        elif split_by_kind and token[1] in "c+" and token[2] is None:
+            for step, kind in _split_thai_steps(token[1], buddhist_era):
+                steps.append(step)
+                kinds.append(kind)
+                template_parts.append("{}")
+        else:
+            _, fmt_char, fmt_char_ext = token
+            if fmt_char_ext == "-" and fmt_char in _UNPADDED_STEPS:
+                step = _UNPADDED_STEPS[fmt_char]
+            else:
+                if fmt_char in _NEED_L10N:
+                    step = _thai_step(fmt_char, buddhist_era)
+                elif _is_mergeable(fmt_char):
+                    step = partial(datetime.strftime, format="%" + fmt_char)
+                else:
+                    step = partial(_std_strftime, fmt_char=fmt_char)
+                if fmt_char_ext is not None:
+                    step = _extension_step(fmt_char_ext, step)
+            steps.append(step)
+            kinds.append(_directive_kind(fmt_char))
+            template_parts.append("{}")
+        i = i + 1
+    template = "".join(
+        part if part == "{}" else part.replace("{", "{{").replace("}", "}}")
+        for part in template_parts
+    )
+    return template, tuple(steps), tuple(kinds)
+
+
+@lru_cache(maxsize=256)
+def compile_thai_format(
+    fmt: str = "%-d %b %y",
+    thai_digit: bool = False,
+    buddhist_era: bool = True,
+):
+    """
+    Compile a format string for :func:`thai_strftime` once.
+
+    The result is cached, so calling this with the same arguments is cheap.
+
+    :param str fmt: string containing date and time directives
+    :param bool thai_digit: represent numbers in Thai digits
+    :param bool buddhist_era: use the Thai Buddhist Era for years
+
+    :return: a function taking a :class:`datetime.datetime` and returning
+             the same text as ``thai_strftime(dt_obj, fmt, thai_digit,
+             buddhist_era)``
+
+    :Example:
+    ::
+
+        fmt_thai = compile_thai_format("%a %-d %b %y")
+        fmt_thai(datetime(year=1976, month=10, day=6))
+        # output: 'พ 6 ต.ค. 19'
+    """
+    template, steps, _ = _compile_steps(fmt, buddhist_era)
+
+    if not steps:
+        text = template.format()
+        if thai_digit:
+            text = text.translate(_HA_TH_DIGITS)
+        return lambda dt_obj: text
+
+    render = template.format
+    if len(steps) == 1:
+        step = steps[0]
+        if thai_digit:
+            return lambda dt_obj: render(step(dt_obj)).translate(_HA_TH_DIGITS)
+        return lambda dt_obj: render(step(dt_obj))
+
+    if thai_digit:
+        return lambda dt_obj: render(*[step(dt_obj) for step in steps]).translate(
+            _HA_TH_DIGITS
+        )
+    return lambda dt_obj: render(*[step(dt_obj) for step in steps])
+
+
+_BATCH_SEPARATOR = "\x00"
+_DATE_CACHE_SIZE = 4096
+_TIME_CACHE_SIZE = 86400
+
+
+def thai_strftime_many(
+    datetimes,
+    fmt: str = "%-d %b %y",
+    thai_digit: bool = False,
+    buddhist_era: bool = True,
+    batch_size: int = 1024,
+):
+    """
+    Lazily format many :class:`datetime.datetime` objects with
+    :func:`thai_strftime`.
+
+    Attendance timestamps mostly fall on a few dates, so the parts of the
+    format that only depend on the date (Thai weekday and month names,
+    Buddhist Era year, ISO year, ...) are computed once per calendar date
+    and the parts that only depend on the time of day once per second.
+    With `thai_digit`, Thai digits are translated once over each batch of
+    joined outputs instead of once per timestamp.
+
+    :param datetimes: an iterable of :class:`datetime.datetime`
+    :param str fmt: string containing date and time directives
+    :param bool thai_digit: represent numbers in Thai digits
+    :param bool buddhist_era: use the Thai Buddhist Era for years
+    :param int batch_size: timestamps per batch when translating digits
+
+    :return: a generator of texts, same as ``thai_strftime()`` for each
+             item of `datetimes`
+
+    :Example:
+    ::
+
+        list(thai_strftime_many(checkin_times, "%a %-d %b %y %H:%M"))
+    """
+    template, steps, kinds = _compile_steps(fmt, buddhist_era, True)
+    render = template.format
+    date_steps = [step for step, kind in zip(steps, kinds) if kind == _DATE]
+    time_steps = [step for step, kind in zip(steps, kinds) if kind == _TIME]
+    other_steps = [step for step, kind in zip(steps, kinds) if kind == _OTHER]
+
+    # position of each step's output in date parts + time parts + other parts
+    counters = {
+        _DATE: 0,
+        _TIME: len(date_steps),
+        _OTHER: len(date_steps) + len(time_steps),
+    }
+    order = []
+    for kind in kinds:
+        order.append(counters[kind])
+        counters[kind] += 1
+
+    date_cache = {}
+    time_cache = {}
+    in_order = order == sorted(order)
+
+    if not time_steps and not other_steps:
+        # the whole text only depends on the date
+        def format_one(dt_obj):
+            date_key = dt_obj.toordinal()
+            text = date_cache.get(date_key)
+            if text is None:
+                if len(date_cache) >= _DATE_CACHE_SIZE:
+                    date_cache.clear()
+                text = render(*[step(dt_obj) for step in steps])
+                if thai_digit:
+                    text = text.translate(_HA_TH_DIGITS)
+                date_cache[date_key] = text
+            return text
+
+        for dt_obj in datetimes:
+            yield format_one(dt_obj)
+        return
+
+    def format_one(dt_obj):
+        date_key = dt_obj.toordinal()
+        date_parts = date_cache.get(date_key)
+        if date_parts is None:
+            if len(date_cache) >= _DATE_CACHE_SIZE:
+                date_cache.clear()
+            date_parts = date_cache[date_key] = tuple(
+                step(dt_obj) for step in date_steps
+            )
+        time_key = (dt_obj.hour, dt_obj.minute, dt_obj.second)
+        time_parts = time_cache.get(time_key)
+        if time_parts is None:
+            if len(time_cache) >= _TIME_CACHE_SIZE:
+                time_cache.clear()
+            time_parts = time_cache[time_key] = tuple(
+                step(dt_obj) for step in time_steps
+            )
+        parts = date_parts + time_parts
+        if other_steps:
+            parts = parts + tuple(step(dt_obj) for step in other_steps)
+        if in_order:
+            return render(*parts)
+        return render(*[parts[i] for i in order])
+
+    if not thai_digit:
+        for dt_obj in datetimes:
+            yield format_one(dt_obj)
+        return
+
+    if _BATCH_SEPARATOR in fmt:
+        # the separator could appear in the output, translate one by one
+        for dt_obj in datetimes:
+            yield format_one(dt_obj).translate(_HA_TH_DIGITS)
+        return
+
+    batch = []
+    for dt_obj in datetimes:
+        batch.append(format_one(dt_obj))
+        if len(batch) >= batch_size:
+            yield from _BATCH_SEPARATOR.join(batch).translate(_HA_TH_DIGITS).split(
+                _BATCH_SEPARATOR
+            )
+            batch = []
+    if batch:
+        yield from _BATCH_SEPARATOR.join(batch).translate(_HA_TH_DIGITS).split(
+            _BATCH_SEPARATOR
+        )
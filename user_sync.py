@@ -0,0 +1,212 @@
+# Sync of the ERPNext employees to the user tables of the devices.
+#
+# The active Employees with an attendance_device_id are listed in one paged
+# query (from every site with ERPNEXT_SITES), and each device's users are
+# read once over the connection get_all_attendance_from_device uses. Users
+# are compared by a hash of the fields the sync manages (user_id and the
+# name as the device stores it), so a device is only written to for:
+#   - add: an employee with no user on the device
+#   - update: a user whose name differs from the employee name; privilege,
+#     password, group and card are kept
+#   - remove: a user matching no active employee. Device admins are never
+#     removed.
+# The devices are synced in parallel, and each one is disabled only while
+# its changes are written, and only if there are any.
+#
+# Usage:
+#   python3 erpnext_sync.py user-sync                  # print the changes
+#   python3 erpnext_sync.py user-sync --apply [--no-remove] [--device-id HO1]
+
+import hashlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import erpnext_sync
+import reconcile
+from erpnext_sync import config, error_logger, info_logger
+
+USER_DEFAULT = 0  # zk.const.USER_DEFAULT, the privilege of non-admin users
+# bytes of the name field, by user record size
+NAME_BYTES = {28: 8, 72: 24}
+ENCODING = "UTF-8"  # pyzk's default
+
+Changes = namedtuple("Changes", ["add", "update", "remove"])
+
+
+def active_employees():
+    """{attendance_device_id: employee_name} of the active employees."""
+    import erpnext_sites
+
+    employees = {}
+    for site in erpnext_sites.site_names() or [None]:
+        for row in reconcile.iter_list(
+            "Employee",
+            ["name", "employee_name", "attendance_device_id"],
+            [["status", "=", "Active"], ["attendance_device_id", "is", "set"]],
+            "name asc",
+            site=site,
+        ):
+            user_id = (row.get("attendance_device_id") or "").strip()
+            if user_id:
+                employees.setdefault(user_id, row.get("employee_name") or row["name"])
+    return employees
+
+
+def device_name(name, user_packet_size):
+    """name as the device stores it: truncated to the bytes of its name
+    field, as pyzk reads it back.
+    """
+    size = NAME_BYTES.get(int(user_packet_size or 72), 24)
+    return name.encode(ENCODING)[:size].decode(ENCODING, errors="ignore").strip()
+
+
+def user_hash(user_id, name):
+    return hashlib.sha1("\0".join((user_id, name)).encode()).hexdigest()
+
+
+def diff(employees, users, user_packet_size=72, remove=True):
+    """Changes that bring the users of a device (pyzk User objects) in line
+    with employees ({user_id: name}): add [(user_id, name)], update
+    [(user, name)] and remove [user].
+    """
+    wanted = {
+        user_id: device_name(name, user_packet_size)
+        for user_id, name in employees.items()
+    }
+    wanted_hashes = {
+        user_id: user_hash(user_id, name) for user_id, name in wanted.items()
+    }
+    on_device = {}
+    for user in users:
+        # the first user wins, like pyzk's lookups by user_id
+        on_device.setdefault(user.user_id, user)
+    changes = Changes([], [], [])
+    for user_id, name in wanted.items():
+        user = on_device.get(user_id)
+        if user is None:
+            changes.add.append((user_id, name))
+        elif user_hash(user.user_id, user.name) != wanted_hashes[user_id]:
+            changes.update.append((user, name))
+    if remove:
+        changes.remove.extend(
+            user
+            for user in users
+            if user.user_id not in wanted and user.privilege == USER_DEFAULT
+        )
+    return changes
+
+
+def apply(conn, changes):
+    """Writes the changes to a connected device, disabled meanwhile."""
+    if not any(changes):
+        return
+    conn.disable_device()
+    try:
+        for user_id, name in changes.add:
+            conn.set_user(name=name, user_id=user_id)
+        for user, name in changes.update:
+            conn.set_user(
+                uid=user.uid,
+                name=name,
+                privilege=user.privilege,
+                password=user.password,
+                group_id=user.group_id,
+                user_id=user.user_id,
+                card=user.card,
+            )
+        for user in changes.remove:
+            conn.delete_user(uid=user.uid)
+    finally:
+        conn.enable_device()
+
+
+def sync_device(device, employees, dry_run=True, remove=True):
+    """Changes of a device, applied unless dry_run."""
+    with erpnext_sync.device_connection(device["ip"]) as conn:
+        changes = diff(employees, conn.get_users(), conn.user_packet_size, remove)
+        if not dry_run:
+            apply(conn, changes)
+    info_logger.info(
+        "\t".join(
+            [
+                "User sync (dry run):" if dry_run else "User sync:",
+                device["device_id"],
+                "add",
+                str(len(changes.add)),
+                "update",
+                str(len(changes.update)),
+                "remove",
+                str(len(changes.remove)),
+            ]
+        )
+    )
+    return changes
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--device-id",
+        action="append",
+        help="sync only this device (repeatable); defaults to every configured device",
+    )
+    parser.add_argument(
+        "--apply",
+        action="store_true",
+        help="write the changes to the devices; without it they are only printed",
+    )
+    parser.add_argument(
+        "--no-remove",
+        action="store_true",
+        help="keep the users that match no active employee",
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="print every user changed"
+    )
+
+
+def run(args):
+    devices = [
+        device
+        for device in config.devices
+        if not args.device_id or device["device_id"] in args.device_id
+    ]
+    employees = active_employees()
+    if not employees and not args.no_remove:
+        # an empty answer would remove every user from the devices
+        print("No active employee with an attendance_device_id found in ERPNext")
+        return 2
+
+    def sync(device):
+        try:
+            return sync_device(device, employees, not args.apply, not args.no_remove)
+        except Exception as e:
+            error_logger.exception(
+                "exception when syncing users to device " + device["device_id"]
+            )
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(1, len(devices))) as executor:
+        results = list(executor.map(sync, devices))
+    exit_code = 0
+    for device, changes in zip(devices, results):
+        if isinstance(changes, Exception):
+            print("{}: failed: {}".format(device["device_id"], changes))
+            exit_code = 1
+            continue
+        print(
+            "{}: {} to add, {} to update, {} to remove{}".format(
+                device["device_id"],
+                len(changes.add),
+                len(changes.update),
+                len(changes.remove),
+                "" if args.apply else " (dry run, --apply to write them)",
+            )
+        )
+        if args.verbose:
+            for user_id, name in changes.add:
+                print("  + {}\t{}".format(user_id, name))
+            for user, name in changes.update:
+                print("  ~ {}\t{} -> {}".format(user.user_id, user.name, name))
+            for user in changes.remove:
+                print("  - {}\t{}".format(user.user_id, user.name))
+    return exit_code